@@ -1,21 +1,45 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context, g, copy_current_request_context
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
-import google.generativeai as genai
-import base64
-import io
-from PIL import Image
+from sqlalchemy import and_, bindparam, or_, text
 import os
-from datetime import datetime, timedelta
+from datetime import datetime
 import uuid
 import json
+import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from llm_pool import LLMPool, LLMPoolError, PoolFullError
+from assessment_cache import AssessmentCache, make_cache_key, normalize_form_data
+from image_pipeline import ImageRejectedError, content_hash, decode_image_payload, prepare_image, read_image_upload
+from image_store import create_image_store
+from werkzeug.exceptions import RequestEntityTooLarge
+from retention import RetentionWorker
+from session_archive import SessionArchive, session_record
+from database import SQLITE_ENGINE_OPTIONS, configure_sqlite_engine, migrate
+from prompt_builder import PROMPT_TOKEN_BUDGET, build_chat_prompt, extend_summary
+from session_store import create_session_store, new_response, new_session
+from llm_backend import create_model
+from resilience import CircuitOpenError, UpstreamError, create_resilient_model
+from singleflight import IdempotencyStore, SingleFlight, payload_digest
+from table_stats import TableStats
+from http_cache import compressed, make_etag, not_modified
+from rate_limit import create_rate_limiter, rate_limited
+from ratings import ASSESSMENT_SECTIONS, RatingBackfill
+from job_queue import JobFailed, JobQueue, RetryLater
+import metrics
+from metrics import record_size, span
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for React frontend
 
+# Reject oversized request bodies before they are parsed (base64 JSON images need the headroom)
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_CONTENT_LENGTH', 16 * 1024 * 1024))
+
 # Database configuration
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///baby_health_data.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///baby_health_data.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = SQLITE_ENGINE_OPTIONS
 db = SQLAlchemy(app)
 
 # Database Models
@@ -23,12 +47,19 @@ class ChatSession(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     session_id = db.Column(db.String(36), unique=True, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.now)
-    last_activity = db.Column(db.DateTime, default=datetime.now)
+    last_activity = db.Column(db.DateTime, default=datetime.now, index=True)
     initial_assessment = db.Column(db.Text)
     baby_info = db.Column(db.JSON)
+    conversation_summary = db.Column(db.Text)  # Rolling summary of turns no longer sent verbatim
+    summarized_until = db.Column(db.Integer, default=0)  # Last ChatResponse.id folded into the summary
     responses = db.relationship('ChatResponse', backref='session', lazy=True, cascade='all, delete-orphan')
 
 class ChatResponse(db.Model):
+    __table_args__ = (
+        # Serves filter_by(session_id=...).order_by(created_at) without a sort
+        db.Index('ix_chat_response_session_created', 'session_id', 'created_at'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     session_id = db.Column(db.String(36), db.ForeignKey('chat_session.session_id'), nullable=False)
     response_text = db.Column(db.Text, nullable=False)
@@ -36,50 +67,145 @@ class ChatResponse(db.Model):
     response_type = db.Column(db.String(20), default='chat')  # 'assessment' or 'chat'
     created_at = db.Column(db.DateTime, default=datetime.now)
 
-# Create tables
+# Tables are created and migrated by migrate_database() (`flask --app app5 migrate`),
+# not on import, so starting a worker never touches the schema
 with app.app_context():
-    db.create_all()
+    configure_sqlite_engine(db.engine)
+    database_path = db.engine.url.database
 
-# Configure Gemini API
-genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-model = genai.GenerativeModel('gemini-1.5-flash')
+# Session lookups and new responses for /submit-assessment and /chat go through the
+# session store: 'tiered' serves hot sessions from memory and writes back in batches,
+# 'sqlite' writes through. The other endpoints query the same tables via SQLAlchemy.
+session_store = create_session_store(os.getenv('SESSION_STORE', 'tiered'), database_path)
 
-def cleanup_old_sessions():
-    """Clean up sessions and responses older than 1 week"""
-    try:
-        one_week_ago = datetime.now() - timedelta(days=7)
-        
-        # Delete old responses first (due to foreign key constraint)
-        old_responses = ChatResponse.query.join(ChatSession).filter(
-            ChatSession.last_activity < one_week_ago
-        ).delete(synchronize_session=False)
-        
-        # Delete old sessions
-        old_sessions = ChatSession.query.filter(
-            ChatSession.last_activity < one_week_ago
-        ).delete()
-        
-        db.session.commit()
-        print(f"Cleaned up {old_sessions} sessions and {old_responses} responses")
-        
-    except Exception as e:
-        print(f"Error during cleanup: {e}")
-        db.session.rollback()
+# Expired sessions are copied to compressed JSONL files under ARCHIVE_DIR before they are
+# deleted, so they stay available for quality review (set ARCHIVE_DIR= to just delete them)
+archive_dir = os.getenv('ARCHIVE_DIR', os.path.join(app.instance_path, 'archive'))
+session_archive = SessionArchive(archive_dir, codec=os.getenv('ARCHIVE_CODEC', 'gzip')) if archive_dir else None
+
+# Prepared session photos, kept once per distinct image so follow-up /chat questions can
+# attach them by reference (IMAGE_STORE=off drops photos after the assessment again)
+image_store = create_image_store(database_path, app.instance_path)
+
+def archive_sessions(session_ids):
+    """Write a batch of sessions about to be deleted, with their responses, to the archive"""
+    sessions = ChatSession.query.filter(ChatSession.session_id.in_(session_ids)).all()
+    responses = {}
+    for response in (ChatResponse.query.filter(ChatResponse.session_id.in_(session_ids))
+                     .order_by(ChatResponse.session_id, ChatResponse.created_at)):
+        responses.setdefault(response.session_id, []).append(response)
+    session_archive.write([session_record(s, responses.get(s.session_id, [])) for s in sessions])
+
+def delete_ratings(session_ids):
+    """Remove the parsed ratings of sessions the retention worker is about to delete"""
+    db.session.execute(
+        text('DELETE FROM response_rating WHERE session_id IN :session_ids')
+        .bindparams(bindparam('session_ids', expanding=True)),
+        {'session_ids': session_ids}
+    )
+
+def delete_session_images(session_ids):
+    """Remove the image references of sessions the retention worker is about to delete"""
+    db.session.execute(
+        text('DELETE FROM session_image WHERE session_id IN :session_ids')
+        .bindparams(bindparam('session_ids', expanding=True)),
+        {'session_ids': session_ids}
+    )
+
+def collect_session_images(session_ids):
+    """Delete stored images that no remaining session refers to"""
+    image_store.collect()
+
+# Delete sessions idle for longer than the retention TTL in the background
+retention_worker = RetentionWorker(
+    app, db, ChatSession, ChatResponse,
+    ttl_days=int(os.getenv('RETENTION_TTL_DAYS', 7)),
+    interval=int(os.getenv('RETENTION_INTERVAL_SECONDS', 3600)),
+    batch_size=int(os.getenv('RETENTION_BATCH_SIZE', 500)),
+    # Write-behind session activity must reach SQLite before expired sessions are picked from it
+    before_batch=[session_store.flush],
+    before_delete=([archive_sessions] if session_archive else []) + [delete_ratings] +
+                  ([delete_session_images] if image_store else []),
+    on_deleted=[session_store.forget] + ([collect_session_images] if image_store else [])
+)
+
+def count_rows():
+    """Full row counts for the stats snapshot (table scans, so only run in the background)"""
+    with app.app_context():
+        try:
+            return {
+                'sessions': ChatSession.query.count(),
+                'responses': ChatResponse.query.count()
+            }
+        finally:
+            db.session.remove()
+
+# New responses get their confidence ratings parsed as they are written; responses stored
+# before the response_rating table existed are parsed once by migrate_database()
+rating_backfill = RatingBackfill(database_path)
+
+# Row counts for /stats and /health, refreshed periodically instead of per request
+table_stats = TableStats(count_rows, interval=int(os.getenv('STATS_REFRESH_SECONDS', 60)))
+
+# Deadlines, retries, optional hedging and a circuit breaker around every model call. The
+# Gemini client itself (or the LLM_BACKEND=fake stub) is only built on first use, since
+# importing the SDK takes about a second; init_worker() starts that in the background
+model = create_resilient_model(model_factory=create_model)
+
+# Dedicated worker pool for model calls so bursts queue up (or get rejected) instead of
+# tying up every request thread
+llm_pool = LLMPool(
+    max_concurrency=int(os.getenv('LLM_MAX_CONCURRENCY', 4)),
+    max_queue=int(os.getenv('LLM_MAX_QUEUE', 16)),
+    deadline=float(os.getenv('LLM_DEADLINE_SECONDS', 60))
+)
+
+# Cache of assessments for identical submissions (set ASSESSMENT_CACHE_DB to share it across processes)
+assessment_cache = AssessmentCache(
+    max_entries=int(os.getenv('ASSESSMENT_CACHE_SIZE', 256)),
+    ttl=int(os.getenv('ASSESSMENT_CACHE_TTL', 3600)),
+    db_path=os.getenv('ASSESSMENT_CACHE_DB') or None
+)
+
+# Identical submissions in progress share one model call, and retries that send the same
+# Idempotency-Key within the window get the stored result instead of a new one
+single_flight = SingleFlight(
+    linger=float(os.getenv('SINGLE_FLIGHT_LINGER_SECONDS', 5)),
+    max_age=float(os.getenv('LLM_DEADLINE_SECONDS', 60)) * 2
+)
+idempotency_store = IdempotencyStore(ttl=int(os.getenv('IDEMPOTENCY_TTL_SECONDS', 600)))
+
+# Token buckets per client IP and per session in front of every endpoint that calls the model
+# (RATE_LIMIT_*); RATE_LIMIT_BACKEND=sqlite shares them between worker processes
+rate_limiter = create_rate_limiter(database_path)
+
+# Request/stage timings on /metrics, plus Server-Timing when a request sends X-Debug-Timing: 1
+metrics_registry = metrics.init_app(app)
+model.register_metrics(metrics_registry)
+rate_limiter.register_metrics(metrics_registry)
+metrics_registry.gauge('llm_pool_calls', 'Model calls on the LLM pool by state', ['state'],
+                       function=lambda: {('queued',): llm_pool.queued, ('running',): llm_pool.running})
+metrics_registry.counter('llm_pool_events_total', 'Finished, rejected and timed out model calls', ['event'],
+                         function=lambda: {('completed',): llm_pool.completed, ('rejected',): llm_pool.rejected,
+                                           ('timed_out',): llm_pool.timed_out})
+metrics_registry.counter('assessment_cache_events_total', 'Assessment cache lookups and writes by outcome', ['event'],
+                         function=lambda: {(name,): value for name, value in dict(assessment_cache.stats).items()})
+metrics_registry.gauge('assessment_cache_entries', 'Assessments held in the in-memory cache',
+                       function=lambda: assessment_cache.snapshot()['entries'])
 
 def get_session_context(session_id, limit=5):
     """Get recent chat history for context"""
     try:
-        recent_responses = ChatResponse.query.filter_by(
-            session_id=session_id
-        ).order_by(ChatResponse.created_at.desc()).limit(limit).all()
+        recent_responses = session_store.recent_responses(session_id, limit)
         
         context = []
-        for response in reversed(recent_responses):  # Reverse to get chronological order
-            if response.response_type == 'chat' and response.user_message:
+        for response in recent_responses:
+            if response['response_type'] == 'chat' and response['user_message']:
                 context.append({
-                    'user_message': response.user_message,
-                    'response': response.response_text,
-                    'timestamp': response.created_at.isoformat()
+                    'id': response['id'],
+                    'user_message': response['user_message'],
+                    'response': response['response_text'],
+                    'timestamp': response['created_at'].isoformat()
                 })
         
         return context
@@ -87,23 +213,263 @@ def get_session_context(session_id, limit=5):
         print(f"Error getting session context: {e}")
         return []
 
-def process_image(base64_string):
-    """Convert base64 image to PIL Image for Gemini API"""
+def update_rolling_summary(chat_session, recent_history):
+    """Fold chat turns that have left the recent window into the session's rolling summary"""
+    # Turns still waiting for a write-behind flush have no id yet; fold them in on a later turn
+    if not recent_history or recent_history[0]['id'] is None:
+        return
+    
+    older_turns = session_store.responses_between(
+        chat_session['session_id'],
+        chat_session['summarized_until'] or 0,
+        recent_history[0]['id'],
+        response_type='chat'
+    )
+    if not older_turns:
+        return
+    
+    chat_session['conversation_summary'] = extend_summary(
+        chat_session['conversation_summary'],
+        [{'user_message': turn['user_message'], 'response': turn['response_text']} for turn in older_turns]
+    )
+    chat_session['summarized_until'] = older_turns[-1]['id']
+
+def read_submission():
+    """Read form fields and raw image bytes from a JSON, multipart or raw image request
+
+    Multipart and raw uploads are spooled by Werkzeug and read straight into bytes,
+    skipping the base64 string the JSON path has to carry and decode.
+    """
+    if request.mimetype == 'multipart/form-data':
+        data = request.form.to_dict()
+        data['location'] = request.form.getlist('location')
+        upload = request.files.get('image')
+        image_data = read_image_upload(upload.stream) if upload else None
+    elif request.mimetype.startswith('image/'):
+        # Raw image body, form fields in the query string
+        data = request.args.to_dict()
+        data['location'] = request.args.getlist('location')
+        image_data = read_image_upload(request.stream)
+    else:
+        data = request.get_json()
+        image_data = decode_image_payload(data['image']) if data.get('image') else None
+    return data, image_data
+
+def wants_stream(data):
+    """Check whether the client asked for a streamed (Server-Sent Events) response"""
+    if data.get('stream'):
+        return True
+    if request.args.get('stream', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return 'text/event-stream' in request.headers.get('Accept', '')
+
+def wants_async(data):
+    """Check whether the client asked for a job id instead of waiting for the assessment"""
+    if data.get('async'):
+        return True
+    if request.args.get('async', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return 'respond-async' in request.headers.get('Prefer', '')
+
+def cache_bypassed(data):
+    """Check whether the client asked to skip the assessment cache"""
+    if data.get('no_cache'):
+        return True
+    return 'no-cache' in request.headers.get('Cache-Control', '')
+
+def sse_event(event, payload):
+    """Format a single Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+def llm_error_response(error):
+    """Build the response for a model call that was rejected, timed out or failed upstream"""
+    # Kept for process_assessment_job, which needs to know whether the model was called at all
+    g.llm_error = error
+    response = jsonify({'error': str(error), 'success': False})
+    response.status_code = error.status_code
+    if error.retry_after:
+        response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def stream_model_response(model_input, on_complete, start_payload=None, on_close=None):
+    """Forward Gemini output to the client as it arrives, then persist the full text"""
+    # The circuit breaker and pool admission are checked here, so an open circuit or an
+    # overloaded pool is reported before the stream starts; the pool worker iterates the stream.
+    # The stream's retry deadline starts now too, so it runs out with the pool's.
+    with span('llm_admit'):
+        model_stream = llm_pool.stream(iter, model.generate_content(model_input, stream=True,
+                                                                    deadline=llm_pool.deadline))
+    
+    def complete(text):
+        record_size('response', text)
+        return on_complete(text)
+    
+    return sse_response((chunk.text for chunk in model_stream), complete, start_payload, on_close)
+
+def generate_text(model_input):
+    """Run a blocking model call on the LLM pool and return its text"""
+    with span('llm'):
+        response = llm_pool.submit(model.generate_content, model_input, deadline_arg='deadline')
+    record_size('response', response.text)
+    return response.text
+
+def sse_response(text_chunks, on_complete, start_payload=None, on_close=None):
+    """Send text chunks as Server-Sent Events, then persist the full text
+
+    on_close runs once the stream ends for any reason, including a client disconnect.
+    """
+    def generate():
+        yield sse_event('start', start_payload or {})
+        chunks = []
+        try:
+            with span('llm_stream'):
+                for text in text_chunks:
+                    if not text:
+                        continue
+                    chunks.append(text)
+                    yield sse_event('chunk', {'text': text})
+
+            # Store the complete response once the stream has finished
+            done_payload = on_complete(''.join(chunks))
+            yield sse_event('done', done_payload)
+
+        except Exception as e:
+            print(f"Gemini API error while streaming: {e}")
+            yield sse_event('error', {'error': 'Failed to generate response', 'success': False})
+        finally:
+            if on_close:
+                on_close()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def replay_result(status, payload, data):
+    """Send a stored or shared result the way the client asked for it"""
+    if status == 200 and wants_stream(data):
+        text = payload.get('assessment', payload.get('response', ''))
+        start_payload = {'session_id': payload.get('session_id', data.get('session_id'))}
+        return sse_response([text], lambda _: payload, start_payload)
+    response = jsonify(payload)
+    response.status_code = status
+    return response
+
+def run_single_flight(name, scope, digest, data, handler):
+    """Run handler once for identical concurrent requests and replay results for idempotent retries
+
+    handler(publish, close) builds the leader's response. Plain responses are
+    shared when it returns; streamed ones must call publish(payload) with the
+    final payload and close() when the stream ends. A scope of None means
+    nothing ties the request to one client (e.g. a new session from an IP
+    that may be shared), so it is only coalesced under an Idempotency-Key.
+    """
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if not idempotency_key and scope is None:
+        return handler(lambda payload: payload, lambda: None)
+    if idempotency_key:
+        try:
+            stored = idempotency_store.get(name, idempotency_key, digest)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 422
+        if stored is not None:
+            response = replay_result(*stored, data)
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+        flight_key = f'{name}:key:{idempotency_key}'
+    else:
+        flight_key = f'{name}:{scope}:{digest}'
+    
     try:
-        # Remove data URL prefix if present
-        if ',' in base64_string:
-            base64_string = base64_string.split(',')[1]
-        
-        # Decode base64 to bytes
-        image_data = base64.b64decode(base64_string)
-        
-        # Convert to PIL Image
-        image = Image.open(io.BytesIO(image_data))
-        return image
+        # Under an Idempotency-Key the digest isn't part of the flight key, so begin() compares it
+        flight, leader = single_flight.begin(flight_key, digest if idempotency_key else None)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 422
+    if not leader:
+        try:
+            status, payload = single_flight.wait(flight)
+        except TimeoutError as e:
+            return jsonify({'error': str(e), 'success': False}), 504
+        return replay_result(status, dict(payload, coalesced=True) if status == 200 else payload, data)
+    
+    def finish(status, payload):
+        if flight.done.is_set():
+            return
+        if idempotency_key and status == 200:
+            idempotency_store.set(name, idempotency_key, digest, status, payload)
+        # Errors go to the followers already waiting, but the next attempt runs again
+        single_flight.finish(flight_key, flight, (status, payload), share=status == 200)
+    
+    def publish(payload):
+        finish(200, payload)
+        return payload
+    
+    def close():
+        finish(500, {'error': 'Failed to generate response', 'success': False})
+    
+    try:
+        response = app.make_response(handler(publish, close))
+    except Exception:
+        close()
+        raise
+    if not response.is_streamed:
+        finish(response.status_code, response.get_json())
+    return response
+
+def store_session_image(session_id, image_data, image_digest, image=None):
+    """Keep a session's prepared photo for follow-up questions and return its image_ref
+
+    An upload that is already stored is only linked to the session; otherwise
+    it is prepared here if the model call didn't need it (a cache hit).
+    Failing to store it only costs follow-ups the photo, so it is logged
+    instead of failing the assessment.
+    """
+    if image_store is None or not image_data:
+        return None
+    try:
+        with span('image_store'):
+            if image is None:
+                image_ref = image_store.find(image_digest)
+                if image_ref and image_store.link(session_id, image_ref):
+                    return image_ref
+                image = prepare_image(image_data)
+            return image_store.add(session_id, image) if image else None
     except Exception as e:
-        print(f"Error processing image: {e}")
+        print(f"Error storing session image: {e}")
         return None
 
+def save_assessment(chat_session, assessment_result, image_ref=None):
+    """Store an assessment response and return the JSON payload for the client"""
+    # Store initial assessment if this is first time
+    if not chat_session['initial_assessment']:
+        chat_session['initial_assessment'] = assessment_result
+    
+    # Store session and response
+    with span('store'):
+        session_store.save_session(chat_session)
+        session_store.add_response(chat_session['session_id'], 'assessment', assessment_result)
+    
+    payload = {
+        'session_id': chat_session['session_id'],
+        'assessment': assessment_result,
+        'success': True
+    }
+    if image_ref:
+        payload['image_ref'] = image_ref
+    return payload
+
+def save_chat_response(chat_session, user_message, bot_response):
+    """Store a follow-up chat response and return the JSON payload for the client"""
+    with span('store'):
+        session_store.save_session(chat_session)
+        session_store.add_response(chat_session['session_id'], 'chat', bot_response, user_message)
+    
+    return {
+        'response': bot_response,
+        'success': True
+    }
+
 def create_baby_assessment_prompt(form_data, historical_context=None):
     """Create a comprehensive prompt for baby health assessment"""
 
@@ -177,102 +543,359 @@ Keep your response clear, reassuring when appropriate, but always err on the sid
     
     return prompt
 
+def baby_info_from_form(data, has_image):
+    """Baby information stored on a new session, from the submitted form fields"""
+    return {
+        'location': data.get('location', []),
+        'feedingType': data.get('feedingType', ''),
+        'stoolColor': data.get('stoolColor', ''),
+        'Age (in months)': data.get('numberText', ''),
+        'durationText': data.get('durationText', ''),
+        'temperatureText': data.get('temperatureText', ''),
+        'extraNotes': data.get('extraNotes', ''),
+        'hasImage': has_image
+    }
+
+def assessment_cache_key(baby_info, historical_context, image_digest):
+    """Cache key built from the normalized form so equivalent submissions match"""
+    normalized = normalize_form_data(baby_info)
+    prompt = create_baby_assessment_prompt(normalized, historical_context)
+    return make_cache_key(normalized, prompt, image_digest)
+
 @app.route('/submit-assessment', methods=['POST'])
+@rate_limited(rate_limiter)
 def submit_assessment():
     """Handle initial baby health assessment submission"""
     try:
-        data = request.get_json()
+        try:
+            with span('read_submission'):
+                data, image_data = read_submission()
+        except (ImageRejectedError, RequestEntityTooLarge) as e:
+            return jsonify({'error': str(e)}), 413
         
-        # Get or create session
-        session_id = data.get('session_id', str(uuid.uuid4()))
+        if data.get('image') and image_data is None:
+            return jsonify({'error': 'Failed to process image'}), 400
         
-        # Check if session exists in database
-        chat_session = ChatSession.query.filter_by(session_id=session_id).first()
+        # Asynchronous mode: queue the work and answer with a job id straight away
+        if wants_async(data):
+            return enqueue_assessment_job(data, image_data)
         
-        if not chat_session:
-            # Create new session
-            baby_info = {
-                'location': data.get('location', []),
-                'feedingType': data.get('feedingType', ''),
-                'stoolColor': data.get('stoolColor', ''),
-                'Age (in months)': data.get('numberText', ''),
-                'durationText': data.get('durationText', ''),
-                'temperatureText': data.get('temperatureText', ''),
-                'extraNotes': data.get('extraNotes', ''),
-                'hasImage': bool(data.get('image'))
-            }
+        submitted_info = baby_info_from_form(data, image_data is not None)
+        image_digest = content_hash(image_data) if image_data else None
+        
+        # Double taps and retries of the same submission share one model call and one stored response.
+        # New sessions are only coalesced under an Idempotency-Key: clients behind one address
+        # sending the same form must not end up sharing a session.
+        digest = payload_digest(data.get('session_id'), normalize_form_data(submitted_info), image_digest)
+        return run_single_flight(
+            'submit-assessment',
+            data.get('session_id'),
+            digest,
+            data,
+            lambda publish, close: run_assessment(data, image_data, image_digest, submitted_info, publish, close)
+        )
             
-            chat_session = ChatSession(
-                session_id=session_id,
-                baby_info=baby_info
-            )
-            db.session.add(chat_session)
+    except Exception as e:
+        print(f"Error in submit_assessment: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+def run_assessment(data, image_data, image_digest, submitted_info, publish, close):
+    """Generate (or fetch from cache) and store one assessment"""
+    # Get or create session
+    session_id = data.get('session_id', str(uuid.uuid4()))
+    
+    # Check if session exists
+    with span('session_lookup'):
+        chat_session = session_store.get_session(session_id)
+    
+    if not chat_session:
+        # Create new session
+        baby_info = submitted_info
+        chat_session = new_session(session_id, baby_info)
+    else:
+        # Update existing session activity
+        chat_session['last_activity'] = datetime.now()
+        baby_info = chat_session['baby_info'] or {}
+    
+    # Get historical context for this baby
+    historical_context = None
+    if chat_session['initial_assessment']:
+        historical_context = f"Previous assessment: {chat_session['initial_assessment'][:500]}..."
+    
+    # Create assessment prompt
+    with span('prompt'):
+        prompt = create_baby_assessment_prompt(baby_info, historical_context)
+    
+    # Identical form data, prompt and photo get the same assessment
+    with span('cache_lookup'):
+        cache_key = assessment_cache_key(baby_info, historical_context, image_digest)
+        cached_result = None
+        if cache_bypassed(data):
+            assessment_cache.record_bypass()
         else:
-            # Update existing session activity
-            chat_session.last_activity = datetime.now()
-            baby_info = chat_session.baby_info or {}
+            cached_result = assessment_cache.get(cache_key)
+    
+    image = None
+    
+    def store_assessment(assessment_result):
+        # The photo is kept for follow-up questions once the assessment has succeeded
+        image_ref = store_session_image(session_id, image_data, image_digest, image)
+        return save_assessment(chat_session, assessment_result, image_ref)
+    
+    def complete_assessment(assessment_result):
+        assessment_cache.set(cache_key, assessment_result)
+        return publish(store_assessment(assessment_result))
+    
+    if cached_result is not None:
+        if wants_stream(data):
+            return sse_response(
+                [cached_result],
+                lambda text: publish(dict(store_assessment(text), cached=True)),
+                start_payload={'session_id': session_id},
+                on_close=close
+            )
+        return jsonify(dict(store_assessment(cached_result), cached=True))
+    
+    # Downscale and re-encode the image only when the model actually needs it
+    model_input = prompt
+    if image_data:
+        with span('image_prepare'):
+            image = prepare_image(image_data)
+        if image is None:
+            return jsonify({'error': 'Failed to process image'}), 400
+        record_size('image', image.data)
+        model_input = [prompt, image.as_model_part()]
+    record_size('prompt', prompt)
+    
+    # Generate response from Gemini
+    try:
+        # Stream partial text back as it is generated if requested
+        if wants_stream(data):
+            return stream_model_response(
+                model_input,
+                complete_assessment,
+                start_payload={'session_id': session_id},
+                on_close=close
+            )
         
-        # Get historical context for this baby
-        historical_context = None
-        if chat_session.initial_assessment:
-            historical_context = f"Previous assessment: {chat_session.initial_assessment[:500]}..."
+        assessment_result = generate_text(model_input)
         
-        # Create assessment prompt
-        prompt = create_baby_assessment_prompt(baby_info, historical_context)
+        return jsonify(complete_assessment(assessment_result))
         
-        # Process image if provided
-        image = None
-        if data.get('image'):
-            image = process_image(data['image'])
-            if image is None:
-                return jsonify({'error': 'Failed to process image'}), 400
+    except (LLMPoolError, UpstreamError) as e:
+        return llm_error_response(e)
+    except Exception as e:
+        print(f"Gemini API error: {e}")
+        return jsonify({'error': 'Failed to generate assessment'}), 500
+
+def enqueue_assessment_job(data, image_data):
+    """Persist a submission as a queued job and return 202 with where to poll for it"""
+    form = {key: value for key, value in data.items() if key not in ('image', 'stream', 'async')}
+    form['no_cache'] = cache_bypassed(data)
+    job_id = job_queue.enqueue({
+        'form': form,
+        'image': base64.b64encode(image_data).decode('ascii') if image_data else None
+    })
+    response = jsonify({'job_id': job_id, 'status': 'queued', 'status_url': f'/jobs/{job_id}'})
+    response.status_code = 202
+    response.headers['Location'] = f'/jobs/{job_id}'
+    return response
+
+def process_assessment_job(payload):
+    """Job queue handler: run one queued submission through the same code as /submit-assessment"""
+    data = payload['form']
+    image_data = base64.b64decode(payload['image']) if payload.get('image') else None
+    submitted_info = baby_info_from_form(data, image_data is not None)
+    image_digest = content_hash(image_data) if image_data else None
+    
+    # A bare request context, so the shared code sees no stream or cache headers from a client
+    with app.test_request_context('/submit-assessment', method='POST'):
+        response = app.make_response(
+            run_assessment(data, image_data, image_digest, submitted_info, lambda payload: payload, lambda: None)
+        )
+        body = response.get_json() or {}
+        llm_error = g.get('llm_error')
+    
+    if response.status_code == 200:
+        return body
+    if isinstance(llm_error, (PoolFullError, CircuitOpenError)):
+        # Refused before any model call was made: wait for room without using up an attempt.
+        # Upstream failures and timeouts did call the model, so they count against max_attempts.
+        raise RetryLater(body.get('error'), delay=float(response.headers.get('Retry-After', 1)))
+    if response.status_code >= 500:
+        raise RuntimeError(body.get('error', 'Assessment failed'))
+    raise JobFailed(body.get('error', 'Assessment failed'))
+
+# Queued assessments live in the same database so they survive restarts
+job_queue = JobQueue(
+    database_path,
+    process_assessment_job,
+    workers=int(os.getenv('JOB_WORKERS', 2)),
+    lease_seconds=int(os.getenv('JOB_LEASE_SECONDS', 300)),
+    max_attempts=int(os.getenv('JOB_MAX_ATTEMPTS', 3)),
+    result_ttl=int(os.getenv('JOB_RESULT_TTL_SECONDS', 86400))
+)
+metrics_registry.gauge('job_queue_jobs', 'Assessment jobs in the queue table by status', ['status'],
+                       function=lambda: {(status,): jobs for status, jobs in job_queue.depth().items()})
+
+# Longest a /jobs/<id> request may hold the connection waiting for a result
+MAX_JOB_WAIT = float(os.getenv('JOB_MAX_WAIT_SECONDS', 30))
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Status and result of a queued assessment
+
+    With ?wait=N the request long-polls for up to N seconds (capped at
+    JOB_MAX_WAIT_SECONDS) and returns as soon as the job has finished.
+    """
+    try:
+        try:
+            wait = min(float(request.args.get('wait', 0)), MAX_JOB_WAIT)
+        except ValueError:
+            return jsonify({'error': 'wait must be a number of seconds'}), 400
         
-        # Generate response from Gemini
+        job = job_queue.wait(job_id, wait) if wait > 0 else job_queue.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify(job)
+        
+    except Exception as e:
+        print(f"Error getting job: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/job-queue-stats', methods=['GET'])
+def job_queue_stats():
+    """Queue depth by status, age of the oldest queued job and worker counters"""
+    return jsonify(job_queue.stats())
+
+# Most forms /submit-assessments accepts at once, and how many of them call the model in parallel
+MAX_BATCH_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 50))
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 4))
+
+def assess_batch_item(form):
+    """Generate the assessment for one batch form without storing it
+
+    Returns (result, session, response) for a success or (error, None, None),
+    where error carries the item's HTTP-style status.
+    """
+    if not isinstance(form, dict):
+        return {'error': 'Each item must be a JSON object', 'status': 400}, None, None
+    try:
+        image_data = decode_image_payload(form['image']) if form.get('image') else None
+    except ImageRejectedError as e:
+        return {'error': str(e), 'status': 413}, None, None
+    if form.get('image') and image_data is None:
+        return {'error': 'Failed to process image', 'status': 400}, None, None
+    
+    baby_info = baby_info_from_form(form, image_data is not None)
+    with span('prompt'):
+        prompt = create_baby_assessment_prompt(baby_info)
+    image_digest = content_hash(image_data) if image_data else None
+    cache_key = assessment_cache_key(baby_info, None, image_digest)
+    
+    cached = None
+    image = None
+    if form.get('no_cache'):
+        assessment_cache.record_bypass()
+    else:
+        cached = assessment_cache.get(cache_key)
+    
+    if cached is not None:
+        assessment_result = cached
+    else:
+        model_input = prompt
+        if image_data:
+            with span('image_prepare'):
+                image = prepare_image(image_data)
+            if image is None:
+                return {'error': 'Failed to process image', 'status': 400}, None, None
+            model_input = [prompt, image.as_model_part()]
+        record_size('prompt', prompt)
         try:
-            if image:
-                response = model.generate_content([prompt, image])
-            else:
-                response = model.generate_content(prompt)
-            
-            assessment_result = response.text
-            
-            # Store initial assessment if this is first time
-            if not chat_session.initial_assessment:
-                chat_session.initial_assessment = assessment_result
-            
-            # Store response in database
-            chat_response = ChatResponse(
-                session_id=session_id,
-                response_text=assessment_result,
-                response_type='assessment'
-            )
-            db.session.add(chat_response)
-            db.session.commit()
-            
-            # Clean up old sessions (run occasionally)
-            # You might want to run this as a background job instead
-            if datetime.now().hour == 2 and datetime.now().minute < 5:  # Run at 2 AM
-                cleanup_old_sessions()
-            
-            return jsonify({
-                'session_id': session_id,
-                'assessment': assessment_result,
-                'success': True
-            })
-            
+            assessment_result = generate_text(model_input)
+        except (LLMPoolError, UpstreamError) as e:
+            return {'error': str(e), 'status': e.status_code, 'retry_after': e.retry_after}, None, None
         except Exception as e:
-            db.session.rollback()
-            print(f"Gemini API error: {e}")
-            return jsonify({'error': 'Failed to generate assessment'}), 500
-            
+            print(f"Gemini API error in batch item: {e}")
+            return {'error': 'Failed to generate assessment', 'status': 500}, None, None
+        assessment_cache.set(cache_key, assessment_result)
+    
+    session = new_session(str(uuid.uuid4()), baby_info)
+    session['initial_assessment'] = assessment_result
+    response = new_response(session['session_id'], 'assessment', assessment_result)
+    result = {'session_id': session['session_id'], 'assessment': assessment_result, 'cached': cached is not None}
+    image_ref = store_session_image(session['session_id'], image_data, image_digest, image)
+    if image_ref:
+        result['image_ref'] = image_ref
+    return result, session, response
+
+def batch_cost():
+    """Rate limit tokens a batch takes: one per assessment in it"""
+    data = request.get_json(silent=True)
+    forms = data.get('assessments') if isinstance(data, dict) else data
+    return len(forms) if isinstance(forms, list) and forms else 1
+
+@app.route('/submit-assessments', methods=['POST'])
+@rate_limited(rate_limiter, cost=batch_cost)
+def submit_assessments():
+    """Assess a batch of intake forms concurrently and store every new session in one transaction
+
+    Body: {"assessments": [form, ...]} with the same fields /submit-assessment takes
+    (images as base64). Every form starts a new session. Items fail independently;
+    each result has its index and either session_id/assessment or error/status.
+    """
+    try:
+        data = request.get_json(silent=True)
+        forms = data.get('assessments') if isinstance(data, dict) else data
+        if not isinstance(forms, list) or not forms:
+            return jsonify({'error': 'Expected a non-empty "assessments" array'}), 400
+        if len(forms) > MAX_BATCH_ITEMS:
+            return jsonify({'error': f'At most {MAX_BATCH_ITEMS} assessments per batch'}), 413
+        
+        # Every form starts a new session, so only an Idempotency-Key coalesces batches
+        return run_single_flight(
+            'submit-assessments',
+            None,
+            payload_digest(forms),
+            {},
+            lambda publish, close: run_assessment_batch(forms)
+        )
+        
     except Exception as e:
-        db.session.rollback()
-        print(f"Error in submit_assessment: {e}")
+        print(f"Error in submit_assessments: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
+def run_assessment_batch(forms):
+    """Fan the forms out to the model under BATCH_CONCURRENCY and store the successes together"""
+    # Each item runs in its own copy of this request's context, so spans are attributed to the batch endpoint
+    tasks = [copy_current_request_context(assess_batch_item) for _ in forms]
+    with ThreadPoolExecutor(max_workers=min(BATCH_CONCURRENCY, len(forms)), thread_name_prefix='batch') as executor:
+        outcomes = list(executor.map(lambda task, form: task(form), tasks, forms))
+    
+    sessions = [session for _, session, _ in outcomes if session]
+    responses = [response for _, _, response in outcomes if response]
+    if sessions:
+        with span('store'):
+            session_store.save_batch(sessions, responses)
+    
+    results = [dict(result, index=index) for index, (result, _, _) in enumerate(outcomes)]
+    failed = sum(1 for result in results if 'error' in result)
+    return jsonify({
+        'results': results,
+        'succeeded': len(results) - failed,
+        'failed': failed,
+        'success': failed == 0
+    })
+
 @app.route('/chat', methods=['POST'])
+@rate_limited(rate_limiter)
 def chat():
-    """Handle follow-up chat messages"""
+    """Handle follow-up chat messages
+
+    With "attach_image": true the session's photo from the assessment is sent
+    to the model with the question; "image_ref" picks one of the session's
+    photos by the image_ref the assessment returned.
+    """
     try:
         data = request.get_json()
         session_id = data.get('session_id')
@@ -281,113 +904,260 @@ def chat():
         if not session_id or not user_message:
             return jsonify({'error': 'Missing session_id or message'}), 400
         
-        # Get chat session from database
-        chat_session = ChatSession.query.filter_by(session_id=session_id).first()
-        if not chat_session:
-            return jsonify({'error': 'Invalid session_id'}), 404
+        # A resent question shares the answer already being generated for it
+        return run_single_flight(
+            'chat',
+            session_id,
+            payload_digest(session_id, user_message, bool(data.get('attach_image')), data.get('image_ref')),
+            data,
+            lambda publish, close: run_chat(data, session_id, user_message, publish, close)
+        )
+            
+    except Exception as e:
+        print(f"Error in chat: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+# Appended to the follow-up prompt when the session's photo is sent with it
+CHAT_IMAGE_NOTE = "\nThe photo sent with the initial assessment is attached; refer to it where it helps answer the question.\n"
+
+def session_image(session_id, image_ref=None):
+    """A session's stored photo (its latest, or the one with image_ref), or None"""
+    if image_store is None:
+        return None
+    with span('image_load'):
+        image_refs = image_store.session_images(session_id)
+        if not image_refs or (image_ref and image_ref not in image_refs):
+            return None
+        return image_store.get(image_ref or image_refs[-1])
+
+def run_chat(data, session_id, user_message, publish, close):
+    """Answer and store one follow-up question"""
+    # Get chat session from the session store
+    with span('session_lookup'):
+        chat_session = session_store.get_session(session_id)
+    if not chat_session:
+        return jsonify({'error': 'Invalid session_id'}), 404
+    
+    # Update last activity
+    chat_session['last_activity'] = datetime.now()
+    
+    # Get recent chat history for context
+    with span('history'):
+        recent_history = get_session_context(session_id)
+    
+    # Older turns are carried as a compact summary instead of raw text
+    with span('summary'):
+        update_rolling_summary(chat_session, recent_history)
+    
+    # Create context-aware prompt for follow-up questions within the token budget
+    with span('prompt'):
+        context_prompt, g.prompt_stats = build_chat_prompt(
+            chat_session['initial_assessment'],
+            chat_session['baby_info'],
+            chat_session['conversation_summary'],
+            recent_history,
+            user_message,
+            budget=PROMPT_TOKEN_BUDGET
+        )
+    record_size('prompt', context_prompt)
+    
+    # The photo is only sent when asked for, by reference, rather than with every question
+    model_input = context_prompt
+    if data.get('attach_image') or data.get('image_ref'):
+        image = session_image(session_id, data.get('image_ref'))
+        if image is None:
+            return jsonify({'error': 'No stored image for this session'}), 404
+        record_size('image', image.data)
+        model_input = [context_prompt + CHAT_IMAGE_NOTE, image.as_model_part()]
+    
+    # Generate response
+    try:
+        # Stream partial text back as it is generated if requested
+        if wants_stream(data):
+            return stream_model_response(
+                model_input,
+                lambda text: publish(save_chat_response(chat_session, user_message, text)),
+                start_payload={'session_id': session_id},
+                on_close=close
+            )
         
-        # Update last activity
-        chat_session.last_activity = datetime.now()
+        bot_response = generate_text(model_input)
         
-        # Get recent chat history for context
-        recent_history = get_session_context(session_id)
+        return jsonify(save_chat_response(chat_session, user_message, bot_response))
         
-        # Create context-aware prompt for follow-up questions
-        context_prompt = f"""You are continuing a conversation about a baby's health. 
+    except (LLMPoolError, UpstreamError) as e:
+        return llm_error_response(e)
+    except Exception as e:
+        print(f"Gemini API error in chat: {e}")
+        return jsonify({'error': 'Failed to generate response'}), 500
 
-IMPORTANT: When providing assessments or identifying conditions, always include accuracy/confidence ratings in brackets like [XX% match], [XX% confidence], or [XX% likely].
+# Largest page /get-session returns when a limit is requested
+MAX_HISTORY_PAGE = 500
 
-PREVIOUS ASSESSMENT CONTEXT:
-{chat_session.initial_assessment}
+def encode_history_cursor(created_at, response_id):
+    """Opaque cursor pointing just past a chat history row"""
+    raw = json.dumps([created_at.isoformat(), response_id])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
 
-BABY INFORMATION:
-"""
-        
-        baby_info = chat_session.baby_info or {}
-        for key, value in baby_info.items():
-            if value and key != 'hasImage':
-                context_prompt += f"• {key}: {value}\n"
-        
-        context_prompt += f"""
-RECENT CHAT HISTORY:
-"""
+def decode_history_cursor(cursor):
+    """Inverse of encode_history_cursor, raises ValueError on a malformed cursor"""
+    try:
+        created_at, response_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.fromisoformat(created_at), int(response_id)
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+def history_query(session_id, since=None, after=None):
+    """Column-only, keyset-ordered query for a session's chat history
+
+    Selecting plain columns skips ORM object hydration, and ordering by
+    (created_at, id) lets the (session_id, created_at) index serve the query.
+    """
+    query = db.session.query(
+        ChatResponse.id,
+        ChatResponse.response_type,
+        ChatResponse.response_text,
+        ChatResponse.user_message,
+        ChatResponse.created_at
+    ).filter(ChatResponse.session_id == session_id)
+    
+    if since:
+        query = query.filter(ChatResponse.created_at > since)
+    if after:
+        created_at, response_id = after
+        query = query.filter(or_(
+            ChatResponse.created_at > created_at,
+            and_(ChatResponse.created_at == created_at, ChatResponse.id > response_id)
+        ))
+    
+    return query.order_by(ChatResponse.created_at, ChatResponse.id)
+
+def history_entry(row):
+    """JSON shape of one chat history row"""
+    return {
+        'type': row.response_type,
+        'response': row.response_text,
+        'user_message': row.user_message,
+        'timestamp': row.created_at.isoformat()
+    }
+
+def parse_history_params():
+    """Read since/cursor/limit query parameters, raising ValueError on bad input"""
+    since = request.args.get('since')
+    since = datetime.fromisoformat(since) if since else None
+    
+    cursor = request.args.get('cursor')
+    after = decode_history_cursor(cursor) if cursor else None
+    
+    limit = request.args.get('limit')
+    if limit is not None:
+        limit = int(limit)
+        if limit < 1:
+            raise ValueError('limit must be positive')
+        limit = min(limit, MAX_HISTORY_PAGE)
+    
+    return since, after, limit
+
+def stream_session_json(session_info, query, limit):
+    """Stream the session JSON with chat_history written one row at a time"""
+    def generate():
+        yield json.dumps(session_info)[:-1] + ', "chat_history": ['
         
-        # Add recent chat history
-        for exchange in recent_history:
-            context_prompt += f"User: {exchange['user_message']}\n"
-            context_prompt += f"Assistant: {exchange['response']}\n"
+        last_row = None
+        count = 0
+        for row in query.yield_per(200):
+            if limit is not None and count == limit:
+                # One extra row was fetched only to learn that another page exists
+                next_cursor = encode_history_cursor(last_row.created_at, last_row.id)
+                yield f'], "next_cursor": {json.dumps(next_cursor)}}}'
+                return
+            yield (', ' if count else '') + json.dumps(history_entry(row))
+            last_row = row
+            count += 1
         
-        context_prompt += f"""
-CURRENT USER QUESTION: {user_message}
+        yield '], "next_cursor": null}'
+    
+    return Response(stream_with_context(generate()), mimetype='application/json')
 
-Please respond to the user's question while maintaining context of the baby's condition and previous conversation. 
-Continue to emphasize that this is not medical advice and recommend consulting a pediatrician when appropriate.
-REMEMBER: Include accuracy/confidence ratings in brackets [XX%] for any medical assessments or condition identifications.
+def session_etag(chat_session):
+    """ETag for a session's /get-session representation with the current query parameters
 
-EXAMPLES:
-- "That symptom could indicate teething [75% likely]"
-- "The described behavior is typical for this age [88% normal]"
-- "This might be a growth spurt [70% confidence]"
-"""
-        
-        # Generate response
-        try:
-            response = model.generate_content(context_prompt)
-            bot_response = response.text
-            
-            # Store in database
-            chat_response = ChatResponse(
-                session_id=session_id,
-                response_text=bot_response,
-                user_message=user_message,
-                response_type='chat'
-            )
-            db.session.add(chat_response)
-            db.session.commit()
-            
-            return jsonify({
-                'response': bot_response,
-                'success': True
-            })
-            
-        except Exception as e:
-            db.session.rollback()
-            print(f"Gemini API error in chat: {e}")
-            return jsonify({'error': 'Failed to generate response'}), 500
-            
-    except Exception as e:
-        db.session.rollback()
-        print(f"Error in chat: {e}")
-        return jsonify({'error': 'Internal server error'}), 500
+    Responses are append-only, so last_activity with the response count and
+    the newest response's time identify the session's state. The session
+    store answers from memory or an index lookup, including writes it hasn't
+    flushed yet.
+    """
+    session_id = chat_session['session_id']
+    return make_etag(session_id, chat_session['last_activity'], *session_store.history_version(session_id),
+                     request.query_string.decode('latin-1'))
 
 @app.route('/get-session/<session_id>', methods=['GET'])
+@compressed
 def get_session(session_id):
-    """Get session information and chat history"""
+    """Get session information and chat history
+
+    Optional query parameters:
+    - limit: page size, returns next_cursor when more rows exist
+    - cursor: next_cursor from the previous page
+    - since: ISO timestamp, only rows created after it
+    - stream: write the history row by row instead of building it in memory
+
+    Responses carry an ETag; polls sending it back in If-None-Match get a 304
+    without the history being queried or serialized while nothing changed.
+    """
     try:
-        chat_session = ChatSession.query.filter_by(session_id=session_id).first()
+        try:
+            since, after, limit = parse_history_params()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        with span('session_lookup'):
+            chat_session = session_store.get_session(session_id)
         if not chat_session:
             return jsonify({'error': 'Session not found'}), 404
         
-        # Get all responses for this session
-        responses = ChatResponse.query.filter_by(session_id=session_id).order_by(ChatResponse.created_at).all()
+        with span('etag'):
+            etag = session_etag(chat_session)
+        unchanged = not_modified(etag)
+        if unchanged:
+            return unchanged
         
-        chat_history = []
-        for response in responses:
-            chat_history.append({
-                'type': response.response_type,
-                'response': response.response_text,
-                'user_message': response.user_message,
-                'timestamp': response.created_at.isoformat()
-            })
+        # Not a 304, so the history is read: make the session store's buffered writes visible to it
+        with span('flush'):
+            session_store.flush()
         
-        return jsonify({
+        session_info = {
             'session_id': session_id,
-            'initial_assessment': chat_session.initial_assessment,
-            'baby_info': chat_session.baby_info,
-            'chat_history': chat_history,
-            'created_at': chat_session.created_at.isoformat(),
-            'last_activity': chat_session.last_activity.isoformat()
-        })
+            'initial_assessment': chat_session['initial_assessment'],
+            'baby_info': chat_session['baby_info'],
+            'created_at': chat_session['created_at'].isoformat(),
+            'last_activity': chat_session['last_activity'].isoformat(),
+            'image_refs': image_store.session_images(session_id) if image_store else []
+        }
+        
+        query = history_query(session_id, since=since, after=after)
+        if limit is not None:
+            query = query.limit(limit + 1)
+        
+        if request.args.get('stream', '').lower() in ('1', 'true', 'yes'):
+            response = stream_session_json(session_info, query, limit)
+        else:
+            with span('history'):
+                rows = query.all()
+            next_cursor = None
+            if limit is not None and len(rows) > limit:
+                rows = rows[:limit]
+                next_cursor = encode_history_cursor(rows[-1].created_at, rows[-1].id)
+            
+            response = jsonify(dict(
+                session_info,
+                chat_history=[history_entry(row) for row in rows],
+                next_cursor=next_cursor
+            ))
+        
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
         
     except Exception as e:
         print(f"Error getting session: {e}")
@@ -395,39 +1165,267 @@ def get_session(session_id):
 
 @app.route('/cleanup-old-sessions', methods=['POST'])
 def manual_cleanup():
-    """Manually trigger cleanup of old sessions"""
+    """Manually trigger cleanup of old sessions on the retention worker
+
+    Only the process holding the background jobs lock runs retention, so two
+    workers never archive or delete the same batch; any other answers 409.
+    """
+    if not claim_singleton_jobs():
+        return jsonify({'error': 'Retention runs in another worker process, try again',
+                        'success': False}), 409
+    retention_worker.start()
+    retention_worker.trigger()
+    return jsonify({'message': 'Cleanup scheduled', 'status': retention_worker.status()}), 202
+
+@app.route('/cleanup-status', methods=['GET'])
+def cleanup_status():
+    """Retention worker status and statistics from recent runs"""
+    status = retention_worker.status()
+    status['archive'] = session_archive.status() if session_archive else None
+    return jsonify(status)
+
+@app.after_request
+def add_prompt_headers(response):
+    """Report the prompt budget and estimated size for requests that built a prompt"""
+    stats = g.get('prompt_stats')
+    if stats:
+        response.headers['X-Prompt-Token-Budget'] = str(stats['budget'])
+        response.headers['X-Prompt-Tokens'] = str(stats['estimated_tokens'])
+        response.headers['X-Prompt-History-Turns'] = str(stats['history_turns'])
+    return response
+
+@app.route('/session-store-stats', methods=['GET'])
+def session_store_stats():
+    """Session store size, hit/miss and flush counters"""
+    return jsonify(session_store.stats())
+
+@app.route('/single-flight-stats', methods=['GET'])
+def single_flight_stats():
+    """Coalesced request and idempotent replay counters"""
+    return jsonify({'single_flight': single_flight.snapshot(), 'idempotency': idempotency_store.snapshot()})
+
+@app.route('/rate-limit-stats', methods=['GET'])
+def rate_limit_stats():
+    """Rate limiter settings, bucket count and allowed/limited counters"""
+    return jsonify(rate_limiter.status())
+
+@app.route('/image-store-stats', methods=['GET'])
+def image_store_stats():
+    """Stored session images, their total size and the store's counters"""
+    return jsonify(image_store.status() if image_store else {'enabled': False})
+
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    """Assessment cache hit/miss counters"""
+    return jsonify(assessment_cache.snapshot())
+
+def database_ready():
+    """Trivial round trip to the database, returns the error message or None"""
     try:
-        cleanup_old_sessions()
-        return jsonify({'message': 'Cleanup completed successfully'})
+        db.session.execute(text('SELECT 1'))
+        return None
     except Exception as e:
-        return jsonify({'error': f'Cleanup failed: {str(e)}'}), 500
+        return str(e)
+
+@app.route('/livez', methods=['GET'])
+def liveness_check():
+    """Liveness probe: the process is up and serving requests, no database access"""
+    return jsonify({'status': 'alive', 'timestamp': datetime.now().isoformat()})
+
+@app.route('/readyz', methods=['GET'])
+def readiness_check():
+    """Readiness probe: the database answers a trivial query"""
+    error = database_ready()
+    if error:
+        return jsonify({'status': 'unavailable', 'database': 'disconnected', 'error': error}), 503
+    return jsonify({'status': 'ready', 'database': 'connected'})
+
+@app.route('/stats', methods=['GET'])
+def table_stats_snapshot():
+    """Row counts from the last periodic snapshot"""
+    return jsonify(table_stats.snapshot())
+
+# Largest number of conditions /stats/conditions returns
+MAX_CONDITIONS = 200
+
+@app.route('/stats/conditions', methods=['GET'])
+def condition_stats():
+    """Most frequently rated conditions with their average, min and max percentages
+
+    Optional query parameters:
+    - section: assessment (default), explanation, warning_signs, care, chat or all
+    - kind: only ratings of this kind (match, likely, confidence)
+    - since: ISO timestamp, only ratings from responses created after it
+    - limit: number of conditions (default 20)
+    """
+    section = request.args.get('section', 'assessment')
+    if section not in ASSESSMENT_SECTIONS + ('chat', 'all'):
+        return jsonify({'error': f'Unknown section: {section}'}), 400
+    try:
+        since = request.args.get('since')
+        since = datetime.fromisoformat(since) if since else None
+        limit = min(int(request.args.get('limit', 20)), MAX_CONDITIONS)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    filters = ['condition_key IS NOT NULL']
+    params = {'limit': limit}
+    if section != 'all':
+        filters.append('section = :section')
+        params['section'] = section
+    if request.args.get('kind'):
+        filters.append('kind = :kind')
+        params['kind'] = request.args['kind']
+    if since:
+        filters.append('created_at > :since')
+        params['since'] = since.strftime('%Y-%m-%d %H:%M:%S.%f')
+    
+    with span('condition_stats'):
+        rows = db.session.execute(text(
+            'SELECT condition_key, MIN(condition) AS condition, COUNT(*) AS mentions, '
+            'COUNT(DISTINCT session_id) AS sessions, AVG(percent) AS avg_percent, '
+            'MIN(percent) AS min_percent, MAX(percent) AS max_percent '
+            f"FROM response_rating WHERE {' AND '.join(filters)} "
+            'GROUP BY condition_key ORDER BY mentions DESC, condition_key LIMIT :limit'
+        ), params).fetchall()
+    
+    return jsonify({
+        'section': section,
+        'conditions': [
+            {
+                'condition': row.condition,
+                'key': row.condition_key,
+                'mentions': row.mentions,
+                'sessions': row.sessions,
+                'avg_percent': round(row.avg_percent, 1),
+                'min_percent': row.min_percent,
+                'max_percent': row.max_percent
+            }
+            for row in rows
+        ],
+        'backfill': rating_backfill.status()
+    })
+
+@app.route('/stats/conditions/backfill', methods=['POST'])
+def backfill_conditions():
+    """Re-parse ratings for every stored response in the background"""
+    started = rating_backfill.start()
+    return jsonify({'started': started, 'status': rating_backfill.status()}), 202 if started else 409
 
 @app.route('/health', methods=['GET'])
 def health_check():
-    """Health check endpoint"""
-    try:
-        # Check database connection
-        session_count = ChatSession.query.count()
-        response_count = ChatResponse.query.count()
-        
-        return jsonify({
-            'status': 'healthy', 
-            'timestamp': datetime.now().isoformat(),
-            'database': 'connected',
-            'sessions': session_count,
-            'responses': response_count
-        })
-    except Exception as e:
+    """Health check endpoint (readiness plus the cached row counts)"""
+    error = database_ready()
+    if error:
         return jsonify({
             'status': 'unhealthy',
             'timestamp': datetime.now().isoformat(),
-            'error': str(e)
+            'error': error
         }), 500
+    
+    counts = table_stats.snapshot()['counts'] or {}
+    return jsonify({
+        'status': 'healthy', 
+        'timestamp': datetime.now().isoformat(),
+        'database': 'connected',
+        'sessions': counts.get('sessions'),
+        'responses': counts.get('responses')
+    })
+
+def migrate_database():
+    """Create missing tables and apply pending migrations; run once per deployment, not per worker
+
+    Responses stored before the response_rating table existed are rated here
+    too, right after that migration is applied.
+    """
+    with app.app_context():
+        db.create_all()
+        applied = migrate(db.engine)
+    session_store.create_schema()
+    job_queue.create_schema()
+    assessment_cache.create_schema()
+    rate_limiter.buckets.create_schema()
+    if image_store:
+        image_store.create_schema()
+    if 3 in applied:
+        rating_backfill.run()
+    return applied
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Create the database tables and apply pending migrations"""
+    applied = migrate_database()
+    print(f"Applied migrations: {applied}" if applied else "Database is up to date")
+
+# Importing this module only defines the app, so a pre-fork server can load it once in the
+# master (see wsgi.py and gunicorn.conf.py). Each worker process then creates its own model
+# client, database connections and background threads in init_worker().
+_worker_lock = threading.Lock()
+_worker_pid = None
+_singleton_lock_file = None
+
+def claim_singleton_jobs():
+    """Whether this process runs the once-per-deployment jobs (the retention worker)
+
+    The first worker to take an exclusive lock on a file in the instance folder
+    keeps it until it exits; the worker that replaces it takes it over.
+    """
+    global _singleton_lock_file
+    if _singleton_lock_file is not None:
+        return True
+    try:
+        import fcntl
+    except ImportError:
+        # No pre-fork servers without fcntl (Windows), so this is the only process
+        return True
+    os.makedirs(app.instance_path, exist_ok=True)
+    lock_file = open(os.path.join(app.instance_path, 'background-jobs.lock'), 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _singleton_lock_file = lock_file
+    return True
+
+@app.before_request
+def init_worker():
+    """Set up this process's model client, connections and background threads, once per process
+
+    Called from gunicorn's post_fork hook, by create_app(), and before the first
+    request as a fallback for servers that do neither.
+    """
+    global _worker_pid
+    if _worker_pid == os.getpid():
+        return
+    with _worker_lock:
+        if _worker_pid == os.getpid():
+            return
+        with app.app_context():
+            # Pooled connections opened before fork() belong to the parent process
+            db.engine.dispose(close=False)
+        model.warm()
+        table_stats.start()
+        job_queue.start()
+        if claim_singleton_jobs():
+            retention_worker.start()
+        _worker_pid = os.getpid()
+
+def create_app():
+    """The app, ready to serve requests from this process"""
+    init_worker()
+    return app
 
 if __name__ == '__main__':
     # Make sure GEMINI_API_KEY environment variable is set
-    if not os.getenv('GEMINI_API_KEY'):
+    if os.getenv('LLM_BACKEND', 'gemini') == 'gemini' and not os.getenv('GEMINI_API_KEY'):
         print("WARNING: GEMINI_API_KEY environment variable not set!")
         print("Please set it with: export GEMINI_API_KEY='your-api-key-here'")
     
+    # Single process development server; see gunicorn.conf.py for the multi-worker setup.
+    # With the reloader only the child process serves requests, so only it sets up workers.
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        create_app()
+    else:
+        migrate_database()
     app.run(debug=True, host='0.0.0.0', port=8000)
\ No newline at end of file
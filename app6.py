@@ -1,47 +1,161 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
-import google.generativeai as genai
-import base64
-import io
-from PIL import Image
 import os
 from datetime import datetime
 import uuid
+import json
+from image_pipeline import ImageRejectedError, decode_image_payload, prepare_image, read_image_upload
+from werkzeug.exceptions import RequestEntityTooLarge
+from session_store import create_session_store, new_session
+from llm_backend import create_model
+from resilience import UpstreamError, create_resilient_model
+from http_cache import compressed, make_etag, not_modified
+from rate_limit import create_rate_limiter, rate_limited
+import metrics
+from metrics import record_size, span
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for React frontend
 
-# Configure Gemini API
-genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-model = genai.GenerativeModel('gemini-1.5-flash')
+# Reject oversized request bodies before they are parsed (base64 JSON images need the headroom)
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_CONTENT_LENGTH', 16 * 1024 * 1024))
 
-# In-memory storage for chat sessions (use Redis/Database in production)
-chat_sessions = {}
+# Deadlines, retries, optional hedging and a circuit breaker around every model call. The
+# Gemini client itself (or the LLM_BACKEND=fake stub) is only built on first use, since
+# importing the SDK takes about a second; init_worker() starts that in the background
+model = create_resilient_model(model_factory=create_model)
 
-class ChatSession:
-    def __init__(self, session_id):
-        self.session_id = session_id
-        self.chat_history = []
-        self.initial_assessment = None
-        self.baby_info = None
-        self.created_at = datetime.now()
+# Storage for chat sessions: bounded in-memory LRU by default, set SESSION_STORE=sqlite
+# (or tiered) to keep sessions in SESSION_DB_PATH instead. Memory is per process, so
+# multi-worker deployments need sqlite (gunicorn.conf.py defaults to it).
+os.makedirs(app.instance_path, exist_ok=True)
+session_db_path = os.getenv('SESSION_DB_PATH', os.path.join(app.instance_path, 'baby_health_data.db'))
+session_store = create_session_store(os.getenv('SESSION_STORE', 'memory'), session_db_path)
 
-def process_image(base64_string):
-    """Convert base64 image to PIL Image for Gemini API"""
-    try:
-        # Remove data URL prefix if present
-        if ',' in base64_string:
-            base64_string = base64_string.split(',')[1]
-        
-        # Decode base64 to bytes
-        image_data = base64.b64decode(base64_string)
-        
-        # Convert to PIL Image
-        image = Image.open(io.BytesIO(image_data))
-        return image
-    except Exception as e:
-        print(f"Error processing image: {e}")
-        return None
+# Token buckets per client IP and per session in front of the model (RATE_LIMIT_*);
+# RATE_LIMIT_BACKEND=sqlite shares them between worker processes
+rate_limiter = create_rate_limiter(session_db_path)
+
+# Request/stage timings on /metrics, plus Server-Timing when a request sends X-Debug-Timing: 1
+metrics_registry = metrics.init_app(app)
+model.register_metrics(metrics_registry)
+rate_limiter.register_metrics(metrics_registry)
+
+def read_submission():
+    """Read form fields and raw image bytes from a JSON, multipart or raw image request
+
+    Multipart and raw uploads are spooled by Werkzeug and read straight into bytes,
+    skipping the base64 string the JSON path has to carry and decode.
+    """
+    if request.mimetype == 'multipart/form-data':
+        data = request.form.to_dict()
+        data['location'] = request.form.getlist('location')
+        upload = request.files.get('image')
+        image_data = read_image_upload(upload.stream) if upload else None
+    elif request.mimetype.startswith('image/'):
+        # Raw image body, form fields in the query string
+        data = request.args.to_dict()
+        data['location'] = request.args.getlist('location')
+        image_data = read_image_upload(request.stream)
+    else:
+        data = request.get_json()
+        image_data = decode_image_payload(data['image']) if data.get('image') else None
+    return data, image_data
+
+def wants_stream(data):
+    """Check whether the client asked for a streamed (Server-Sent Events) response"""
+    if data.get('stream'):
+        return True
+    if request.args.get('stream', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return 'text/event-stream' in request.headers.get('Accept', '')
+
+def sse_event(event, payload):
+    """Format a single Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+def stream_model_response(model_input, on_complete, start_payload=None):
+    """Forward Gemini output to the client as it arrives, then store the full text"""
+    # Called before the response starts, so an open circuit is still answered with a 503
+    model_stream = model.generate_content(model_input, stream=True)
+    
+    def generate():
+        yield sse_event('start', start_payload or {})
+        chunks = []
+        try:
+            with span('llm_stream'):
+                for chunk in model_stream:
+                    if not chunk.text:
+                        continue
+                    chunks.append(chunk.text)
+                    yield sse_event('chunk', {'text': chunk.text})
+
+            # Store the complete response once the stream has finished
+            text = ''.join(chunks)
+            record_size('response', text)
+            done_payload = on_complete(text)
+            yield sse_event('done', done_payload)
+
+        except Exception as e:
+            print(f"Gemini API error while streaming: {e}")
+            yield sse_event('error', {'error': 'Failed to generate response', 'success': False})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def upstream_error_response(error):
+    """Build the response for a model call that timed out or failed after its retries"""
+    response = jsonify({'error': str(error), 'success': False})
+    response.status_code = error.status_code
+    if error.retry_after:
+        response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def save_assessment(chat_session, assessment_result):
+    """Store the initial assessment and session, returning the JSON payload for the client"""
+    chat_session['initial_assessment'] = assessment_result
+    
+    # Store session
+    with span('store'):
+        session_store.save_session(chat_session)
+        session_store.add_response(chat_session['session_id'], 'assessment', assessment_result)
+    
+    return {
+        'session_id': chat_session['session_id'],
+        'assessment': assessment_result,
+        'success': True
+    }
+
+def save_chat_response(chat_session, user_message, bot_response):
+    """Store a follow-up exchange in chat history, returning the JSON payload for the client"""
+    chat_session['last_activity'] = datetime.now()
+    with span('store'):
+        session_store.save_session(chat_session)
+        session_store.add_response(chat_session['session_id'], 'chat', bot_response, user_message)
+    
+    return {
+        'response': bot_response,
+        'success': True
+    }
+
+def generate_text(model_input):
+    """Run a blocking Gemini call and return its text"""
+    with span('llm'):
+        response = model.generate_content(model_input)
+    record_size('response', response.text)
+    return response.text
+
+def history_entry(response):
+    """JSON shape of one chat history entry"""
+    return {
+        'type': response['response_type'],
+        'user_message': response['user_message'],
+        'response': response['response_text'],
+        'timestamp': response['created_at'].isoformat()
+    }
 
 def create_baby_assessment_prompt(form_data):
     """Create a comprehensive prompt for baby health assessment"""
@@ -112,15 +226,64 @@ Keep your response clear, reassuring when appropriate, but always err on the sid
     
     return prompt
 
+def create_chat_prompt(chat_session, recent_history, user_message):
+    """Create the context-aware prompt for a follow-up question"""
+    context_prompt = f"""You are continuing a conversation about a baby's health. 
+
+IMPORTANT: When providing assessments or identifying conditions, always include accuracy/confidence ratings in brackets like [XX% match], [XX% confidence], or [XX% likely].
+
+PREVIOUS ASSESSMENT CONTEXT:
+{chat_session['initial_assessment']}
+
+BABY INFORMATION:
+"""
+    
+    baby_info = chat_session['baby_info']
+    for key, value in baby_info.items():
+        if value and key != 'hasImage':
+            context_prompt += f"• {key}: {value}\n"
+    
+    context_prompt += f"""
+CHAT HISTORY:
+"""
+    
+    # Add recent chat history
+    for exchange in recent_history:
+        if exchange['response_type'] == 'chat':
+            context_prompt += f"User: {exchange['user_message']}\n"
+            context_prompt += f"Assistant: {exchange['response_text']}\n"
+    
+    context_prompt += f"""
+CURRENT USER QUESTION: {user_message}
+
+Please respond to the user's question while maintaining context of the baby's condition and previous conversation. 
+Continue to emphasize that this is not medical advice and recommend consulting a pediatrician when appropriate.
+REMEMBER: Include accuracy/confidence ratings in brackets [XX%] for any medical assessments or condition identifications.
+
+EXAMPLES:
+- "That symptom could indicate teething [75% likely]"
+- "The described behavior is typical for this age [88% normal]"
+- "This might be a growth spurt [70% confidence]"
+"""
+    
+    return context_prompt
+
 @app.route('/submit-assessment', methods=['POST'])
+@rate_limited(rate_limiter)
 def submit_assessment():
     """Handle initial baby health assessment submission"""
     try:
-        data = request.get_json()
+        try:
+            with span('read_submission'):
+                data, image_data = read_submission()
+        except (ImageRejectedError, RequestEntityTooLarge) as e:
+            return jsonify({'error': str(e)}), 413
+        
+        if data.get('image') and image_data is None:
+            return jsonify({'error': 'Failed to process image'}), 400
         
         # Create new chat session
         session_id = str(uuid.uuid4())
-        chat_session = ChatSession(session_id)
         
         # Store baby information
         baby_info = {
@@ -131,48 +294,42 @@ def submit_assessment():
             'durationText': data.get('durationText', ''),
             'temperatureText': data.get('temperatureText', ''),
             'extraNotes': data.get('extraNotes', ''),
-            'hasImage': bool(data.get('image'))
+            'hasImage': image_data is not None
         }
         
-        chat_session.baby_info = baby_info
+        chat_session = new_session(session_id, baby_info)
         
         # Create assessment prompt
-        prompt = create_baby_assessment_prompt(baby_info)
+        with span('prompt'):
+            prompt = create_baby_assessment_prompt(baby_info)
         
-        # Process image if provided
-        image = None
-        if data.get('image'):
-            image = process_image(data['image'])
+        # Downscale and re-encode the image if provided
+        model_input = prompt
+        if image_data:
+            with span('image_prepare'):
+                image = prepare_image(image_data)
             if image is None:
                 return jsonify({'error': 'Failed to process image'}), 400
+            record_size('image', image.data)
+            model_input = [prompt, image.as_model_part()]
+        record_size('prompt', prompt)
         
         # Generate response from Gemini
         try:
-            if image:
-                response = model.generate_content([prompt, image])
-            else:
-                response = model.generate_content(prompt)
+            # Stream partial text back as it is generated if requested
+            if wants_stream(data):
+                return stream_model_response(
+                    model_input,
+                    lambda text: save_assessment(chat_session, text),
+                    start_payload={'session_id': session_id}
+                )
             
-            assessment_result = response.text
+            assessment_result = generate_text(model_input)
             
-            # Store initial assessment and conversation
-            chat_session.initial_assessment = assessment_result
-            chat_session.chat_history.append({
-                'type': 'assessment',
-                'prompt': prompt,
-                'response': assessment_result,
-                'timestamp': datetime.now().isoformat()
-            })
-            
-            # Store session
-            chat_sessions[session_id] = chat_session
-            
-            return jsonify({
-                'session_id': session_id,
-                'assessment': assessment_result,
-                'success': True
-            })
+            return jsonify(save_assessment(chat_session, assessment_result))
             
+        except UpstreamError as e:
+            return upstream_error_response(e)
         except Exception as e:
             print(f"Gemini API error: {e}")
             return jsonify({'error': 'Failed to generate assessment'}), 500
@@ -182,6 +339,7 @@ def submit_assessment():
         return jsonify({'error': 'Internal server error'}), 500
 
 @app.route('/chat', methods=['POST'])
+@rate_limited(rate_limiter)
 def chat():
     """Handle follow-up chat messages"""
     try:
@@ -193,69 +351,36 @@ def chat():
             return jsonify({'error': 'Missing session_id or message'}), 400
         
         # Get chat session
-        if session_id not in chat_sessions:
+        with span('session_lookup'):
+            chat_session = session_store.get_session(session_id)
+        if not chat_session:
             return jsonify({'error': 'Invalid session_id'}), 404
         
-        chat_session = chat_sessions[session_id]
-        
-        # Create context-aware prompt for follow-up questions
-        context_prompt = f"""You are continuing a conversation about a baby's health. 
-
-IMPORTANT: When providing assessments or identifying conditions, always include accuracy/confidence ratings in brackets like [XX% match], [XX% confidence], or [XX% likely].
-
-PREVIOUS ASSESSMENT CONTEXT:
-{chat_session.initial_assessment}
-
-BABY INFORMATION:
-"""
-        
-        baby_info = chat_session.baby_info
-        for key, value in baby_info.items():
-            if value and key != 'hasImage':
-                context_prompt += f"• {key}: {value}\n"
-        
-        context_prompt += f"""
-CHAT HISTORY:
-"""
-        
         # Add recent chat history (last 5 exchanges)
-        recent_history = chat_session.chat_history[-5:]
-        for exchange in recent_history:
-            if exchange['type'] == 'chat':
-                context_prompt += f"User: {exchange['user_message']}\n"
-                context_prompt += f"Assistant: {exchange['response']}\n"
+        with span('history'):
+            recent_history = session_store.recent_responses(session_id, 5)
         
-        context_prompt += f"""
-CURRENT USER QUESTION: {user_message}
-
-Please respond to the user's question while maintaining context of the baby's condition and previous conversation. 
-Continue to emphasize that this is not medical advice and recommend consulting a pediatrician when appropriate.
-REMEMBER: Include accuracy/confidence ratings in brackets [XX%] for any medical assessments or condition identifications.
-
-EXAMPLES:
-- "That symptom could indicate teething [75% likely]"
-- "The described behavior is typical for this age [88% normal]"
-- "This might be a growth spurt [70% confidence]"
-"""
+        # Create context-aware prompt for follow-up questions
+        with span('prompt'):
+            context_prompt = create_chat_prompt(chat_session, recent_history, user_message)
+        record_size('prompt', context_prompt)
         
         # Generate response
         try:
-            response = model.generate_content(context_prompt)
-            bot_response = response.text
+            # Stream partial text back as it is generated if requested
+            if wants_stream(data):
+                return stream_model_response(
+                    context_prompt,
+                    lambda text: save_chat_response(chat_session, user_message, text),
+                    start_payload={'session_id': session_id}
+                )
             
-            # Store in chat history
-            chat_session.chat_history.append({
-                'type': 'chat',
-                'user_message': user_message,
-                'response': bot_response,
-                'timestamp': datetime.now().isoformat()
-            })
+            bot_response = generate_text(context_prompt)
             
-            return jsonify({
-                'response': bot_response,
-                'success': True
-            })
+            return jsonify(save_chat_response(chat_session, user_message, bot_response))
             
+        except UpstreamError as e:
+            return upstream_error_response(e)
         except Exception as e:
             print(f"Gemini API error in chat: {e}")
             return jsonify({'error': 'Failed to generate response'}), 500
@@ -265,30 +390,86 @@ EXAMPLES:
         return jsonify({'error': 'Internal server error'}), 500
 
 @app.route('/get-session/<session_id>', methods=['GET'])
+@compressed
 def get_session(session_id):
-    """Get session information and chat history"""
-    if session_id not in chat_sessions:
+    """Get session information and chat history, or a 304 if the client's ETag is current"""
+    chat_session = session_store.get_session(session_id)
+    if not chat_session:
         return jsonify({'error': 'Session not found'}), 404
     
-    chat_session = chat_sessions[session_id]
+    # Only the response count and newest response time, so an unchanged poll doesn't load the history
+    etag = make_etag(session_id, chat_session['last_activity'], *session_store.history_version(session_id))
+    unchanged = not_modified(etag)
+    if unchanged:
+        return unchanged
     
-    return jsonify({
+    responses = session_store.recent_responses(session_id)
+    response = jsonify({
         'session_id': session_id,
-        'initial_assessment': chat_session.initial_assessment,
-        'baby_info': chat_session.baby_info,
-        'chat_history': chat_session.chat_history,
-        'created_at': chat_session.created_at.isoformat()
+        'initial_assessment': chat_session['initial_assessment'],
+        'baby_info': chat_session['baby_info'],
+        'chat_history': [history_entry(r) for r in responses],
+        'created_at': chat_session['created_at'].isoformat()
     })
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/session-store-stats', methods=['GET'])
+def session_store_stats():
+    """Session store size, hit/miss and flush counters"""
+    return jsonify(session_store.stats())
+
+@app.route('/rate-limit-stats', methods=['GET'])
+def rate_limit_stats():
+    """Rate limiter settings, bucket count and allowed/limited counters"""
+    return jsonify(rate_limiter.status())
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
     return jsonify({'status': 'healthy', 'timestamp': datetime.now().isoformat()})
 
+def migrate_database():
+    """Create the session and rate limit tables when they are kept in SQLite; run once per deployment"""
+    session_store.create_schema()
+    rate_limiter.buckets.create_schema()
+    return []
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Create the session tables"""
+    migrate_database()
+    print("Database is up to date")
+
+# Importing this module only defines the app, so a pre-fork server can load it once in the
+# master; each worker creates its own model client in init_worker() (see wsgi.py)
+_worker_pid = None
+
+@app.before_request
+def init_worker():
+    """Start building this process's model client in the background, once per process
+
+    Called from gunicorn's post_fork hook, by create_app(), and before the first
+    request as a fallback for servers that do neither.
+    """
+    global _worker_pid
+    if _worker_pid == os.getpid():
+        return
+    model.warm()
+    _worker_pid = os.getpid()
+
+def create_app():
+    """The app, ready to serve requests from this process"""
+    init_worker()
+    return app
+
 if __name__ == '__main__':
     # Make sure GEMINI_API_KEY environment variable is set
-    if not os.getenv('GEMINI_API_KEY'):
+    if os.getenv('LLM_BACKEND', 'gemini') == 'gemini' and not os.getenv('GEMINI_API_KEY'):
         print("WARNING: GEMINI_API_KEY environment variable not set!")
         print("Please set it with: export GEMINI_API_KEY='your-api-key-here'")
     
-    app.run(debug=True, host='0.0.0.0', port=8000)
\ No newline at end of file
+    # Single process development server; see gunicorn.conf.py for the multi-worker setup
+    migrate_database()
+    create_app().run(debug=True, host='0.0.0.0', port=8000)
\ No newline at end of file
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from database import thread_connection
+
+
+def normalize_form_data(form_data):
+    """Canonicalize form fields so equivalent submissions hash the same"""
+    normalized = {}
+    for key, value in (form_data or {}).items():
+        if key == 'hasImage':
+            continue
+        if isinstance(value, str):
+            value = ' '.join(value.split()).lower()
+        elif isinstance(value, (list, tuple)):
+            value = sorted(' '.join(str(item).split()).lower() for item in value if item)
+        if value in ('', [], None):
+            continue
+        normalized[key] = value
+    return normalized
+
+
+def make_cache_key(form_data, prompt, image_digest=None):
+    """Hash the normalized form, the generated prompt and the image digest into a cache key"""
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps(normalize_form_data(form_data), sort_keys=True).encode('utf-8'))
+    hasher.update(b'\0')
+    hasher.update(prompt.encode('utf-8'))
+    hasher.update(b'\0')
+    if image_digest:
+        hasher.update(image_digest.encode('ascii'))
+    return hasher.hexdigest()
+
+
+class AssessmentCache:
+    """Content-addressed cache of model assessments
+
+    Lookups go to a bounded in-process LRU first and then, if a database path
+    is configured, to a SQLite table shared between processes. Entries in both
+    tiers expire after `ttl` seconds.
+    """
+
+    def __init__(self, max_entries=256, ttl=3600, db_path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (stored_at, response_text)
+        self._lock = threading.Lock()
+        self.stats = {
+            'memory_hits': 0,
+            'sqlite_hits': 0,
+            'misses': 0,
+            'bypassed': 0,
+            'stores': 0,
+            'evictions': 0
+        }
+
+        self.db_path = db_path
+        self._local = threading.local()
+
+    def create_schema(self):
+        """Create the shared-tier table when a database path is configured"""
+        if not self.db_path:
+            return
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS assessment_cache ('
+            'key TEXT PRIMARY KEY, response_text TEXT NOT NULL, stored_at REAL NOT NULL)'
+        )
+
+    def _connection(self):
+        return thread_connection(self._local, self.db_path)
+
+    def get(self, key):
+        """Return the cached response for key, or None on a miss"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                return entry[1]
+            if entry:
+                del self._entries[key]
+
+        # Each thread has its own connection, so the shared tier is read outside the lock
+        if self.db_path:
+            connection = self._connection()
+            row = connection.execute(
+                'SELECT response_text, stored_at FROM assessment_cache WHERE key = ?', (key,)
+            ).fetchone()
+            if row and now - row[1] < self.ttl:
+                with self._lock:
+                    self._store_in_memory(key, row[1], row[0])
+                    self.stats['sqlite_hits'] += 1
+                return row[0]
+            if row:
+                connection.execute('DELETE FROM assessment_cache WHERE key = ? AND stored_at = ?', (key, row[1]))
+
+        with self._lock:
+            self.stats['misses'] += 1
+        return None
+
+    def set(self, key, response_text):
+        """Store a response in every configured tier"""
+        now = time.time()
+        with self._lock:
+            self._store_in_memory(key, now, response_text)
+            self.stats['stores'] += 1
+        if self.db_path:
+            self._connection().execute(
+                'INSERT OR REPLACE INTO assessment_cache (key, response_text, stored_at) VALUES (?, ?, ?)',
+                (key, response_text, now)
+            )
+
+    def record_bypass(self):
+        """Count a request that explicitly skipped the cache lookup"""
+        with self._lock:
+            self.stats['bypassed'] += 1
+
+    def _store_in_memory(self, key, stored_at, response_text):
+        self._entries[key] = (stored_at, response_text)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def snapshot(self):
+        """Return cache counters and current size"""
+        with self._lock:
+            lookups = self.stats['memory_hits'] + self.stats['sqlite_hits'] + self.stats['misses']
+            hits = self.stats['memory_hits'] + self.stats['sqlite_hits']
+            return dict(
+                self.stats,
+                entries=len(self._entries),
+                hit_ratio=round(hits / lookups, 3) if lookups else 0.0,
+                sqlite_enabled=bool(self.db_path)
+            )
@@ -0,0 +1,139 @@
+"""Benchmark the hot ChatSession/ChatResponse queries as the tables grow
+
+Builds a scratch SQLite database with the same schema app5.py uses, fills it
+to each target size and times the session lookup, the history query and the
+retention scan, first without the indexes from database.MIGRATIONS and then
+with them.
+
+    python bench_db.py --sizes 10000,100000,1000000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from database import MIGRATIONS, SQLITE_SCHEMA, apply_sqlite_pragmas
+
+# The queries app5.py issues through the ORM
+QUERIES = {
+    'session lookup': 'SELECT * FROM chat_session WHERE session_id = ? LIMIT 1',
+    'session history': 'SELECT * FROM chat_response WHERE session_id = ? ORDER BY created_at',
+    'recent context': 'SELECT * FROM chat_response WHERE session_id = ? ORDER BY created_at DESC LIMIT 5',
+    'retention scan': 'SELECT session_id FROM chat_session WHERE last_activity < ? LIMIT 500',
+}
+
+# Index statements from the schema migrations, with the index names they create
+INDEXES = [
+    (statement.split()[5], statement)
+    for statements in MIGRATIONS for statement in statements
+    if statement.startswith('CREATE INDEX IF NOT EXISTS')
+]
+
+RESPONSES_PER_SESSION = 10
+RESPONSE_TEXT = 'Possible diaper rash [75% likely]. ' * 20
+
+
+def fill(connection, total_responses, existing_responses):
+    """Grow the tables until chat_response holds total_responses rows"""
+    now = datetime.now()
+    new_sessions = (total_responses - existing_responses) // RESPONSES_PER_SESSION
+    session_ids = []
+    sessions, responses = [], []
+    for _ in range(new_sessions):
+        session_id = str(uuid.uuid4())
+        session_ids.append(session_id)
+        # Spread activity over the last 30 days
+        last_activity = now - timedelta(minutes=random.randint(0, 30 * 24 * 60))
+        sessions.append((session_id, last_activity, last_activity, RESPONSE_TEXT, '{}'))
+        for i in range(RESPONSES_PER_SESSION):
+            created_at = last_activity - timedelta(minutes=RESPONSES_PER_SESSION - i)
+            responses.append((session_id, RESPONSE_TEXT, 'question?', 'chat', created_at))
+
+        if len(responses) >= 50000:
+            insert(connection, sessions, responses)
+            sessions, responses = [], []
+    insert(connection, sessions, responses)
+    return session_ids
+
+
+def insert(connection, sessions, responses):
+    connection.executemany(
+        'INSERT INTO chat_session (session_id, created_at, last_activity, initial_assessment, baby_info) '
+        'VALUES (?, ?, ?, ?, ?)', sessions)
+    # Interleave insert order so a session's rows are not stored next to each other
+    random.shuffle(responses)
+    connection.executemany(
+        'INSERT INTO chat_response (session_id, response_text, user_message, response_type, created_at) '
+        'VALUES (?, ?, ?, ?, ?)', responses)
+    connection.commit()
+
+
+def time_queries(connection, session_ids, repeats):
+    """Median latency in milliseconds for each hot query"""
+    # Steady state for the retention worker: only sessions that expired since its last run match
+    cutoff = datetime.now() - timedelta(days=29, hours=23)
+    results = {}
+    for name, sql in QUERIES.items():
+        samples = []
+        for _ in range(repeats):
+            params = (cutoff,) if name == 'retention scan' else (random.choice(session_ids),)
+            start = time.perf_counter()
+            connection.execute(sql, params).fetchall()
+            samples.append((time.perf_counter() - start) * 1000)
+        results[name] = statistics.median(samples)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='10000,100000,1000000',
+                        help='Comma separated chat_response row counts')
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--keep', action='store_true', help='Keep the scratch database')
+    args = parser.parse_args()
+    sizes = sorted(int(size) for size in args.sizes.split(','))
+
+    sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+    random.seed(0)
+    path = os.path.join(tempfile.mkdtemp(prefix='bench_db_'), 'bench.db')
+    connection = sqlite3.connect(path)
+    apply_sqlite_pragmas(connection)
+    for statement in SQLITE_SCHEMA:
+        connection.execute(statement)
+
+    print(f"{'rows':>10}  {'query':<16}{'no index (ms)':>15}{'indexed (ms)':>15}{'speedup':>10}")
+    session_ids, rows = [], 0
+    for size in sizes:
+        session_ids += fill(connection, size, rows)
+        rows = size
+
+        # Time without the migration indexes, then with them
+        for index_name, _ in INDEXES:
+            connection.execute(f'DROP INDEX IF EXISTS {index_name}')
+        connection.execute('ANALYZE')
+        before = time_queries(connection, session_ids, args.repeats)
+
+        for _, statement in INDEXES:
+            connection.execute(statement)
+        connection.execute('ANALYZE')
+        after = time_queries(connection, session_ids, args.repeats)
+
+        for name in QUERIES:
+            speedup = before[name] / after[name] if after[name] else float('inf')
+            print(f"{size:>10}  {name:<16}{before[name]:>15.3f}{after[name]:>15.3f}{speedup:>9.1f}x")
+
+    connection.close()
+    print(f"Database size: {os.path.getsize(path) / 1024 / 1024:.1f} MB at {path}")
+    if not args.keep:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+if __name__ == '__main__':
+    main()
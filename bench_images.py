@@ -0,0 +1,104 @@
+"""Micro-benchmark for the image ingestion pipeline
+
+Compares what /submit-assessment used to send to the model (the full-size
+upload opened with PIL) against the downscaled, re-encoded copy produced by
+image_pipeline, and reports bytes and milliseconds saved per image.
+
+    python bench_images.py --width 4000 --height 3000 --runs 5
+"""
+import argparse
+import base64
+import io
+import random
+import statistics
+import time
+
+from PIL import Image
+
+from image_pipeline import decode_image_payload, prepare_image
+
+
+def make_phone_photo(width, height, quality=92):
+    """Build a noisy JPEG with EXIF, roughly what a phone camera uploads"""
+    random.seed(0)
+    tile = Image.effect_noise((256, 256), 60).convert('RGB')
+    image = Image.new('RGB', (width, height))
+    for x in range(0, width, 256):
+        for y in range(0, height, 256):
+            image.paste(tile, (x, y))
+    gradient = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    image = Image.blend(image, gradient, 0.5)
+
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Orientation: rotated 90 degrees
+    exif[0x010F] = 'BenchPhone'  # Make
+
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=quality, exif=exif)
+    return output.getvalue()
+
+
+def time_ms(fn):
+    start = time.perf_counter()
+    result = fn()
+    return (time.perf_counter() - start) * 1000, result
+
+
+def baseline(payload):
+    """Old process_image(): decode everything, then let the SDK upload the full image"""
+    raw = base64.b64decode(payload.split(',', 1)[1])
+    image = Image.open(io.BytesIO(raw))
+    image.load()
+    return raw
+
+
+def pipeline(payload, max_edge, image_format, quality):
+    raw = decode_image_payload(payload, max_bytes=len(payload))
+    return prepare_image(raw, max_edge=max_edge, image_format=image_format, quality=quality)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--width', type=int, default=4000)
+    parser.add_argument('--height', type=int, default=3000)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-edge', type=int, default=1024)
+    parser.add_argument('--format', default='JPEG', choices=['JPEG', 'WEBP'])
+    parser.add_argument('--quality', type=int, default=85)
+    parser.add_argument('--uplink-mbps', type=float, default=20.0,
+                        help='Bandwidth to the model API, used to estimate upload time')
+    args = parser.parse_args()
+
+    photo = make_phone_photo(args.width, args.height)
+    payload = 'data:image/jpeg;base64,' + base64.b64encode(photo).decode('ascii')
+    print(f"Input: {args.width}x{args.height} JPEG, {len(photo) / 1024:.0f} KiB "
+          f"({len(payload) / 1024:.0f} KiB as base64)")
+
+    baseline_times, pipeline_times = [], []
+    for _ in range(args.runs):
+        elapsed, original = time_ms(lambda: baseline(payload))
+        baseline_times.append(elapsed)
+        elapsed, prepared = time_ms(lambda: pipeline(payload, args.max_edge, args.format, args.quality))
+        pipeline_times.append(elapsed)
+
+    def upload_ms(size):
+        return size * 8 / (args.uplink_mbps * 1_000_000) * 1000
+
+    baseline_ms = statistics.median(baseline_times)
+    pipeline_ms = statistics.median(pipeline_times)
+    saved_bytes = len(original) - len(prepared.data)
+    total_baseline = baseline_ms + upload_ms(len(original))
+    total_pipeline = pipeline_ms + upload_ms(len(prepared.data))
+
+    print(f"Output: {prepared.width}x{prepared.height} {args.format}, {len(prepared.data) / 1024:.0f} KiB")
+    print(f"{'':24}{'baseline':>12}{'pipeline':>12}")
+    print(f"{'bytes sent to model':24}{len(original):>12}{len(prepared.data):>12}")
+    print(f"{'processing (ms, p50)':24}{baseline_ms:>12.1f}{pipeline_ms:>12.1f}")
+    print(f"{'upload @ %.0f Mbps (ms)' % args.uplink_mbps:24}"
+          f"{upload_ms(len(original)):>12.1f}{upload_ms(len(prepared.data)):>12.1f}")
+    print(f"Saved per image: {saved_bytes} bytes ({saved_bytes / len(original):.0%}), "
+          f"{total_baseline - total_pipeline:.1f} ms end to end")
+
+
+if __name__ == '__main__':
+    main()
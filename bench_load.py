@@ -0,0 +1,235 @@
+"""Offline load test for app5.py against the fake LLM backend
+
+Starts the app in a subprocess with LLM_BACKEND=fake and a scratch database,
+then runs virtual users at each concurrency level. Each user submits an
+assessment, asks a few follow-up questions and reads the session back, in a
+loop. Reports throughput, p50/p95/p99 latency per endpoint, errors and how
+much the database grew.
+
+    python bench_load.py --concurrency 1,8,32 --duration 20 --latency-ms 800
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+QUESTIONS = [
+    'Is this normal for her age?',
+    'Should I be worried about the redness spreading?',
+    'How often should I change diapers?',
+    'Can I keep breastfeeding while this heals?',
+    'When should I call the pediatrician?',
+]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of an unsorted list"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def random_submission(rng):
+    """Form data shaped like what App1.tsx sends, varied so the assessment cache rarely hits"""
+    return {
+        'location': rng.sample(['head', 'torso', 'arms', 'legs', 'diaper area'], rng.randint(1, 2)),
+        'feedingType': rng.choice(['breast', 'formula', 'mixed']),
+        'stoolColor': rng.choice(['yellow', 'green', 'brown', '']),
+        'numberText': str(rng.randint(0, 24)),
+        'durationText': f'{rng.randint(1, 14)} days',
+        'temperatureText': f'{rng.uniform(36.4, 38.8):.1f}',
+        'extraNotes': f'Parent note {rng.randint(0, 10 ** 6)}'
+    }
+
+
+class Client:
+    """Minimal JSON client that records latency per operation"""
+
+    def __init__(self, base_url, results, lock, timeout):
+        self.base_url = base_url
+        self.results = results
+        self.lock = lock
+        self.timeout = timeout
+
+    def call(self, op, method, path, payload=None):
+        body = json.dumps(payload).encode('utf-8') if payload is not None else None
+        req = urllib.request.Request(self.base_url + path, data=body, method=method,
+                                     headers={'Content-Type': 'application/json'})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                status, data = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, data = e.code, e.read()
+        except Exception:
+            status, data = 0, b''
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.results.setdefault(op, []).append((elapsed, status))
+        try:
+            return status, json.loads(data)
+        except ValueError:
+            return status, None
+
+
+def virtual_user(client, rng, chats_per_session, stop_at):
+    """Replay submit -> chat x N -> get-session until the level's time is up"""
+    while time.monotonic() < stop_at:
+        status, body = client.call('submit-assessment', 'POST', '/submit-assessment', random_submission(rng))
+        if status != 200 or not body:
+            continue
+        session_id = body['session_id']
+        for _ in range(chats_per_session):
+            if time.monotonic() >= stop_at:
+                return
+            client.call('chat', 'POST', '/chat', {'session_id': session_id, 'message': rng.choice(QUESTIONS)})
+        client.call('get-session', 'GET', f'/get-session/{session_id}')
+
+
+def database_size(path):
+    """Bytes on disk for the database and its WAL, plus row counts"""
+    size = sum(os.path.getsize(path + suffix) for suffix in ('', '-wal') if os.path.exists(path + suffix))
+    connection = sqlite3.connect(path)
+    try:
+        sessions = connection.execute('SELECT COUNT(*) FROM chat_session').fetchone()[0]
+        responses = connection.execute('SELECT COUNT(*) FROM chat_response').fetchone()[0]
+    finally:
+        connection.close()
+    return size, sessions, responses
+
+
+def start_server(args, db_path, port):
+    env = dict(
+        os.environ,
+        LLM_BACKEND='fake',
+        FAKE_LLM_LATENCY_MS=str(args.latency_ms),
+        FAKE_LLM_LATENCY_SIGMA=str(args.latency_sigma),
+        FAKE_LLM_FAILURE_RATE=str(args.failure_rate),
+        DATABASE_URL=f'sqlite:///{db_path}',
+        RETENTION_INTERVAL_SECONDS=str(24 * 3600),
+        # Every virtual user shares one IP; measure the server, not the rate limiter
+        RATE_LIMIT_ENABLED='0',
+    )
+    code = (f"import app5; app5.migrate_database(); "
+            f"app5.create_app().run(host='127.0.0.1', port={port}, threaded=True)")
+    server = subprocess.Popen([sys.executable, '-c', code], env=env,
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.DEVNULL if not args.verbose else None,
+                              stderr=subprocess.DEVNULL if not args.verbose else None)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('Server exited during startup, rerun with --verbose')
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/health', timeout=1).read()
+            return server
+        except Exception:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('Server did not become healthy within 30 seconds')
+
+
+def run_level(base_url, concurrency, args):
+    results, lock = {}, threading.Lock()
+    stop_at = time.monotonic() + args.duration
+    threads = []
+    for i in range(concurrency):
+        client = Client(base_url, results, lock, timeout=args.timeout)
+        rng = random.Random(args.seed * 1000 + concurrency * 100 + i)
+        thread = threading.Thread(target=virtual_user, args=(client, rng, args.chats, stop_at), daemon=True)
+        threads.append(thread)
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', default='1,4,16,32', help='Comma separated virtual user counts')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds per concurrency level')
+    parser.add_argument('--chats', type=int, default=3, help='Follow-up questions per session')
+    parser.add_argument('--latency-ms', type=float, default=800, help='Median fake model latency')
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help='Log-normal spread of the latency')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Share of model calls that fail')
+    parser.add_argument('--timeout', type=float, default=120, help='Client timeout per request')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='Also write the results to this file')
+    parser.add_argument('--keep', action='store_true', help='Keep the scratch database')
+    parser.add_argument('--verbose', action='store_true', help='Show the server output')
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix='bench_load_'), 'bench.db')
+    port = free_port()
+    server = start_server(args, db_path, port)
+    base_url = f'http://127.0.0.1:{port}'
+
+    report = []
+    print(f"{'users':>6}  {'endpoint':<18}{'requests':>9}{'errors':>8}{'req/s':>9}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    try:
+        size_before, _, _ = database_size(db_path)
+        for concurrency in sorted(int(level) for level in args.concurrency.split(',')):
+            results, elapsed = run_level(base_url, concurrency, args)
+            size_after, sessions, responses = database_size(db_path)
+
+            level = {'concurrency': concurrency, 'seconds': round(elapsed, 2), 'endpoints': {}}
+            total = 0
+            for op, samples in sorted(results.items()):
+                latencies = [latency * 1000 for latency, _ in samples]
+                errors = sum(1 for _, status in samples if status != 200)
+                stats = {
+                    'requests': len(samples),
+                    'errors': errors,
+                    'throughput': round(len(samples) / elapsed, 2),
+                    'p50_ms': round(percentile(latencies, 50), 1),
+                    'p95_ms': round(percentile(latencies, 95), 1),
+                    'p99_ms': round(percentile(latencies, 99), 1)
+                }
+                level['endpoints'][op] = stats
+                total += len(samples)
+                print(f"{concurrency:>6}  {op:<18}{stats['requests']:>9}{errors:>8}{stats['throughput']:>9.1f}"
+                      f"{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}{stats['p99_ms']:>9.1f}")
+
+            level['throughput'] = round(total / elapsed, 2)
+            level['db_growth_bytes'] = size_after - size_before
+            level['db_sessions'], level['db_responses'] = sessions, responses
+            print(f"{concurrency:>6}  {'total':<18}{total:>9}{'':>8}{level['throughput']:>9.1f}  "
+                  f"db +{level['db_growth_bytes'] / 1024:.0f} KB, {sessions} sessions, {responses} responses")
+            size_before = size_after
+            report.append(level)
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(f"Database size (with WAL): {database_size(db_path)[0] / 1024 / 1024:.1f} MB at {db_path}")
+    if not args.keep:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""Per-request overhead of the token-bucket rate limiter, in microseconds
+
+Times RateLimiter.check() directly for the in-process and the SQLite
+backend (one thread, then several threads sharing the limiter), then the
+whole cost the rate_limited decorator adds to a trivial Flask view: taking
+the keys from the request, the check, the Server-Timing span and the
+response headers. Limits are set high enough that every request is
+allowed, so only the bookkeeping is measured.
+
+    python bench_ratelimit.py --requests 20000 --clients 1000 --threads 4
+"""
+import argparse
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+
+from flask import Flask, jsonify, request
+
+from bench_load import percentile
+from rate_limit import MemoryBuckets, RateLimit, RateLimiter, SQLiteBuckets, rate_limited
+
+
+def make_limiter(backend, db_path):
+    buckets = MemoryBuckets() if backend == 'memory' else SQLiteBuckets(db_path)
+    buckets.create_schema()
+    # Never empty, so every request takes the allow path
+    return RateLimiter(buckets, RateLimit('ip', 10 ** 9, 10 ** 9), RateLimit('session', 10 ** 9, 10 ** 9))
+
+
+def time_checks(limiter, keys, requests, rng):
+    """Microseconds per check() call"""
+    samples = []
+    for _ in range(requests):
+        ip, session_id = rng.choice(keys)
+        start = time.perf_counter()
+        limiter.check(ip, session_id)
+        samples.append((time.perf_counter() - start) * 1e6)
+    return samples
+
+
+def time_threaded(limiter, keys, requests, threads, seed):
+    """Microseconds per check() with `threads` threads calling at once, and checks per second overall"""
+    results = []
+    lock = threading.Lock()
+
+    def worker(index):
+        samples = time_checks(limiter, keys, requests // threads, random.Random(seed + index))
+        with lock:
+            results.extend(samples)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return results, len(results) / (time.perf_counter() - start)
+
+
+def time_decorator(limiter, keys, requests, rng):
+    """Microseconds per call of a trivial view, bare and wrapped in rate_limited, inside a request context
+
+    Both are called in the same request context, one after the other, so
+    request setup and machine noise affect both alike.
+    """
+    app = Flask(__name__)
+
+    def view():
+        # Like /chat, the view reads the JSON body; Flask parses it once for both
+        return jsonify({'session_id': request.get_json()['session_id']})
+    limited_view = rate_limited(limiter)(view)
+
+    bare, limited = [], []
+    for _ in range(requests):
+        ip, session_id = rng.choice(keys)
+        with app.test_request_context('/chat', method='POST', json={'session_id': session_id},
+                                      environ_base={'REMOTE_ADDR': ip}):
+            start = time.perf_counter()
+            view()
+            middle = time.perf_counter()
+            response = limited_view()
+            end = time.perf_counter()
+        if response.status_code != 200:
+            raise RuntimeError(f'Unexpected status {response.status_code}')
+        bare.append((middle - start) * 1e6)
+        limited.append((end - middle) * 1e6)
+    return bare, limited
+
+
+def summary(samples):
+    return statistics.fmean(samples), percentile(samples, 50), percentile(samples, 99)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=20000, help='Checks per measurement')
+    parser.add_argument('--clients', type=int, default=1000, help='Distinct IP/session pairs')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    keys = [(f'10.0.{i // 256}.{i % 256}', f'session-{i}') for i in range(args.clients)]
+    scratch = tempfile.mkdtemp(prefix='bench_ratelimit_')
+    try:
+        print(f"{args.requests} requests over {args.clients} clients, microseconds per request")
+        print(f"{'measurement':<34}{'mean':>9}{'p50':>9}{'p99':>9}{'checks/s':>11}")
+        for backend in ('memory', 'sqlite'):
+            limiter = make_limiter(backend, os.path.join(scratch, f'{backend}.db'))
+            time_checks(limiter, keys, min(2000, args.requests), random.Random(args.seed))  # warm up
+            samples = time_checks(limiter, keys, args.requests, random.Random(args.seed))
+            mean, p50, p99 = summary(samples)
+            print(f"{backend + ' check()':<34}{mean:>9.1f}{p50:>9.1f}{p99:>9.1f}{1e6 / mean:>11.0f}")
+            samples, rate = time_threaded(limiter, keys, args.requests, args.threads, args.seed)
+            mean, p50, p99 = summary(samples)
+            label = f'{backend} check(), {args.threads} threads'
+            print(f"{label:<34}{mean:>9.1f}{p50:>9.1f}{p99:>9.1f}{rate:>11.0f}")
+
+        for backend in ('memory', 'sqlite'):
+            limiter = make_limiter(backend, os.path.join(scratch, f'{backend}-view.db'))
+            bare, limited = time_decorator(limiter, keys, args.requests, random.Random(args.seed))
+            overhead = [with_limit - without for without, with_limit in zip(bare, limited)]
+            mean, p50, p99 = summary(overhead)
+            label = f'{backend} rate_limited overhead'
+            print(f"{label:<34}{mean:>9.1f}{p50:>9.1f}{p99:>9.1f}   (view alone {percentile(bare, 50):.1f} at p50)")
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
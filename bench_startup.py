@@ -0,0 +1,151 @@
+"""Startup time of app5.py/app6.py, from a cold interpreter to the first request
+
+Each run uses a fresh Python process and a scratch database. The phases run
+is timed in-process: importing the app, migrate_database(), create_app(),
+the first request through the test client, and how long after the start
+the model client (built lazily in the background) is ready. Then a real
+server is spawned and the wall time until /health first answers 200 is
+measured, which includes interpreter startup. --eager-model builds the model
+client before serving, the way workers started before it was made lazy.
+
+    python bench_startup.py --runs 5
+    python bench_startup.py --app app6 --backend fake
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from bench_load import free_port
+
+PHASES_CODE = '''
+import json, time
+start = time.perf_counter()
+import {app} as module
+imported = time.perf_counter()
+module.migrate_database()
+migrated = time.perf_counter()
+if {eager}:
+    module.model.client()
+built = time.perf_counter()
+app = module.create_app()
+created = time.perf_counter()
+status = app.test_client().get('/health').status_code
+served = time.perf_counter()
+module.model.client()
+ready = time.perf_counter()
+# Background threads print to stdout too, so the result goes to a file
+with open({result_path!r}, 'w') as f:
+    json.dump({{
+        'status': status,
+        'import': imported - start,
+        'migrate': migrated - imported,
+        'eager_model': built - migrated,
+        'create_app': created - built,
+        'first_request': served - created,
+        'first_response_at': served - start,
+        'model_ready_at': ready - start
+    }}, f)
+'''
+
+SERVER_CODE = '''
+import {app} as module
+module.migrate_database()
+if {eager}:
+    module.model.client()
+module.create_app().run(host='127.0.0.1', port={port}, threaded=True)
+'''
+
+
+def scratch_env(args, scratch):
+    db_path = os.path.join(scratch, 'startup.db')
+    env = dict(
+        os.environ,
+        LLM_BACKEND=args.backend,
+        DATABASE_URL=f'sqlite:///{db_path}',
+        SESSION_DB_PATH=db_path,
+        SESSION_STORE='sqlite' if args.app == 'app6' else os.getenv('SESSION_STORE', 'tiered'),
+        ARCHIVE_DIR='',
+        RETENTION_INTERVAL_SECONDS=str(24 * 3600),
+    )
+    # Building the Gemini client needs a key but makes no requests
+    env.setdefault('GEMINI_API_KEY', 'bench-startup')
+    return env
+
+
+def measure_phases(args, cwd):
+    scratch = tempfile.mkdtemp(prefix='bench_startup_')
+    try:
+        result_path = os.path.join(scratch, 'phases.json')
+        code = PHASES_CODE.format(app=args.app, eager=args.eager_model, result_path=result_path)
+        subprocess.run([sys.executable, '-c', code], env=scratch_env(args, scratch), cwd=cwd,
+                       stdout=subprocess.DEVNULL, check=True)
+        with open(result_path) as f:
+            phases = json.load(f)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    if phases.pop('status') != 200:
+        raise RuntimeError('The first request failed')
+    return phases
+
+
+def measure_server(args, cwd):
+    """Seconds from spawning the server process to its first 200 on /health"""
+    scratch = tempfile.mkdtemp(prefix='bench_startup_')
+    port = free_port()
+    code = SERVER_CODE.format(app=args.app, eager=args.eager_model, port=port)
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-c', code], env=scratch_env(args, scratch), cwd=cwd,
+                              stdout=subprocess.DEVNULL if not args.verbose else None,
+                              stderr=subprocess.DEVNULL if not args.verbose else None)
+    try:
+        while time.perf_counter() - started < 60:
+            if server.poll() is not None:
+                raise RuntimeError('The server exited during startup, rerun with --verbose')
+            try:
+                urllib.request.urlopen(f'http://127.0.0.1:{port}/health', timeout=1).read()
+                return time.perf_counter() - started
+            except Exception:
+                time.sleep(0.005)
+        raise RuntimeError('The server did not answer within 60 seconds')
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--app', default='app5', choices=['app5', 'app6'])
+    parser.add_argument('--backend', default='gemini', choices=['gemini', 'fake'],
+                        help='Model backend to build (no requests are sent either way)')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--eager-model', action='store_true', help='Build the model client before serving')
+    parser.add_argument('--json', help='Also write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help='Show the server output')
+    args = parser.parse_args()
+    cwd = os.path.dirname(os.path.abspath(__file__))
+
+    runs = [measure_phases(args, cwd) for _ in range(args.runs)]
+    servers = [measure_server(args, cwd) for _ in range(args.runs)]
+
+    report = {name: round(statistics.median(run[name] for run in runs) * 1000, 1) for name in runs[0]}
+    report['spawn_to_first_200'] = round(statistics.median(servers) * 1000, 1)
+    print(f"{args.app}, {args.backend} backend{', eager model client' if args.eager_model else ''}, "
+          f"median of {args.runs} runs")
+    for name, ms in report.items():
+        print(f"  {name:<20}{ms:>9.1f} ms")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""Throughput of the multi-worker gunicorn profile as the worker count grows
+
+For each worker count, starts gunicorn with gunicorn.conf.py, the fake LLM
+backend and a fresh shared SQLite database, then runs the same virtual users
+as bench_load.py (submit, follow-up chats, get-session). Every request opens
+a new connection, so follow-ups land on arbitrary workers; any error there
+means session state is not shared.
+
+    python bench_workers.py --workers 1,2,4 --users 32 --duration 15
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from bench_load import free_port, percentile, run_level
+
+
+def start_gunicorn(args, workers, db_path, port):
+    env = dict(
+        os.environ,
+        APP_MODULE=args.app,
+        LLM_BACKEND='fake',
+        FAKE_LLM_LATENCY_MS=str(args.latency_ms),
+        FAKE_LLM_LATENCY_SIGMA='0.2',
+        DATABASE_URL=f'sqlite:///{db_path}',
+        SESSION_DB_PATH=db_path,
+        SESSION_STORE='sqlite',
+        WEB_CONCURRENCY=str(workers),
+        WEB_THREADS=str(args.threads),
+        BIND=f'127.0.0.1:{port}',
+        # Admission control is per worker and every virtual user shares one IP; keep both out of the
+        # way so the server itself is measured
+        LLM_MAX_CONCURRENCY='256',
+        LLM_MAX_QUEUE='256',
+        RATE_LIMIT_ENABLED='0',
+        RETENTION_INTERVAL_SECONDS=str(24 * 3600),
+    )
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py'], env=env,
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.DEVNULL if not args.verbose else None,
+                              stderr=subprocess.DEVNULL if not args.verbose else None)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('gunicorn exited during startup, rerun with --verbose')
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/health', timeout=1).read()
+            return server
+        except Exception:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('gunicorn did not become healthy within 30 seconds')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--app', default='app5', choices=['app5', 'app6'])
+    parser.add_argument('--workers', default='1,2,4', help='Comma separated worker counts')
+    parser.add_argument('--threads', type=int, default=8, help='Threads per worker')
+    parser.add_argument('--users', type=int, default=32, help='Concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=15, help='Seconds per worker count')
+    parser.add_argument('--chats', type=int, default=3, help='Follow-up questions per session')
+    parser.add_argument('--latency-ms', type=float, default=20, help='Median fake model latency')
+    parser.add_argument('--timeout', type=float, default=60, help='Client timeout per request')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='Also write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help='Show the server output')
+    args = parser.parse_args()
+
+    print(f"{args.users} users, fake model latency {args.latency_ms:.0f} ms, {args.threads} threads per worker, "
+          f"{os.cpu_count()} CPUs")
+    print(f"{'workers':>8}{'requests':>10}{'errors':>8}{'req/s':>9}{'speedup':>9}{'p50 ms':>9}{'p95 ms':>9}")
+    report = []
+    baseline = None
+    for workers in sorted(int(count) for count in args.workers.split(',')):
+        scratch = tempfile.mkdtemp(prefix='bench_workers_')
+        port = free_port()
+        server = start_gunicorn(args, workers, os.path.join(scratch, 'bench.db'), port)
+        try:
+            results, elapsed = run_level(f'http://127.0.0.1:{port}', args.users, args)
+        finally:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(scratch, ignore_errors=True)
+
+        samples = [sample for op_samples in results.values() for sample in op_samples]
+        latencies = [latency * 1000 for latency, _ in samples]
+        errors = sum(1 for _, status in samples if status != 200)
+        throughput = len(samples) / elapsed
+        baseline = baseline or throughput
+        level = {
+            'workers': workers,
+            'requests': len(samples),
+            'errors': errors,
+            'throughput': round(throughput, 1),
+            'speedup': round(throughput / baseline, 2),
+            'p50_ms': round(percentile(latencies, 50), 1),
+            'p95_ms': round(percentile(latencies, 95), 1)
+        }
+        report.append(level)
+        print(f"{workers:>8}{level['requests']:>10}{errors:>8}{level['throughput']:>9.1f}"
+              f"{level['speedup']:>8.2f}x{level['p50_ms']:>9.1f}{level['p95_ms']:>9.1f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
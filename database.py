@@ -0,0 +1,143 @@
+import os
+import sqlite3
+
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
+
+# Applied to every new SQLite connection
+SQLITE_PRAGMAS = [
+    # WAL lets readers keep going while a writer commits
+    'PRAGMA journal_mode=WAL',
+    # Safe with WAL: only the last transactions can be lost on power failure, never corruption
+    f"PRAGMA synchronous={os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')}",
+    # Negative values are KiB, so this is a 20 MB page cache per connection
+    f"PRAGMA cache_size=-{int(os.getenv('SQLITE_CACHE_SIZE_KB', 20000))}",
+    'PRAGMA temp_store=MEMORY',
+    f"PRAGMA mmap_size={int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))}",
+    f"PRAGMA busy_timeout={int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))}",
+]
+
+# Engine and connection pool settings for Flask-SQLAlchemy
+SQLITE_ENGINE_OPTIONS = {
+    'pool_size': int(os.getenv('SQLITE_POOL_SIZE', 10)),
+    'max_overflow': int(os.getenv('SQLITE_POOL_OVERFLOW', 10)),
+    'pool_timeout': 10,
+    'connect_args': {'timeout': 15, 'check_same_thread': False},
+}
+
+# Confidence ratings parsed out of each chat_response (see ratings.py); no SQLAlchemy model,
+# so app5.py gets the table from migration 3 and app6.py from SQLITE_SCHEMA
+RATING_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS response_rating (
+        id INTEGER PRIMARY KEY,
+        response_id INTEGER NOT NULL,
+        session_id VARCHAR(36) NOT NULL,
+        response_type VARCHAR(20),
+        section VARCHAR(20) NOT NULL,
+        condition TEXT,
+        condition_key TEXT,
+        percent REAL NOT NULL,
+        kind VARCHAR(20) NOT NULL,
+        created_at DATETIME
+    )''',
+    # Covers the per-condition aggregates of /stats/conditions without touching the table
+    'CREATE INDEX IF NOT EXISTS ix_response_rating_section_condition '
+    'ON response_rating (section, condition_key, percent, kind)',
+    'CREATE INDEX IF NOT EXISTS ix_response_rating_created ON response_rating (created_at)',
+    'CREATE INDEX IF NOT EXISTS ix_response_rating_response ON response_rating (response_id)',
+    'CREATE INDEX IF NOT EXISTS ix_response_rating_session ON response_rating (session_id)',
+]
+
+# Tables app5.py's models create, for code that talks to the database without SQLAlchemy
+SQLITE_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS chat_session (
+        id INTEGER PRIMARY KEY,
+        session_id VARCHAR(36) NOT NULL UNIQUE,
+        created_at DATETIME,
+        last_activity DATETIME,
+        initial_assessment TEXT,
+        baby_info JSON,
+        conversation_summary TEXT,
+        summarized_until INTEGER DEFAULT 0
+    )''',
+    '''CREATE TABLE IF NOT EXISTS chat_response (
+        id INTEGER PRIMARY KEY,
+        session_id VARCHAR(36) NOT NULL REFERENCES chat_session (session_id),
+        response_text TEXT NOT NULL,
+        user_message TEXT,
+        response_type VARCHAR(20),
+        created_at DATETIME
+    )''',
+] + RATING_SCHEMA
+
+# Schema changes that db.create_all() can't make on an existing database.
+# Each entry is one version; PRAGMA user_version records how many have been applied.
+MIGRATIONS = [
+    # 1: indexes for the session history, session lookup and retention queries
+    [
+        'CREATE INDEX IF NOT EXISTS ix_chat_response_session_created ON chat_response (session_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS ix_chat_session_last_activity ON chat_session (last_activity)',
+    ],
+    # 2: rolling conversation summary for token-budgeted chat prompts
+    [
+        'ALTER TABLE chat_session ADD COLUMN conversation_summary TEXT',
+        'ALTER TABLE chat_session ADD COLUMN summarized_until INTEGER DEFAULT 0',
+    ],
+    # 3: structured confidence ratings; existing responses are filled in by ratings.RatingBackfill
+    RATING_SCHEMA,
+]
+
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record=None):
+    """Tune a freshly opened SQLite connection"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def thread_connection(local, db_path, row_factory=None, autocommit=True):
+    """This thread's tuned connection to db_path, kept on the threading.local `local`
+
+    One connection per thread and per process: one inherited across fork()
+    must not be reused, so a new one is opened when the pid has changed.
+    With autocommit the caller manages transactions (BEGIN IMMEDIATE).
+    """
+    connection = getattr(local, 'connection', None)
+    if connection is None or local.pid != os.getpid():
+        if autocommit:
+            connection = sqlite3.connect(db_path, timeout=15, isolation_level=None)
+        else:
+            connection = sqlite3.connect(db_path, timeout=15)
+        if row_factory is not None:
+            connection.row_factory = row_factory
+        apply_sqlite_pragmas(connection)
+        local.connection = connection
+        local.pid = os.getpid()
+    return connection
+
+
+def configure_sqlite_engine(engine):
+    """Apply the pragmas to every connection the engine opens from now on"""
+    event.listen(engine, 'connect', apply_sqlite_pragmas)
+
+
+def migrate(engine):
+    """Apply any migrations newer than the database's user_version and return their numbers"""
+    applied = []
+    with engine.begin() as connection:
+        version = connection.execute(text('PRAGMA user_version')).scalar()
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            for statement in statements:
+                try:
+                    connection.execute(text(statement))
+                except OperationalError as e:
+                    # db.create_all() already built new databases with the latest columns
+                    if 'duplicate column name' not in str(e):
+                        raise
+            connection.execute(text(f'PRAGMA user_version={number}'))
+            applied.append(number)
+            print(f"Applied database migration {number}")
+    return applied
@@ -0,0 +1,42 @@
+"""Pre-fork, multi-worker serving profile: gunicorn -c gunicorn.conf.py
+
+The app is preloaded in the master, which creates and migrates the tables
+once (on_starting, since importing the app never touches the schema), then
+forked into WEB_CONCURRENCY workers. Every worker must see every session,
+so sessions default to the write-through SQLite store in WAL mode rather
+than per-process memory; the tiered store's memory tier would serve stale
+copies across workers.
+"""
+import multiprocessing
+import os
+
+os.environ.setdefault('SESSION_STORE', 'sqlite')
+# In-process rate limit buckets would give each worker its own allowance
+os.environ.setdefault('RATE_LIMIT_BACKEND', 'sqlite')
+if os.environ['SESSION_STORE'] != 'sqlite':
+    print(f"WARNING: SESSION_STORE={os.environ['SESSION_STORE']} keeps sessions per worker; "
+          "follow-up requests landing on another worker won't see them")
+
+wsgi_app = 'wsgi:app'
+bind = os.getenv('BIND', '0.0.0.0:8000')
+workers = int(os.getenv('WEB_CONCURRENCY', min(multiprocessing.cpu_count(), 8)))
+# Threads per worker: model calls and SSE streams mostly wait on the network
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', 8))
+timeout = int(os.getenv('WEB_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+preload_app = True
+# Recycle workers now and then so slow leaks can't build up
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', 5000))
+max_requests_jitter = 500
+
+
+def on_starting(server):
+    from wsgi import migrate_database
+    migrate_database()
+
+
+def post_fork(server, worker):
+    from wsgi import init_worker
+    init_worker()
@@ -0,0 +1,100 @@
+import base64
+import binascii
+import hashlib
+import io
+import os
+
+# Ingestion limits and output settings
+MAX_IMAGE_BYTES = int(os.getenv('IMAGE_MAX_BYTES', 10 * 1024 * 1024))
+MAX_IMAGE_EDGE = int(os.getenv('IMAGE_MAX_EDGE', 1024))
+IMAGE_FORMAT = os.getenv('IMAGE_FORMAT', 'JPEG').upper()
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', 85))
+
+MIME_TYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp', 'PNG': 'image/png'}
+
+
+class ImageRejectedError(Exception):
+    """Raised when an uploaded image is too large to accept"""
+
+
+class PreparedImage:
+    """A downscaled, re-encoded copy of an uploaded image ready to send to the model"""
+
+    def __init__(self, data, mime_type, width, height, original_size, digest):
+        self.data = data
+        self.mime_type = mime_type
+        self.width = width
+        self.height = height
+        self.original_size = original_size
+        self.digest = digest
+
+    def as_model_part(self):
+        """Inline blob the Gemini SDK accepts directly, without re-encoding a PIL image"""
+        return {'mime_type': self.mime_type, 'data': self.data}
+
+
+def decode_image_payload(base64_string, max_bytes=MAX_IMAGE_BYTES):
+    """Decode a base64 (or data URL) image string, rejecting oversized payloads before decoding"""
+    # Remove data URL prefix if present
+    if ',' in base64_string[:256]:
+        base64_string = base64_string.split(',', 1)[1]
+
+    # Every 4 base64 characters hold 3 bytes, so the size is known without decoding
+    decoded_size = len(base64_string) * 3 // 4
+    if decoded_size > max_bytes:
+        raise ImageRejectedError(f'Image is {decoded_size} bytes, limit is {max_bytes}')
+
+    try:
+        return base64.b64decode(base64_string) or None
+    except (binascii.Error, ValueError) as e:
+        print(f"Error decoding image: {e}")
+        return None
+
+
+def content_hash(image_data):
+    """SHA-256 of the uploaded image bytes, used to recognise re-uploads of the same photo"""
+    return hashlib.sha256(image_data).hexdigest()
+
+
+def prepare_image(image_data, max_edge=MAX_IMAGE_EDGE, image_format=IMAGE_FORMAT, quality=IMAGE_QUALITY):
+    """Downscale, strip metadata and re-encode an uploaded image, or return None if it can't be read"""
+    # Imported on first use so starting the app doesn't pay for PIL
+    from PIL import Image, ImageOps
+
+    try:
+        # Image.open only parses the header; pixels are decoded on demand below
+        image = Image.open(io.BytesIO(image_data))
+
+        # Let the JPEG decoder skip detail we are about to throw away
+        image.draft('RGB', (max_edge, max_edge))
+
+        # Apply the EXIF orientation before the metadata is dropped
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+        if image_format in ('JPEG', 'WEBP') and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        # Saving without exif= drops EXIF (including GPS) from the output
+        output = io.BytesIO()
+        image.save(output, format=image_format, quality=quality, optimize=True)
+
+        return PreparedImage(
+            data=output.getvalue(),
+            mime_type=MIME_TYPES.get(image_format, 'application/octet-stream'),
+            width=image.width,
+            height=image.height,
+            original_size=len(image_data),
+            digest=content_hash(image_data)
+        )
+    except Exception as e:
+        print(f"Error processing image: {e}")
+        return None
+
+
+def read_image_upload(stream, max_bytes=MAX_IMAGE_BYTES):
+    """Read raw image bytes from an upload stream, rejecting anything over max_bytes"""
+    image_data = stream.read(max_bytes + 1)
+    if len(image_data) > max_bytes:
+        raise ImageRejectedError(f'Image is larger than the {max_bytes} byte limit')
+    return image_data or None
@@ -0,0 +1,292 @@
+"""Content-addressed store for the prepared photos of chat sessions
+
+Each image is kept once, under the SHA-256 of its prepared bytes (its
+image_ref), however many sessions use it; `source_digest`, the hash of the
+upload, lets a re-upload of the same photo be matched without preparing it
+again. Sessions refer to images by image_ref in the session_image table, so
+/chat can attach a session's photo on demand instead of the client sending
+it again.
+
+The bytes live either in the image_blob_data table ('sqlite') or in files
+under <root>/<first two hex digits>/<image_ref> ('disk'); the metadata and
+references are always in SQLite, shared by every worker. Images no session
+refers to any more are removed by collect(), which the retention worker
+runs after deleting sessions, and once the images add up to more than
+`max_bytes` the least recently used ones are evicted along with their
+references.
+"""
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+from database import thread_connection
+
+IMAGE_STORE_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS image_blob (
+        digest TEXT PRIMARY KEY,
+        source_digest TEXT,
+        mime_type TEXT NOT NULL,
+        width INTEGER,
+        height INTEGER,
+        size INTEGER NOT NULL,
+        created_at REAL NOT NULL,
+        last_used_at REAL NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS ix_image_blob_source ON image_blob (source_digest)',
+    'CREATE INDEX IF NOT EXISTS ix_image_blob_last_used ON image_blob (last_used_at)',
+    # Apart from the metadata, so updating last_used_at doesn't rewrite the image
+    '''CREATE TABLE IF NOT EXISTS image_blob_data (
+        digest TEXT PRIMARY KEY,
+        data BLOB NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS session_image (
+        session_id TEXT NOT NULL,
+        digest TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        PRIMARY KEY (session_id, digest)
+    ) WITHOUT ROWID''',
+    'CREATE INDEX IF NOT EXISTS ix_session_image_digest ON session_image (digest)',
+]
+
+
+class StoredImage:
+    """An image read back from the store"""
+
+    def __init__(self, digest, data, mime_type, width, height):
+        self.digest = digest
+        self.data = data
+        self.mime_type = mime_type
+        self.width = width
+        self.height = height
+
+    def as_model_part(self):
+        """Inline blob the Gemini SDK accepts directly"""
+        return {'mime_type': self.mime_type, 'data': self.data}
+
+
+class ImageStore:
+    """Prepared session images in SQLite or on disk, deduplicated by content hash
+
+    With `root` the bytes are written to files under it, otherwise they are
+    stored in the database. last_used_at is refreshed at most once every
+    `touch_interval` seconds per image, which is all LRU eviction needs.
+    """
+
+    def __init__(self, db_path, root=None, max_bytes=256 * 1024 * 1024, touch_interval=60):
+        self.db_path = db_path
+        self.root = root
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.counters = {'stored': 0, 'deduplicated': 0, 'hits': 0, 'misses': 0, 'evicted': 0, 'collected': 0}
+
+    def _connection(self):
+        return thread_connection(self._local, self.db_path)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def create_schema(self):
+        """Create the image tables (and the blob directory) if they don't exist yet"""
+        connection = self._connection()
+        for statement in IMAGE_STORE_SCHEMA:
+            connection.execute(statement)
+        if self.root:
+            os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _write_file(self, digest, data):
+        path = self._path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.{uuid.uuid4().hex[:8]}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def find(self, source_digest):
+        """image_ref of a stored copy of the upload with this hash, or None"""
+        row = self._connection().execute(
+            'SELECT digest FROM image_blob WHERE source_digest = ? LIMIT 1', (source_digest,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def add(self, session_id, image):
+        """Keep a PreparedImage for a session and return its image_ref
+
+        Content already in the store is only linked to the session. File
+        writes happen inside the transaction, so collect() in another worker
+        can't delete a file between this add writing it and linking it.
+        """
+        digest = hashlib.sha256(image.data).hexdigest()
+        now = time.time()
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            added = connection.execute('UPDATE image_blob SET last_used_at = ? WHERE digest = ?',
+                                       (now, digest)).rowcount == 0
+            if added:
+                connection.execute(
+                    'INSERT INTO image_blob (digest, source_digest, mime_type, width, height, size, created_at, '
+                    'last_used_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (digest, image.digest, image.mime_type, image.width, image.height, len(image.data), now, now)
+                )
+                if self.root:
+                    self._write_file(digest, image.data)
+                else:
+                    connection.execute('INSERT OR REPLACE INTO image_blob_data (digest, data) VALUES (?, ?)',
+                                       (digest, image.data))
+            self._link(connection, session_id, digest, now)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        self._count('stored' if added else 'deduplicated')
+        if added:
+            self.evict()
+        return digest
+
+    def link(self, session_id, digest):
+        """Refer a session to an image already in the store; False if it has been evicted meanwhile"""
+        connection = self._connection()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            found = connection.execute('UPDATE image_blob SET last_used_at = ? WHERE digest = ?',
+                                       (now, digest)).rowcount
+            if found:
+                self._link(connection, session_id, digest, now)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        if found:
+            self._count('deduplicated')
+        return bool(found)
+
+    def _link(self, connection, session_id, digest, now):
+        connection.execute('INSERT OR IGNORE INTO session_image (session_id, digest, created_at) VALUES (?, ?, ?)',
+                           (session_id, digest, now))
+
+    def session_images(self, session_id):
+        """image_refs of a session, oldest first"""
+        rows = self._connection().execute(
+            'SELECT digest FROM session_image WHERE session_id = ? ORDER BY created_at', (session_id,)
+        )
+        return [row[0] for row in rows]
+
+    def get(self, digest):
+        """The StoredImage for an image_ref, or None if it isn't (or is no longer) stored"""
+        connection = self._connection()
+        row = connection.execute(
+            'SELECT mime_type, width, height, last_used_at FROM image_blob WHERE digest = ?', (digest,)
+        ).fetchone()
+        data = None
+        if row is not None:
+            if self.root:
+                try:
+                    with open(self._path(digest), 'rb') as f:
+                        data = f.read()
+                except FileNotFoundError:
+                    pass
+            else:
+                blob = connection.execute('SELECT data FROM image_blob_data WHERE digest = ?', (digest,)).fetchone()
+                data = blob[0] if blob else None
+        if data is None:
+            self._count('misses')
+            return None
+
+        mime_type, width, height, last_used_at = row
+        now = time.time()
+        if now - last_used_at > self.touch_interval:
+            connection.execute('UPDATE image_blob SET last_used_at = ? WHERE digest = ?', (now, digest))
+        self._count('hits')
+        return StoredImage(digest, data, mime_type, width, height)
+
+    def _delete(self, connection, digests):
+        """Delete images with their references and bytes, inside the caller's transaction"""
+        params = [(digest,) for digest in digests]
+        connection.executemany('DELETE FROM session_image WHERE digest = ?', params)
+        connection.executemany('DELETE FROM image_blob_data WHERE digest = ?', params)
+        connection.executemany('DELETE FROM image_blob WHERE digest = ?', params)
+        if self.root:
+            for digest in digests:
+                try:
+                    os.remove(self._path(digest))
+                except FileNotFoundError:
+                    pass
+
+    def collect(self):
+        """Delete images no session refers to any more; returns how many"""
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            digests = [row[0] for row in connection.execute(
+                'SELECT digest FROM image_blob WHERE NOT EXISTS '
+                '(SELECT 1 FROM session_image WHERE session_image.digest = image_blob.digest)'
+            )]
+            self._delete(connection, digests)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        self._count('collected', len(digests))
+        return len(digests)
+
+    def evict(self):
+        """Evict least recently used images until the store is back under 90% of max_bytes; returns how many"""
+        if not self.max_bytes:
+            return 0
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            excess = connection.execute('SELECT COALESCE(SUM(size), 0) FROM image_blob').fetchone()[0] - self.max_bytes
+            digests = []
+            if excess > 0:
+                # Free a little more than needed so the next few adds don't evict again straight away
+                to_free = excess + self.max_bytes // 10
+                for digest, size in connection.execute('SELECT digest, size FROM image_blob ORDER BY last_used_at'):
+                    if to_free <= 0:
+                        break
+                    digests.append(digest)
+                    to_free -= size
+                self._delete(connection, digests)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        self._count('evicted', len(digests))
+        return len(digests)
+
+    def status(self):
+        connection = self._connection()
+        images, size = connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM image_blob').fetchone()
+        references = connection.execute('SELECT COUNT(*) FROM session_image').fetchone()[0]
+        with self._lock:
+            counters = dict(self.counters)
+        return dict(counters, backend='disk' if self.root else 'sqlite', root=self.root, images=images,
+                    bytes=size, max_bytes=self.max_bytes, references=references)
+
+
+def create_image_store(db_path, instance_path):
+    """Build the store from the IMAGE_STORE* settings, or None with IMAGE_STORE=off
+
+    IMAGE_STORE is 'sqlite' (default) or 'disk', which writes the images
+    under IMAGE_STORE_DIR (default <instance>/images). IMAGE_STORE_MAX_BYTES
+    caps their total size (0 for no cap).
+    """
+    backend = os.getenv('IMAGE_STORE', 'sqlite')
+    if backend in ('', 'off', 'none'):
+        return None
+    if backend == 'disk':
+        root = os.getenv('IMAGE_STORE_DIR') or os.path.join(instance_path, 'images')
+    elif backend == 'sqlite':
+        root = None
+    else:
+        raise ValueError(f'Unknown image store backend: {backend}')
+    return ImageStore(db_path, root=root, max_bytes=int(os.getenv('IMAGE_STORE_MAX_BYTES', 256 * 1024 * 1024)))
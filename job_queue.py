@@ -0,0 +1,295 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from database import thread_connection
+
+JOB_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS assessment_job (
+        id VARCHAR(36) PRIMARY KEY,
+        status VARCHAR(10) NOT NULL,
+        payload TEXT NOT NULL,
+        result TEXT,
+        error TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        created_at REAL NOT NULL,
+        available_at REAL NOT NULL,
+        started_at REAL,
+        finished_at REAL,
+        lease_until REAL,
+        lease_token TEXT
+    )''',
+    'CREATE INDEX IF NOT EXISTS ix_assessment_job_status_available ON assessment_job (status, available_at)',
+]
+
+# Columns added after the table was first released, for databases created before them
+JOB_SCHEMA_UPGRADES = [
+    'ALTER TABLE assessment_job ADD COLUMN lease_token TEXT',
+]
+
+PENDING_STATUSES = ('queued', 'running')
+
+
+class JobFailed(Exception):
+    """Raised by a job handler for a failure that retrying will not fix"""
+
+
+class RetryLater(Exception):
+    """Raised by a job handler to put the job back in the queue for `delay` seconds
+
+    Meant for work that was refused before it started (e.g. a full LLM
+    pool), so it doesn't count as an attempt.
+    """
+
+    def __init__(self, message, delay=1.0):
+        super().__init__(message)
+        self.delay = delay
+
+
+class JobQueue:
+    """SQLite-backed job queue processed by a pool of worker threads
+
+    Jobs are rows in the assessment_job table, so they survive restarts and
+    can be shared by several processes using the same file. A worker claims
+    a job by taking a lease, which it keeps renewing while the job runs; if
+    the process dies mid-job the lease runs out and another worker picks it
+    up again, up to `max_attempts` times. Only the holder of a job's current
+    lease can finish it. A RetryLater (e.g. the LLM pool was full) puts the
+    job back without using up an attempt.
+    """
+
+    def __init__(self, db_path, handler, workers=2, lease_seconds=300, max_attempts=3,
+                 poll_interval=1.0, result_ttl=86400):
+        self.db_path = db_path
+        self.handler = handler
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.result_ttl = result_ttl
+
+        self._local = threading.local()
+        self._wake = threading.Event()
+        self._finished = threading.Condition()
+        self._stop = threading.Event()
+        self._threads = []
+        self._last_purge = 0.0
+        self.counters = {'enqueued': 0, 'completed': 0, 'failed': 0, 'retried': 0, 'lease_lost': 0}
+
+    def create_schema(self):
+        """Create the assessment_job table if it doesn't exist yet"""
+        connection = self._connection()
+        for statement in JOB_SCHEMA:
+            connection.execute(statement)
+        for statement in JOB_SCHEMA_UPGRADES:
+            try:
+                connection.execute(statement)
+            except sqlite3.OperationalError as e:
+                if 'duplicate column name' not in str(e):
+                    raise
+
+    def _connection(self):
+        return thread_connection(self._local, self.db_path, row_factory=sqlite3.Row)
+
+    def start(self):
+        """Start the worker threads if they aren't running yet"""
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        for i in range(len(self._threads), self.workers):
+            thread = threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def enqueue(self, payload):
+        """Persist a new job and return its id"""
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        self._connection().execute(
+            'INSERT INTO assessment_job (id, status, payload, created_at, available_at) VALUES (?, ?, ?, ?, ?)',
+            (job_id, 'queued', json.dumps(payload), now, now)
+        )
+        self.counters['enqueued'] += 1
+        self._wake.set()
+        return job_id
+
+    def _claim(self):
+        """Lease the oldest runnable job, including jobs whose previous lease ran out"""
+        connection = self._connection()
+        now = time.time()
+        lease_token = uuid.uuid4().hex
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                "SELECT * FROM assessment_job WHERE (status = 'queued' AND available_at <= ?) "
+                "OR (status = 'running' AND lease_until < ?) ORDER BY available_at LIMIT 1",
+                (now, now)
+            ).fetchone()
+            if row is None:
+                connection.execute('COMMIT')
+                return None
+            connection.execute(
+                "UPDATE assessment_job SET status = 'running', attempts = attempts + 1, "
+                "started_at = ?, lease_until = ?, lease_token = ? WHERE id = ?",
+                (now, now + self.lease_seconds, lease_token, row['id'])
+            )
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return dict(row, attempts=row['attempts'] + 1, lease_token=lease_token)
+
+    def _finish(self, job, status, result=None, error=None, available_at=None, refund_attempt=False):
+        """Record a job's outcome; False if its lease was lost to another worker meanwhile"""
+        now = time.time()
+        finished = self._connection().execute(
+            'UPDATE assessment_job SET status = ?, result = ?, error = ?, finished_at = ?, '
+            'available_at = COALESCE(?, available_at), attempts = attempts - ?, lease_until = NULL, '
+            'lease_token = NULL WHERE id = ? AND lease_token = ?',
+            (status, json.dumps(result) if result is not None else None, error,
+             now if status in ('done', 'failed') else None, available_at, 1 if refund_attempt else 0,
+             job['id'], job['lease_token'])
+        ).rowcount
+        if not finished:
+            print(f"Job {job['id']} lost its lease, its outcome was not recorded")
+            self.counters['lease_lost'] += 1
+        with self._finished:
+            self._finished.notify_all()
+        return bool(finished)
+
+    def _renew_lease(self, job, stop):
+        """Keep extending a running job's lease so it isn't claimed again while it is still running"""
+        while not stop.wait(self.lease_seconds / 3):
+            try:
+                renewed = self._connection().execute(
+                    'UPDATE assessment_job SET lease_until = ? WHERE id = ? AND lease_token = ?',
+                    (time.time() + self.lease_seconds, job['id'], job['lease_token'])
+                ).rowcount
+            except sqlite3.Error as e:
+                print(f"Error renewing the lease of job {job['id']}: {e}")
+                continue
+            if not renewed:
+                return
+
+    def _run(self, job):
+        stop_renewing = threading.Event()
+        renewer = threading.Thread(target=self._renew_lease, args=(job, stop_renewing),
+                                   name='job-lease', daemon=True)
+        renewer.start()
+        try:
+            result = self.handler(json.loads(job['payload']))
+        except JobFailed as e:
+            self.counters['failed'] += 1
+            self._finish(job, 'failed', error=str(e))
+        except RetryLater as e:
+            # The job didn't get to run (e.g. the LLM pool was full), so this isn't a failed attempt
+            self.counters['retried'] += 1
+            self._finish(job, 'queued', error=str(e), available_at=time.time() + e.delay, refund_attempt=True)
+        except Exception as e:
+            if job['attempts'] >= self.max_attempts:
+                print(f"Job {job['id']} failed after {job['attempts']} attempts: {e}")
+                self.counters['failed'] += 1
+                self._finish(job, 'failed', error=str(e))
+            else:
+                self.counters['retried'] += 1
+                self._finish(job, 'queued', error=str(e),
+                             available_at=time.time() + self.poll_interval * 2 ** job['attempts'])
+        else:
+            self.counters['completed'] += 1
+            self._finish(job, 'done', result=result)
+        finally:
+            stop_renewing.set()
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                job = self._claim()
+            except Exception as e:
+                print(f"Error claiming job: {e}")
+                job = None
+            if job is None:
+                self._purge()
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            if job['attempts'] > self.max_attempts:
+                # Its leases kept running out, most likely because the worker process died each time
+                self.counters['failed'] += 1
+                self._finish(job, 'failed', error='Job abandoned after too many attempts')
+                continue
+            self._run(job)
+
+    def _purge(self):
+        """Delete finished jobs older than result_ttl, at most once a minute"""
+        now = time.time()
+        if now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        try:
+            self._connection().execute(
+                "DELETE FROM assessment_job WHERE status IN ('done', 'failed') AND finished_at < ?",
+                (now - self.result_ttl,)
+            )
+        except Exception as e:
+            print(f"Error purging finished jobs: {e}")
+
+    def get(self, job_id):
+        """Job status and result as a JSON-ready dict, or None for an unknown id"""
+        row = self._connection().execute('SELECT * FROM assessment_job WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+
+        def timestamp(value):
+            return datetime.fromtimestamp(value).isoformat() if value else None
+
+        job = {
+            'job_id': row['id'],
+            'status': row['status'],
+            'attempts': row['attempts'],
+            'created_at': timestamp(row['created_at']),
+            'started_at': timestamp(row['started_at']),
+            'finished_at': timestamp(row['finished_at'])
+        }
+        if row['status'] == 'done':
+            job['result'] = json.loads(row['result'])
+        elif row['error']:
+            job['error'] = row['error']
+        return job
+
+    def wait(self, job_id, timeout):
+        """Long-poll: return the job once it has finished or `timeout` seconds have passed"""
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job['status'] not in PENDING_STATUSES or remaining <= 0:
+                return job
+            # Woken early by local workers; jobs finished by other processes are seen on the next poll
+            with self._finished:
+                self._finished.wait(min(remaining, self.poll_interval))
+
+    def depth(self):
+        """Number of jobs in each status"""
+        rows = self._connection().execute(
+            'SELECT status, COUNT(*) AS jobs FROM assessment_job GROUP BY status'
+        ).fetchall()
+        counts = {status: 0 for status in ('queued', 'running', 'done', 'failed')}
+        counts.update({row['status']: row['jobs'] for row in rows})
+        return counts
+
+    def stats(self):
+        oldest = self._connection().execute(
+            "SELECT MIN(created_at) FROM assessment_job WHERE status = 'queued'"
+        ).fetchone()[0]
+        return dict(
+            self.counters,
+            depth=self.depth(),
+            oldest_queued_seconds=round(time.time() - oldest, 1) if oldest else None,
+            workers=self.workers,
+            workers_alive=sum(1 for thread in self._threads if thread.is_alive())
+        )
@@ -0,0 +1,107 @@
+import hashlib
+import os
+import random
+import threading
+import time
+
+# Canned answer in the format the prompts ask for, so parsing and storage see realistic text
+FAKE_RESPONSE = """- Mild diaper rash [78% likely] 🙂
+- Normal newborn skin irritation [65% match]
+\\
+- Diaper rash is common and usually caused by moisture and friction [80% confidence]
+- Heat rash can look similar in warm weather [55% confidence]
+\\
+- **Seek urgent care if there is a fever above 38 °C, blisters or the baby is unusually drowsy**
+\\
+- Change diapers often and let the skin air-dry
+- Use a zinc oxide barrier cream
+- Talk to your pediatrician if it does not improve within 3 days"""
+
+
+class FakeBackendError(Exception):
+    """Simulated model failure from FakeModel, reported like an upstream 503"""
+    code = 503
+
+
+class FakeChunk:
+    """Stand-in for a Gemini response or stream chunk"""
+
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeModel:
+    """Local stand-in for genai.GenerativeModel with configurable latency and failures
+
+    Latency is log-normal around `latency_ms` (sigma controls the tail), and
+    `failure_rate` of calls raise FakeBackendError after waiting. Streaming
+    calls spend `first_chunk_share` of the latency before the first chunk and
+    spread the rest across the remaining chunks.
+    """
+
+    def __init__(self, latency_ms=800, latency_sigma=0.5, failure_rate=0.0,
+                 first_chunk_share=0.3, chunk_words=8, seed=None, response_text=FAKE_RESPONSE):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.failure_rate = failure_rate
+        self.first_chunk_share = first_chunk_share
+        self.chunk_words = chunk_words
+        self.response_text = response_text
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def _draw(self):
+        """Pick this call's latency in seconds and whether it fails"""
+        with self._lock:
+            self.calls += 1
+            latency = self._random.lognormvariate(0, self.latency_sigma) * self.latency_ms / 1000
+            failed = self._random.random() < self.failure_rate
+        return latency, failed
+
+    def _response_for(self, model_input):
+        # Vary the text a little per prompt so cache keys and stored rows differ
+        prompt = model_input[0] if isinstance(model_input, list) else model_input
+        tag = hashlib.sha256(str(prompt).encode('utf-8')).hexdigest()[:8]
+        return f"{self.response_text}\n- Reference {tag}"
+
+    def generate_content(self, model_input, stream=False, **kwargs):
+        latency, failed = self._draw()
+        text = self._response_for(model_input)
+        if not stream:
+            time.sleep(latency)
+            if failed:
+                raise FakeBackendError('Simulated model failure')
+            return FakeChunk(text)
+        return self._stream(text, latency, failed)
+
+    def _stream(self, text, latency, failed):
+        words = text.split(' ')
+        chunks = [' '.join(words[i:i + self.chunk_words]) + ' ' for i in range(0, len(words), self.chunk_words)]
+        time.sleep(latency * self.first_chunk_share)
+        if failed:
+            raise FakeBackendError('Simulated model failure')
+        pause = latency * (1 - self.first_chunk_share) / max(1, len(chunks) - 1)
+        for i, chunk in enumerate(chunks):
+            if i:
+                time.sleep(pause)
+            yield FakeChunk(chunk)
+
+
+def create_model(backend=None):
+    """Build the model named by LLM_BACKEND: 'gemini' (default) or 'fake' for offline runs"""
+    backend = backend or os.getenv('LLM_BACKEND', 'gemini')
+    if backend == 'fake':
+        seed = os.getenv('FAKE_LLM_SEED')
+        return FakeModel(
+            latency_ms=float(os.getenv('FAKE_LLM_LATENCY_MS', 800)),
+            latency_sigma=float(os.getenv('FAKE_LLM_LATENCY_SIGMA', 0.5)),
+            failure_rate=float(os.getenv('FAKE_LLM_FAILURE_RATE', 0.0)),
+            seed=int(seed) if seed else None
+        )
+    if backend != 'gemini':
+        raise ValueError(f'Unknown LLM backend: {backend}')
+
+    import google.generativeai as genai
+    genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
+    return genai.GenerativeModel(os.getenv('GEMINI_MODEL', 'gemini-1.5-flash'))
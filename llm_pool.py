@@ -0,0 +1,173 @@
+import math
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+
+class LLMPoolError(Exception):
+    """Base error for calls the LLM pool could not run"""
+    status_code = 503
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class PoolFullError(LLMPoolError):
+    """Raised when every worker is busy and the wait queue is full"""
+    status_code = 503
+
+
+class DeadlineExceededError(LLMPoolError):
+    """Raised when a call does not finish before its deadline"""
+    status_code = 504
+
+
+class LLMPool:
+    """Bounded executor for model calls with admission control and per-call deadlines
+
+    At most `max_concurrency` calls run at once and at most `max_queue` more
+    wait for a worker. Anything beyond that is rejected straight away with a
+    PoolFullError so the request thread is freed instead of piling up.
+    """
+
+    def __init__(self, max_concurrency=4, max_queue=16, deadline=60.0):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.deadline = deadline
+
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='llm-worker')
+        self._slots = threading.BoundedSemaphore(max_concurrency + max_queue)
+        self._lock = threading.Lock()
+
+        # Counters, guarded by _lock
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._avg_duration = 5.0  # Moving average of call duration in seconds
+
+    def retry_after(self):
+        """Estimate how many seconds a rejected client should wait before retrying"""
+        with self._lock:
+            backlog = self.queued + self.running
+            return max(1, math.ceil(self._avg_duration * backlog / self.max_concurrency))
+
+    def _admit(self):
+        """Reserve a running/queued slot or raise PoolFullError"""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise PoolFullError('LLM pool is at capacity', retry_after=self.retry_after())
+        with self._lock:
+            self.queued += 1
+
+    def _release(self, future):
+        """Give the slot back once a call is done, including calls cancelled while queued"""
+        if future.cancelled():
+            with self._lock:
+                self.queued -= 1
+        self._slots.release()
+
+    def _start(self, expires_at):
+        """Move a call from queued to running unless it already waited past its deadline"""
+        with self._lock:
+            self.queued -= 1
+            if time.monotonic() > expires_at:
+                self.timed_out += 1
+                raise DeadlineExceededError('Deadline exceeded while waiting for an LLM worker')
+            self.running += 1
+        return time.monotonic()
+
+    def _finish(self, started_at):
+        duration = time.monotonic() - started_at
+        with self._lock:
+            self.running -= 1
+            self.completed += 1
+            self._avg_duration = 0.8 * self._avg_duration + 0.2 * duration
+
+    def _run(self, fn, args, kwargs, expires_at, deadline_arg=None):
+        started_at = self._start(expires_at)
+        if deadline_arg:
+            # Time spent queued comes out of the call's own deadline
+            kwargs = dict(kwargs, **{deadline_arg: expires_at - started_at})
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._finish(started_at)
+
+    def submit(self, fn, *args, deadline=None, deadline_arg=None, **kwargs):
+        """Run fn on the pool and block until it returns, fails, or its deadline passes
+
+        With deadline_arg, fn gets the seconds left of the deadline when it
+        starts as that keyword argument, so it can stop retrying in time.
+        """
+        deadline = deadline or self.deadline
+        self._admit()
+        expires_at = time.monotonic() + deadline
+
+        future = self._executor.submit(self._run, fn, args, kwargs, expires_at, deadline_arg)
+        future.add_done_callback(self._release)
+        try:
+            return future.result(timeout=deadline)
+        except FutureTimeoutError:
+            future.cancel()
+            with self._lock:
+                self.timed_out += 1
+            raise DeadlineExceededError('LLM call exceeded its deadline', retry_after=self.retry_after())
+
+    def stream(self, fn, *args, deadline=None, **kwargs):
+        """Run a streaming call on the pool and return an iterator over its chunks
+
+        Admission happens immediately so callers can reject the request before
+        starting a response. The worker keeps its slot until the stream ends.
+        """
+        deadline = deadline or self.deadline
+        self._admit()
+        expires_at = time.monotonic() + deadline
+        chunks = queue.Queue()
+        cancelled = threading.Event()
+        done = object()
+
+        def produce():
+            try:
+                for chunk in fn(*args, **kwargs):
+                    if cancelled.is_set():
+                        break
+                    chunks.put(chunk)
+                chunks.put(done)
+            except Exception as e:
+                chunks.put(e)
+
+        future = self._executor.submit(self._run, produce, (), {}, expires_at)
+        future.add_done_callback(self._release)
+
+        def forward_error(f):
+            # Errors raised before produce() runs, e.g. a deadline hit while queued
+            if not f.cancelled() and f.exception() is not None:
+                chunks.put(f.exception())
+
+        future.add_done_callback(forward_error)
+
+        def consume():
+            try:
+                while True:
+                    try:
+                        item = chunks.get(timeout=max(0.0, expires_at - time.monotonic()))
+                    except queue.Empty:
+                        with self._lock:
+                            self.timed_out += 1
+                        raise DeadlineExceededError('LLM stream exceeded its deadline')
+                    if item is done:
+                        return
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+            finally:
+                # Stop the worker early if the client went away
+                cancelled.set()
+                future.cancel()
+
+        return consume()
@@ -0,0 +1,267 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, has_request_context, request
+
+# Latency buckets in seconds, wide enough for a cold Gemini call with an image
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Always send the Server-Timing header instead of only when a request asks for it
+TIMING_HEADER_ALWAYS = os.getenv('METRICS_TIMING_HEADER', '').lower() in ('1', 'true', 'yes')
+
+
+def format_labels(labelnames, values, extra=()):
+    """Render a Prometheus label set like {stage="llm",le="0.5"}"""
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = [
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    ]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """One named metric family with optional labels
+
+    If `function` is given the values are read from it at scrape time: it
+    returns a number, or a dict mapping label value tuples to numbers.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self):
+        """(suffix, label values, extra labels, value) tuples for the exposition format"""
+        if self.function is not None:
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {(): values}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [('', key, (), value) for key, value in sorted(values.items())]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for suffix, key, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{format_labels(self.labelnames, key, extra)} {format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        samples = []
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append(('_bucket', key, [('le', format_value(bound))], cumulative))
+            samples.append(('_sum', key, (), total))
+            samples.append(('_count', key, (), cumulative))
+        return samples
+
+
+class Registry:
+    """Collection of metrics rendered together on /metrics"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Metric {metric.name} is already registered')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=(), function=None):
+        return self._register(Counter(name, documentation, labelnames, function))
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self._register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """Prometheus text exposition format (version 0.0.4)"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines += metric.render()
+            except Exception as e:
+                print(f"Error collecting metric {metric.name}: {e}")
+        return '\n'.join(lines) + '\n' if lines else ''
+
+
+# Request metrics shared by every app in the process; init_app() gives each app its own
+# registry for metrics of the objects it owns (model, pool, caches), so two apps can be
+# imported side by side without their names clashing
+registry = Registry()
+
+REQUEST_SECONDS = registry.histogram(
+    'http_request_duration_seconds', 'Time to build the response, excluding streamed bodies',
+    ['endpoint', 'method', 'status'])
+REQUESTS_IN_FLIGHT = registry.gauge(
+    'http_requests_in_flight', 'Requests currently being handled', ['endpoint'])
+STAGE_SECONDS = registry.histogram(
+    'stage_duration_seconds', 'Time spent in each stage of a request', ['endpoint', 'stage'])
+STAGE_ERRORS = registry.counter(
+    'stage_errors_total', 'Exceptions raised inside a timed stage', ['endpoint', 'stage', 'error'])
+ERRORS = registry.counter(
+    'request_errors_total', 'Requests answered with an error status', ['endpoint', 'status'])
+PAYLOAD_BYTES = registry.counter(
+    'payload_bytes_total', 'Prompt, response and image sizes sent to or received from the model',
+    ['endpoint', 'kind'])
+PAYLOAD_COUNT = registry.counter(
+    'payload_count_total', 'Number of prompts, responses and images counted in payload_bytes_total',
+    ['endpoint', 'kind'])
+
+
+def current_endpoint():
+    return (request.endpoint or 'unknown') if has_request_context() else 'background'
+
+
+@contextmanager
+def span(stage, endpoint=None):
+    """Time a block as one stage of the current request
+
+    The duration goes into stage_duration_seconds and, for the Server-Timing
+    header, into the request's own list of timings.
+    """
+    endpoint = endpoint or current_endpoint()
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        STAGE_ERRORS.inc(endpoint=endpoint, stage=stage, error=type(e).__name__)
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_SECONDS.observe(duration, endpoint=endpoint, stage=stage)
+        if has_request_context() and 'timings' in g:
+            g.timings.append((stage, duration))
+
+
+def record_size(kind, text, endpoint=None):
+    """Count the size of a prompt, response or image in bytes"""
+    if text is None:
+        return
+    size = len(text.encode('utf-8')) if isinstance(text, str) else len(text)
+    endpoint = endpoint or current_endpoint()
+    PAYLOAD_BYTES.inc(size, endpoint=endpoint, kind=kind)
+    PAYLOAD_COUNT.inc(endpoint=endpoint, kind=kind)
+
+
+def timing_requested():
+    return TIMING_HEADER_ALWAYS or request.headers.get('X-Debug-Timing', '').lower() in ('1', 'true', 'yes')
+
+
+def init_app(app):
+    """Time every request, count errors, add Server-Timing on request and serve /metrics
+
+    Returns the app's own registry, rendered on /metrics after the shared one.
+    """
+    app_registry = Registry()
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+        g.timings = []
+        g.in_flight_endpoint = request.endpoint or 'unknown'
+        REQUESTS_IN_FLIGHT.inc(endpoint=g.in_flight_endpoint)
+
+    @app.after_request
+    def record_request(response):
+        started = g.get('request_started')
+        if started is None:
+            return response
+        endpoint = request.endpoint or 'unknown'
+        duration = time.perf_counter() - started
+        REQUEST_SECONDS.observe(duration, endpoint=endpoint, method=request.method, status=response.status_code)
+        if response.status_code >= 400:
+            ERRORS.inc(endpoint=endpoint, status=response.status_code)
+
+        if timing_requested():
+            entries = [f'{stage};dur={value * 1000:.2f}' for stage, value in g.timings]
+            entries.append(f'total;dur={duration * 1000:.2f}')
+            response.headers['Server-Timing'] = ', '.join(entries)
+        return response
+
+    @app.teardown_request
+    def finish_request(error=None):
+        endpoint = g.pop('in_flight_endpoint', None)
+        if endpoint is not None:
+            REQUESTS_IN_FLIGHT.dec(endpoint=endpoint)
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        """Prometheus scrape endpoint"""
+        return Response(registry.render() + app_registry.render(), mimetype='text/plain; version=0.0.4')
+
+    return app_registry
@@ -0,0 +1,130 @@
+import math
+import os
+import re
+
+# Upper bound for the whole follow-up prompt and for the rolling summary inside it
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', 3000))
+SUMMARY_TOKEN_BUDGET = int(os.getenv('SUMMARY_TOKEN_BUDGET', 400))
+
+# Share of the budget the initial assessment may take before it is truncated
+ASSESSMENT_BUDGET_SHARE = 0.4
+
+CHARS_PER_TOKEN = 4
+
+RATING_PATTERN = re.compile(r'\[\d{1,3}%[^\]]*\]')
+
+CHAT_HEADER = """You are continuing a conversation about a baby's health.
+
+IMPORTANT: When providing assessments or identifying conditions, always include accuracy/confidence ratings in brackets like [XX% match], [XX% confidence], or [XX% likely].
+"""
+
+CHAT_INSTRUCTIONS = """
+Please respond to the user's question while maintaining context of the baby's condition and previous conversation.
+Continue to emphasize that this is not medical advice and recommend consulting a pediatrician when appropriate.
+REMEMBER: Include accuracy/confidence ratings in brackets [XX%] for any medical assessments or condition identifications.
+
+EXAMPLES:
+- "That symptom could indicate teething [75% likely]"
+- "The described behavior is typical for this age [88% normal]"
+- "This might be a growth spurt [70% confidence]"
+"""
+
+
+def estimate_tokens(text):
+    """Rough token count without calling the API (Gemini averages about 4 characters per token)"""
+    return math.ceil(len(text or '') / CHARS_PER_TOKEN)
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text down to roughly max_tokens, marking the cut"""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    return text[:max(0, max_chars - 3)].rstrip() + '...'
+
+
+def summarize_exchange(user_message, response):
+    """Condense one question/answer pair into a single summary line
+
+    Keeps the question, the first sentence of the answer and any confidence
+    ratings, which is what later turns need to stay consistent.
+    """
+    question = ' '.join((user_message or '').split())
+    answer = ' '.join((response or '').split())
+    first_sentence = re.split(r'(?<=[.!?])\s', answer, maxsplit=1)[0]
+    ratings = []
+    for line in (response or '').splitlines():
+        if RATING_PATTERN.search(line):
+            ratings.append(line.strip(' -*•').strip())
+    line = f"- Parent asked: {truncate_to_tokens(question, 50)} | Answer: {truncate_to_tokens(first_sentence, 60)}"
+    if ratings:
+        line += ' | Ratings: ' + '; '.join(truncate_to_tokens(rating, 30) for rating in ratings[:3])
+    return line
+
+
+def extend_summary(summary, exchanges, max_tokens=SUMMARY_TOKEN_BUDGET):
+    """Fold older exchanges into the rolling summary, dropping the oldest lines past max_tokens"""
+    lines = (summary or '').splitlines()
+    lines += [summarize_exchange(exchange['user_message'], exchange['response']) for exchange in exchanges]
+    while lines and estimate_tokens('\n'.join(lines)) > max_tokens:
+        lines.pop(0)
+    return '\n'.join(lines)
+
+
+def build_chat_prompt(initial_assessment, baby_info, summary, recent_history, user_message,
+                      budget=PROMPT_TOKEN_BUDGET):
+    """Assemble the follow-up prompt within a token budget
+
+    The instructions, the question and the baby information are always sent.
+    The initial assessment is capped at a share of the budget, then the
+    rolling summary, and the remaining room is filled with the most recent
+    exchanges, newest first. Returns the prompt and a dict of size stats.
+    """
+    header = [CHAT_HEADER]
+    baby_lines = ['\nBABY INFORMATION:\n']
+    for key, value in (baby_info or {}).items():
+        if value and key != 'hasImage':
+            baby_lines.append(f"• {key}: {value}\n")
+    footer = [f"\nCURRENT USER QUESTION: {user_message}\n", CHAT_INSTRUCTIONS]
+
+    used = estimate_tokens(''.join(header + baby_lines + footer))
+    remaining = max(0, budget - used)
+
+    assessment = truncate_to_tokens(initial_assessment or '', int(remaining * ASSESSMENT_BUDGET_SHARE))
+    assessment_section = f"\nPREVIOUS ASSESSMENT CONTEXT:\n{assessment}\n"
+    remaining = max(0, remaining - estimate_tokens(assessment_section))
+
+    summary_section = ''
+    if summary:
+        summary_text = truncate_to_tokens(summary, min(SUMMARY_TOKEN_BUDGET, remaining))
+        summary_section = f"\nSUMMARY OF EARLIER CONVERSATION:\n{summary_text}\n"
+        remaining = max(0, remaining - estimate_tokens(summary_section))
+
+    # Newest exchanges are the most relevant, so they claim the remaining budget first
+    history_parts = []
+    for exchange in reversed(recent_history):
+        part = f"User: {exchange['user_message']}\nAssistant: {exchange['response']}\n"
+        cost = estimate_tokens(part)
+        if cost > remaining:
+            break
+        history_parts.append(part)
+        remaining -= cost
+    history_parts.reverse()
+
+    prompt = ''.join(
+        header
+        + [assessment_section]
+        + baby_lines
+        + [summary_section, '\nRECENT CHAT HISTORY:\n']
+        + history_parts
+        + footer
+    )
+    stats = {
+        'budget': budget,
+        'estimated_tokens': estimate_tokens(prompt),
+        'history_turns': len(history_parts),
+        'history_dropped': len(recent_history) - len(history_parts),
+        'summary_tokens': estimate_tokens(summary_section),
+        'assessment_truncated': assessment != (initial_assessment or '')
+    }
+    return prompt, stats
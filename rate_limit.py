@@ -0,0 +1,326 @@
+"""Token-bucket rate limiting for the endpoints that call the model
+
+Each rule is a bucket of `burst` tokens refilled at `per_minute` tokens a
+minute, kept per client IP or per session id and shared by every endpoint
+that calls the model. A request takes one token from each bucket it maps
+to and is refused with 429 once any of them is empty. Responses carry
+RateLimit-Limit/-Remaining/-Reset and RateLimit-Policy headers for the
+tightest bucket, plus Retry-After on 429.
+
+MemoryBuckets keep the buckets in the process; SQLiteBuckets keep them in a
+table so every worker of a multi-worker deployment draws from the same
+buckets. Behind a reverse proxy, wrap the app with werkzeug's ProxyFix so
+request.remote_addr is the client and not the proxy.
+"""
+import math
+import os
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from flask import jsonify, make_response, request
+
+from database import thread_connection
+from metrics import span
+
+RATE_LIMIT_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS rate_limit_bucket (
+        key TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated_at REAL NOT NULL,
+        full_at REAL NOT NULL,
+        allowed INTEGER NOT NULL DEFAULT 1
+    ) WITHOUT ROWID''',
+    'CREATE INDEX IF NOT EXISTS ix_rate_limit_bucket_full_at ON rate_limit_bucket (full_at)',
+]
+
+
+class RateLimit:
+    """A bucket of `burst` tokens refilled at `per_minute` tokens a minute, one bucket per key"""
+
+    def __init__(self, name, burst, per_minute):
+        self.name = name
+        self.burst = burst
+        self.per_minute = per_minute
+        self.rate = per_minute / 60.0
+
+    def policy(self):
+        """RateLimit-Policy value: the burst over the window it takes to refill completely"""
+        return f'{self.burst};w={math.ceil(self.burst / self.rate)}'
+
+
+class Decision:
+    """Outcome of taking tokens from one bucket"""
+
+    __slots__ = ('limit', 'allowed', 'remaining', 'retry_after', 'reset')
+
+    def __init__(self, limit, allowed, tokens, cost):
+        self.limit = limit
+        self.allowed = allowed
+        self.remaining = int(tokens)
+        # Seconds until the request could succeed, and until the bucket is full again
+        self.retry_after = 0.0 if allowed else (cost - tokens) / limit.rate
+        self.reset = (limit.burst - tokens) / limit.rate
+
+
+def refill(tokens, updated_at, now, limit):
+    """Tokens in a bucket at `now`, capped at the burst"""
+    return min(limit.burst, tokens + max(0.0, now - updated_at) * limit.rate)
+
+
+class MemoryBuckets:
+    """Buckets in a dict, for a single process
+
+    Buckets that have refilled completely are the same as new ones, so they
+    are swept out once more than `max_keys` are tracked.
+    """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = {}  # key -> [tokens, updated_at, limit]
+        self._lock = threading.Lock()
+
+    def take(self, key, limit, cost=1):
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    self._sweep(now)
+                bucket = self._buckets[key] = [float(limit.burst), now, limit]
+            tokens = refill(bucket[0], bucket[1], now, limit)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            bucket[0], bucket[1] = tokens, now
+        return Decision(limit, allowed, tokens, cost)
+
+    def refund(self, key, limit, cost=1):
+        """Give back tokens taken from a bucket for a request that was refused elsewhere"""
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket[0] = min(limit.burst, bucket[0] + cost)
+
+    def create_schema(self):
+        """Nothing to create for in-process buckets"""
+
+    def _sweep(self, now):
+        full = [key for key, (tokens, updated_at, limit) in self._buckets.items()
+                if refill(tokens, updated_at, now, limit) >= limit.burst]
+        for key in full:
+            del self._buckets[key]
+        # Every bucket is in use: drop the oldest tenth rather than grow without bound
+        if len(self._buckets) >= self.max_keys:
+            oldest = sorted(self._buckets, key=lambda key: self._buckets[key][1])
+            for key in oldest[:len(oldest) // 10 + 1]:
+                del self._buckets[key]
+
+    def status(self):
+        with self._lock:
+            return {'backend': 'memory', 'buckets': len(self._buckets)}
+
+
+class SQLiteBuckets:
+    """Buckets in a SQLite table shared by every worker process
+
+    Each take is a single upsert that refills, decides and debits in one
+    statement, so concurrent workers can't both spend the last token.
+    """
+
+    # Tokens after refilling up to now, and how many this request takes (none if refused)
+    REFILLED = 'MIN(:burst, tokens + MAX(0, :now - updated_at) * :rate)'
+    SPENT = f'CASE WHEN {REFILLED} >= :cost THEN :cost ELSE 0 END'
+    FIRST_SPENT = 'CASE WHEN :burst >= :cost THEN :cost ELSE 0 END'
+    TAKE = (
+        'INSERT INTO rate_limit_bucket (key, tokens, updated_at, full_at, allowed) '
+        f'VALUES (:key, :burst - {FIRST_SPENT}, :now, :now + {FIRST_SPENT} / :rate, :burst >= :cost) '
+        'ON CONFLICT(key) DO UPDATE SET '
+        f'tokens = {REFILLED} - {SPENT}, '
+        f'full_at = :now + (:burst - {REFILLED} + {SPENT}) / :rate, '
+        f'allowed = {REFILLED} >= :cost, '
+        'updated_at = MAX(:now, updated_at) '
+        'RETURNING tokens, allowed'
+    )
+
+    def __init__(self, db_path, purge_interval=300):
+        self.db_path = db_path
+        self.purge_interval = purge_interval
+        self._local = threading.local()
+        self._last_purge = time.time()
+
+    def _connection(self):
+        return thread_connection(self._local, self.db_path)
+
+    def create_schema(self):
+        connection = self._connection()
+        for statement in RATE_LIMIT_SCHEMA:
+            connection.execute(statement)
+
+    def take(self, key, limit, cost=1):
+        # Wall clock, since the buckets are shared between processes
+        now = time.time()
+        tokens, allowed = self._connection().execute(
+            self.TAKE, {'key': key, 'burst': limit.burst, 'rate': limit.rate, 'cost': cost, 'now': now}
+        ).fetchone()
+        if now - self._last_purge > self.purge_interval:
+            self._last_purge = now
+            self.purge()
+        return Decision(limit, bool(allowed), tokens, cost)
+
+    def refund(self, key, limit, cost=1):
+        """Give back tokens taken from a bucket for a request that was refused elsewhere"""
+        self._connection().execute(
+            'UPDATE rate_limit_bucket SET tokens = MIN(:burst, tokens + :cost), '
+            'full_at = updated_at + (:burst - MIN(:burst, tokens + :cost)) / :rate WHERE key = :key',
+            {'key': key, 'burst': limit.burst, 'rate': limit.rate, 'cost': cost}
+        )
+
+    def purge(self):
+        """Delete buckets that have refilled completely, which are the same as missing ones"""
+        try:
+            self._connection().execute('DELETE FROM rate_limit_bucket WHERE full_at < ?', (time.time(),))
+        except sqlite3.Error as e:
+            print(f"Error purging rate limit buckets: {e}")
+
+    def status(self):
+        row = self._connection().execute('SELECT COUNT(*) FROM rate_limit_bucket').fetchone()
+        return {'backend': 'sqlite', 'buckets': row[0], 'db_path': self.db_path}
+
+
+class RateLimiter:
+    """Applies the per-IP and per-session limits to a request"""
+
+    def __init__(self, buckets, per_ip=None, per_session=None, enabled=True):
+        self.buckets = buckets
+        self.per_ip = per_ip
+        self.per_session = per_session
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.counters = {'allowed': 0, 'limited': 0, 'errors': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def check(self, ip, session_id=None, cost=1):
+        """The decision for the tightest bucket this request maps to, or None when nothing applies
+
+        A refused request uses up none of its tokens: it stops at the first
+        bucket that refuses and gives back what the buckets before it took. A
+        cost above a bucket's burst takes the whole burst, so large requests
+        can still get through.
+        """
+        rules = []
+        if self.per_ip and ip:
+            rules.append((self.per_ip, ip))
+        if self.per_session and session_id:
+            rules.append((self.per_session, session_id))
+        tightest = None
+        taken = []
+        for limit, value in rules:
+            key, amount = f'{limit.name}:{value}', min(cost, limit.burst)
+            decision = self.buckets.take(key, limit, amount)
+            if not decision.allowed:
+                for bucket in taken:
+                    self.buckets.refund(*bucket)
+                self._count('limited')
+                return decision
+            taken.append((key, limit, amount))
+            if tightest is None or decision.remaining < tightest.remaining:
+                tightest = decision
+        if tightest is not None:
+            self._count('allowed')
+        return tightest
+
+    def status(self):
+        with self._lock:
+            counters = dict(self.counters)
+        return dict(counters, enabled=self.enabled, **self.buckets.status(), limits={
+            limit.name: {'burst': limit.burst, 'per_minute': limit.per_minute}
+            for limit in (self.per_ip, self.per_session) if limit
+        })
+
+    def register_metrics(self, registry):
+        registry.counter('rate_limit_decisions_total', 'Requests allowed or refused by the rate limiter',
+                         ['decision'], function=lambda: {(name,): value for name, value in self.counters.items()})
+
+
+def set_headers(response, decision):
+    # One extend instead of four assignments, each of which scans the headers for an old value
+    response.headers.extend((
+        ('RateLimit-Limit', str(decision.limit.burst)),
+        ('RateLimit-Remaining', str(max(0, decision.remaining))),
+        ('RateLimit-Reset', str(math.ceil(decision.reset))),
+        ('RateLimit-Policy', decision.limit.policy())
+    ))
+    return response
+
+
+def request_session_id():
+    """session_id from a JSON body or the query string, without parsing uploads"""
+    if request.is_json:
+        data = request.get_json(silent=True)
+        if isinstance(data, dict) and data.get('session_id'):
+            return str(data['session_id'])
+    return request.args.get('session_id')
+
+
+def rate_limited(limiter, cost=None):
+    """Decorator: refuse a view's requests with 429 once their IP or session runs out of tokens
+
+    `cost` is an optional function of the request returning how many tokens
+    it takes (e.g. one per item of a batch). If the shared backend fails,
+    requests are let through rather than taking the endpoint down with it.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not limiter.enabled:
+                return view(*args, **kwargs)
+            try:
+                with span('rate_limit'):
+                    decision = limiter.check(request.remote_addr, request_session_id(), cost() if cost else 1)
+            except sqlite3.Error as e:
+                limiter._count('errors')
+                print(f"Error checking rate limit: {e}")
+                decision = None
+            if decision is None:
+                return view(*args, **kwargs)
+            if not decision.allowed:
+                response = jsonify({'error': 'Too many requests, please slow down', 'success': False})
+                response.status_code = 429
+                response.headers['Retry-After'] = str(max(1, math.ceil(decision.retry_after)))
+                return set_headers(response, decision)
+            return set_headers(make_response(view(*args, **kwargs)), decision)
+        return wrapper
+    return decorator
+
+
+def create_rate_limiter(db_path=None):
+    """Build the limiter from the RATE_LIMIT_* settings
+
+    RATE_LIMIT_BACKEND is 'memory' (default) or 'sqlite', which keeps the
+    buckets in RATE_LIMIT_DB_PATH (or db_path). Set a burst to 0 to turn
+    that limit off, or RATE_LIMIT_ENABLED=0 to turn both off.
+    """
+    backend = os.getenv('RATE_LIMIT_BACKEND', 'memory')
+    if backend == 'memory':
+        buckets = MemoryBuckets(max_keys=int(os.getenv('RATE_LIMIT_MAX_KEYS', 100000)))
+    elif backend == 'sqlite':
+        buckets = SQLiteBuckets(os.getenv('RATE_LIMIT_DB_PATH') or db_path)
+    else:
+        raise ValueError(f'Unknown rate limit backend: {backend}')
+
+    def limit(name, burst, per_minute):
+        burst = int(os.getenv(f'RATE_LIMIT_{name.upper()}_BURST', burst))
+        per_minute = float(os.getenv(f'RATE_LIMIT_{name.upper()}_PER_MINUTE', per_minute))
+        return RateLimit(name, burst, per_minute) if burst > 0 and per_minute > 0 else None
+
+    return RateLimiter(
+        buckets,
+        per_ip=limit('ip', 20, 10),
+        per_session=limit('session', 10, 6),
+        enabled=os.getenv('RATE_LIMIT_ENABLED', '1').lower() not in ('0', 'false', 'no')
+    )
@@ -0,0 +1,190 @@
+"""Confidence ratings like "[82% match]" parsed out of model responses
+
+Responses are parsed once when they are written (see
+SQLiteSessionStore.write_batch) into the response_rating table, so
+aggregate questions are index queries instead of regexes over every
+response_text. Rows written before the table existed are filled in by the
+backfill:
+
+    python ratings.py backfill --db instance/baby_health_data.db
+"""
+import argparse
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from database import RATING_SCHEMA, apply_sqlite_pragmas
+
+# Assessments are four sections separated by lines holding a backslash (see the assessment prompt)
+ASSESSMENT_SECTIONS = ('assessment', 'explanation', 'warning_signs', 'care')
+
+RATING_PATTERN = re.compile(
+    r'\[\s*(\d{1,3}(?:\.\d+)?)\s*%\s*([a-z]*)[^\]]*\]', re.IGNORECASE)
+RATING_KINDS = {
+    'match': 'match', 'likely': 'likely', 'likelihood': 'likely', 'probability': 'likely',
+    'chance': 'likely', 'confidence': 'confidence', 'confident': 'confidence', 'certainty': 'confidence'
+}
+# Lead-ins before the condition itself ("The pattern suggests a viral infection")
+LEAD_IN = re.compile(
+    r'^.*?\b(?:appears? to be|looks? like|suggests?|suggesting|indicates?|indicating|consistent with|'
+    r'could be|might be|may be|is likely|possibly|probably|possible|probable|likely|suspected)\s+',
+    re.IGNORECASE)
+# Explanations read "Diaper rash is common ..."; the condition is the subject
+PREDICATE = re.compile(r'\s+(?:is|are|can|may|often|usually|typically|tends?)\s+.*$', re.IGNORECASE)
+ARTICLE = re.compile(r'^(?:(?:or|and|versus|vs\.?|a|an|the|this|that|your baby\'s|baby\'s)\s+)+', re.IGNORECASE)
+MAX_CONDITION_LENGTH = 120
+
+
+def split_sections(response_text, response_type):
+    """(section, text) pairs: the four assessment sections, or the whole text as 'chat'"""
+    if response_type != 'assessment':
+        return [('chat', response_text)]
+    parts = response_text.split('\\')
+    return [(ASSESSMENT_SECTIONS[min(i, len(ASSESSMENT_SECTIONS) - 1)], part) for i, part in enumerate(parts)]
+
+
+def condition_phrase(text):
+    """Condition named by the text around a rating, without bullets, markup and lead-ins"""
+    text = re.sub(r'[*_`#>]+|\([^)]*\)?', '', text)
+    text = re.split(r'[:;.!?]\s|\s[-–—]\s', text)[-1]
+    text = text.strip(' \t-•,.:;"\'')
+    text = LEAD_IN.sub('', text)
+    text = PREDICATE.sub('', text)
+    text = ARTICLE.sub('', text)
+    text = re.sub(r'\s+', ' ', text).strip(' ,.:;"\'')
+    return text[:MAX_CONDITION_LENGTH]
+
+
+def condition_key(condition):
+    """Normalized form of a condition phrase used for grouping"""
+    return re.sub(r'\s+', ' ', re.sub(r'[^a-z0-9 ]+', ' ', condition.lower())).strip()
+
+
+def extract_ratings(response_text, response_type):
+    """Every [NN% kind] rating in a response with its section and condition phrase"""
+    ratings = []
+    for section, section_text in split_sections(response_text or '', response_type):
+        for line in section_text.splitlines():
+            matches = list(RATING_PATTERN.finditer(line))
+            for i, match in enumerate(matches):
+                percent = float(match.group(1))
+                if percent > 100:
+                    continue
+                # The condition is written before its rating, after any earlier rating on the line
+                start = matches[i - 1].end() if i else 0
+                condition = condition_phrase(line[start:match.start()])
+                if not condition:
+                    end = matches[i + 1].start() if i + 1 < len(matches) else len(line)
+                    condition = condition_phrase(line[match.end():end])
+                ratings.append({
+                    'section': section,
+                    'condition': condition or None,
+                    'condition_key': condition_key(condition) if condition else None,
+                    'percent': percent,
+                    'kind': RATING_KINDS.get(match.group(2).lower(), 'unspecified')
+                })
+    return ratings
+
+
+def insert_ratings(connection, response):
+    """Insert the ratings of a stored response (a dict with its id) on a sqlite3 connection"""
+    ratings = extract_ratings(response['response_text'], response['response_type'])
+    created_at = response['created_at']
+    if isinstance(created_at, datetime):
+        created_at = created_at.strftime('%Y-%m-%d %H:%M:%S.%f')
+    connection.executemany(
+        'INSERT INTO response_rating (response_id, session_id, response_type, section, condition, '
+        'condition_key, percent, kind, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        [
+            (response['id'], response['session_id'], response['response_type'], rating['section'],
+             rating['condition'], rating['condition_key'], rating['percent'], rating['kind'], created_at)
+            for rating in ratings
+        ]
+    )
+    return len(ratings)
+
+
+class RatingBackfill:
+    """Parse ratings for responses stored before extraction existed, in the background
+
+    Works through chat_response by id in short transactions, replacing any
+    ratings already stored for each batch, so it is safe to rerun.
+    """
+
+    def __init__(self, db_path, batch_size=500, batch_pause=0.05):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self._thread = None
+        self.running = False
+        self.last_id = 0
+        self.status_info = {'responses': 0, 'ratings': 0, 'started_at': None, 'finished_at': None, 'error': None}
+
+    def start(self, after_id=0):
+        """Run the backfill on a background thread unless one is already running"""
+        if self._thread and self._thread.is_alive():
+            return False
+        self._thread = threading.Thread(target=self.run, args=(after_id,), name='rating-backfill', daemon=True)
+        self._thread.start()
+        return True
+
+    def run(self, after_id=0):
+        self.running = True
+        self.last_id = after_id
+        self.status_info = {'responses': 0, 'ratings': 0, 'started_at': datetime.now().isoformat(),
+                            'finished_at': None, 'error': None}
+        connection = sqlite3.connect(self.db_path, timeout=15)
+        connection.row_factory = sqlite3.Row
+        apply_sqlite_pragmas(connection)
+        try:
+            for statement in RATING_SCHEMA:
+                connection.execute(statement)
+            # Rows written after this point are rated at write time
+            until = connection.execute('SELECT MAX(id) FROM chat_response').fetchone()[0] or 0
+            while self.last_id < until:
+                rows = connection.execute(
+                    'SELECT id, session_id, response_type, response_text, created_at FROM chat_response '
+                    'WHERE id > ? AND id <= ? ORDER BY id LIMIT ?',
+                    (self.last_id, until, self.batch_size)
+                ).fetchall()
+                if not rows:
+                    break
+                with connection:
+                    ids = [row['id'] for row in rows]
+                    connection.execute(
+                        f"DELETE FROM response_rating WHERE response_id IN ({','.join('?' * len(ids))})", ids)
+                    for row in rows:
+                        self.status_info['ratings'] += insert_ratings(connection, dict(row))
+                self.status_info['responses'] += len(rows)
+                self.last_id = ids[-1]
+                time.sleep(self.batch_pause)
+        except Exception as e:
+            self.status_info['error'] = str(e)
+            print(f"Error backfilling ratings: {e}")
+        finally:
+            connection.close()
+            self.running = False
+            self.status_info['finished_at'] = datetime.now().isoformat()
+        print(f"Backfilled {self.status_info['ratings']} ratings from {self.status_info['responses']} responses")
+        return self.status()
+
+    def status(self):
+        return dict(self.status_info, running=self.running, last_response_id=self.last_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    backfill_parser = subparsers.add_parser('backfill', help='Parse ratings for already stored responses')
+    backfill_parser.add_argument('--db', default='instance/baby_health_data.db')
+    backfill_parser.add_argument('--after-id', type=int, default=0, help='Resume after this chat_response id')
+    backfill_parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    RatingBackfill(args.db, batch_size=args.batch_size, batch_pause=0).run(args.after_id)
+
+
+if __name__ == '__main__':
+    main()
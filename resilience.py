@@ -0,0 +1,355 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Upstream failures worth another attempt: rate limits, overload and server-side errors
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+RETRYABLE_ERROR_NAMES = {
+    'ResourceExhausted', 'TooManyRequests', 'ServiceUnavailable', 'InternalServerError',
+    'DeadlineExceeded', 'Aborted', 'GatewayTimeout', 'BadGateway',
+    'ConnectionError', 'TimeoutError', 'ModelTimeoutError',
+}
+
+
+class UpstreamError(Exception):
+    """Base error for model calls the resilience layer gave up on"""
+    status_code = 503
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(UpstreamError):
+    """Raised without calling the model while the circuit breaker is open"""
+    status_code = 503
+
+
+class ModelTimeoutError(UpstreamError):
+    """Raised when a call does not finish within its deadline"""
+    status_code = 504
+
+
+def is_retryable(error):
+    """Whether an exception from generate_content is likely to succeed on a later attempt"""
+    # google.api_core errors carry the HTTP status as `code`
+    if getattr(error, 'code', None) in RETRYABLE_STATUS_CODES:
+        return True
+    return any(cls.__name__ in RETRYABLE_ERROR_NAMES for cls in type(error).__mro__)
+
+
+def gave_up(error):
+    """The error to raise once retries are exhausted: upstream failures become a 503 UpstreamError"""
+    if isinstance(error, UpstreamError):
+        return error
+    failure = UpstreamError(f'Model upstream failed: {error}', retry_after=1)
+    failure.__cause__ = error
+    return failure
+
+
+class CircuitBreaker:
+    """Stop calling an unhealthy upstream for a while
+
+    After `failure_threshold` consecutive retryable failures the breaker
+    opens and calls fail fast for `reset_timeout` seconds. Then one trial
+    call is let through (half-open): success closes the breaker, failure
+    opens it again.
+    """
+
+    STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+        self.counters = {'opened': 0, 'short_circuited': 0}
+
+    def allow(self):
+        """Raise CircuitOpenError unless a call may go ahead now"""
+        with self._lock:
+            if self.state == 'open':
+                waited = time.monotonic() - self.opened_at
+                if waited < self.reset_timeout:
+                    self.counters['short_circuited'] += 1
+                    raise CircuitOpenError('Model upstream is unavailable',
+                                           retry_after=max(1, round(self.reset_timeout - waited)))
+                self.state = 'half_open'
+                self._trial_running = False
+            if self.state == 'half_open':
+                if self._trial_running:
+                    self.counters['short_circuited'] += 1
+                    raise CircuitOpenError('Model upstream is recovering', retry_after=1)
+                self._trial_running = True
+
+    def check(self):
+        """Raise CircuitOpenError if allow() would, without taking the half-open trial"""
+        with self._lock:
+            if self.state == 'open':
+                waited = time.monotonic() - self.opened_at
+                if waited < self.reset_timeout:
+                    self.counters['short_circuited'] += 1
+                    raise CircuitOpenError('Model upstream is unavailable',
+                                           retry_after=max(1, round(self.reset_timeout - waited)))
+            elif self.state == 'half_open' and self._trial_running:
+                self.counters['short_circuited'] += 1
+                raise CircuitOpenError('Model upstream is recovering', retry_after=1)
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.consecutive_failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self._trial_running = False
+            if self.state == 'half_open' or self.consecutive_failures >= self.failure_threshold:
+                if self.state != 'open':
+                    self.counters['opened'] += 1
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def record_ignored(self):
+        """A call finished with an error that says nothing about upstream health"""
+        with self._lock:
+            self._trial_running = False
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters, state=self.state, consecutive_failures=self.consecutive_failures)
+
+
+class ResilientModel:
+    """Wrap a model's generate_content with deadlines, retries, hedging and a circuit breaker
+
+    Blocking calls get an overall `deadline` (or the one passed to
+    generate_content, e.g. what is left of the LLM pool's), each attempt at
+    most `attempt_timeout` of it. Retryable failures are retried up to
+    `max_retries` times with full-jitter exponential backoff. With
+    `hedge_after` set (seconds, or 'p95' for the observed 95th percentile
+    latency) a second identical call is started when the first is slower
+    than that, and whichever answers first wins. Streaming calls are
+    retried only until the first chunk arrives and are never hedged.
+
+    Pass `model_factory` instead of `model` to build the client on first
+    use, so importing the app doesn't pay for the provider SDK.
+    """
+
+    def __init__(self, model=None, deadline=60.0, attempt_timeout=None, max_retries=2, backoff_base=0.5,
+                 backoff_max=8.0, hedge_after=None, breaker=None, max_threads=32, model_factory=None):
+        self.model = model
+        self.model_factory = model_factory
+        self._build_lock = threading.Lock()
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout or deadline
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_after = hedge_after
+        self.breaker = breaker or CircuitBreaker()
+        self._executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix='llm-call')
+        self._latencies = deque(maxlen=200)
+        self._lock = threading.Lock()
+        self.counters = {'calls': 0, 'retries': 0, 'hedges': 0, 'hedge_wins': 0, 'timeouts': 0, 'failures': 0}
+
+    def client(self):
+        """The wrapped model, built by model_factory the first time it is needed"""
+        if self.model is None:
+            with self._build_lock:
+                if self.model is None:
+                    self.model = self.model_factory()
+        return self.model
+
+    def warm(self):
+        """Build the client on a background thread, off the request path
+
+        A call arriving before it is done waits for the same build.
+        """
+        def build():
+            try:
+                self.client()
+            except Exception as e:
+                print(f"Error creating model client: {e}")
+        threading.Thread(target=build, name='model-client', daemon=True).start()
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def backoff(self, attempt):
+        """Full jitter: a random wait up to the exponential cap for this attempt"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def hedge_delay(self):
+        """Seconds to wait before hedging, or None when hedging is off or not yet calibrated"""
+        if not self.hedge_after:
+            return None
+        if self.hedge_after != 'p95':
+            return float(self.hedge_after)
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < 20:
+            return None
+        return samples[int(len(samples) * 0.95) - 1]
+
+    def generate_content(self, model_input, stream=False, deadline=None, **kwargs):
+        """Call the model; `deadline` (seconds from now) overrides the configured one"""
+        self._count('calls')
+        expires_at = time.monotonic() + (self.deadline if deadline is None else deadline)
+        if stream:
+            return self._stream(model_input, kwargs, expires_at)
+        return self._call(model_input, kwargs, expires_at)
+
+    def _call(self, model_input, kwargs, expires_at):
+        attempt = 0
+        while True:
+            self.breaker.allow()
+            remaining = expires_at - time.monotonic()
+            try:
+                response = self._attempt(model_input, kwargs, min(self.attempt_timeout, remaining))
+            except Exception as e:
+                if not is_retryable(e):
+                    self.breaker.record_ignored()
+                    raise
+                self.breaker.record_failure()
+                delay = self.backoff(attempt)
+                if attempt >= self.max_retries or time.monotonic() + delay >= expires_at:
+                    self._count('failures')
+                    raise gave_up(e)
+                attempt += 1
+                self._count('retries')
+                time.sleep(delay)
+                continue
+            self.breaker.record_success()
+            return response
+
+    def _attempt(self, model_input, kwargs, timeout):
+        """One attempt, hedged with a duplicate call if the first is slower than the hedge delay"""
+        if timeout <= 0:
+            self._count('timeouts')
+            raise ModelTimeoutError('Model call exceeded its deadline')
+        kwargs = dict(kwargs, request_options=dict(kwargs.get('request_options') or {}, timeout=timeout))
+        started = {}
+
+        def submit():
+            future = self._executor.submit(self.client().generate_content, model_input, **kwargs)
+            started[future] = time.monotonic()
+            return future
+
+        primary = submit()
+        pending = {primary}
+        expires_at = time.monotonic() + timeout
+        hedge_delay = self.hedge_delay()
+        if hedge_delay is not None and hedge_delay < timeout:
+            done, _ = wait(pending, timeout=hedge_delay)
+            if not done and self.breaker.state == 'closed':
+                pending.add(submit())
+                self._count('hedges')
+
+        error = None
+        while pending:
+            remaining = expires_at - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    with self._lock:
+                        self._latencies.append(time.monotonic() - started[future])
+                    if future is not primary:
+                        self._count('hedge_wins')
+                    return future.result()
+                error = future.exception()
+        if error is not None and not pending:
+            raise error
+        # Abandoned calls finish in the background; the upstream timeout above bounds them
+        self._count('timeouts')
+        raise ModelTimeoutError('Model call exceeded its deadline')
+
+    def _stream(self, model_input, kwargs, expires_at):
+        # Checked before the generator is returned so the caller can still answer with a 503;
+        # the trial call itself is only taken once the stream is iterated
+        self.breaker.check()
+        return self._stream_chunks(model_input, kwargs, expires_at)
+
+    def _stream_chunks(self, model_input, kwargs, expires_at):
+        attempt = 0
+        while True:
+            self.breaker.allow()
+            try:
+                chunks = iter(self.client().generate_content(model_input, stream=True, **kwargs))
+                first = next(chunks, None)
+            except Exception as e:
+                if not is_retryable(e):
+                    self.breaker.record_ignored()
+                    raise
+                self.breaker.record_failure()
+                delay = self.backoff(attempt)
+                if attempt >= self.max_retries or time.monotonic() + delay >= expires_at:
+                    self._count('failures')
+                    raise gave_up(e)
+                attempt += 1
+                self._count('retries')
+                time.sleep(delay)
+                continue
+            break
+
+        # Text has reached the client from here on, so a failure can no longer be retried
+        outcome = None
+        try:
+            if first is not None:
+                yield first
+            yield from chunks
+            outcome = 'success'
+        except Exception as e:
+            outcome = 'failure' if is_retryable(e) else None
+            raise
+        finally:
+            # A stream closed early (client gone, pool deadline) says nothing about upstream health,
+            # but it must still end a half-open trial
+            if outcome == 'success':
+                self.breaker.record_success()
+            elif outcome == 'failure':
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_ignored()
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self.counters)
+        return dict(counters, breaker=self.breaker.snapshot(), hedge_delay_seconds=self.hedge_delay())
+
+    def register_metrics(self, registry):
+        """Expose breaker state and retry/hedge counters on a metrics registry"""
+        registry.gauge('llm_circuit_state', 'Circuit breaker state (0 closed, 1 half open, 2 open)',
+                       function=lambda: CircuitBreaker.STATES[self.breaker.state])
+        registry.counter('llm_circuit_events_total', 'Times the breaker opened or failed a call fast', ['event'],
+                         function=lambda: {(name,): value for name, value in self.breaker.counters.items()})
+        registry.counter('llm_call_events_total', 'Model calls, retries, hedges and timeouts', ['event'],
+                         function=lambda: {(name,): value for name, value in self.counters.items()})
+
+
+def create_resilient_model(model=None, model_factory=None):
+    """Wrap model (or the one model_factory builds on first use) using the LLM_* settings"""
+    hedge_after = os.getenv('LLM_HEDGE_AFTER', '')
+    return ResilientModel(
+        model,
+        model_factory=model_factory,
+        deadline=float(os.getenv('LLM_DEADLINE_SECONDS', 60)),
+        attempt_timeout=float(os.getenv('LLM_ATTEMPT_TIMEOUT_SECONDS', 0)) or None,
+        max_retries=int(os.getenv('LLM_MAX_RETRIES', 2)),
+        backoff_base=float(os.getenv('LLM_BACKOFF_BASE_SECONDS', 0.5)),
+        hedge_after=hedge_after if hedge_after in ('', 'p95') else float(hedge_after),
+        breaker=CircuitBreaker(
+            failure_threshold=int(os.getenv('LLM_BREAKER_THRESHOLD', 5)),
+            reset_timeout=float(os.getenv('LLM_BREAKER_RESET_SECONDS', 30))
+        )
+    )
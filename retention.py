@@ -0,0 +1,142 @@
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+
+class RetentionWorker:
+    """Background thread that deletes expired chat sessions in small batches
+
+    Each batch is its own short transaction, so the SQLite write lock is only
+    held for a few milliseconds at a time and request threads can interleave
+    their own writes between batches. `before_batch` callbacks run before each
+    batch is selected, e.g. to flush buffered session writes so a session
+    resumed moments ago isn't taken for an expired one. `before_delete`
+    callbacks (e.g. the archiver) see each batch of session ids first, inside
+    the batch's transaction; if one raises, the batch is left in place and
+    retried on the next run.
+    """
+
+    def __init__(self, app, db, session_model, response_model,
+                 ttl_days=7, interval=3600, batch_size=500, batch_pause=0.05, before_batch=None, before_delete=None,
+                 on_deleted=None):
+        self.app = app
+        self.db = db
+        self.session_model = session_model
+        self.response_model = response_model
+        self.ttl = timedelta(days=ttl_days)
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.before_batch = list(before_batch or [])  # Called with no arguments before each batch is selected
+        self.before_delete = list(before_delete or [])  # Called with each batch of session ids to be deleted
+        self.on_deleted = list(on_deleted or [])  # Called with each batch of deleted session ids
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+        self.running = False
+        self.last_run = None
+        self.recent_runs = deque(maxlen=10)
+        self.totals = {'runs': 0, 'sessions_deleted': 0, 'responses_deleted': 0, 'errors': 0}
+
+    def start(self):
+        """Start the worker thread if it isn't running yet"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._loop, name='retention-worker', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def trigger(self):
+        """Ask the worker to run now instead of waiting for the next interval"""
+        self._wake.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self.run_once()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def _delete_batch(self, cutoff):
+        """Delete one batch of expired sessions and their responses in a single short transaction"""
+        Session, Response = self.session_model, self.response_model
+        for callback in self.before_batch:
+            callback()
+        session_ids = [
+            row.session_id for row in self.db.session.query(Session.session_id)
+            .filter(Session.last_activity < cutoff)
+            .limit(self.batch_size)
+        ]
+        if not session_ids:
+            return 0, 0
+
+        for callback in self.before_delete:
+            callback(session_ids)
+
+        # Delete old responses first (due to foreign key constraint)
+        responses = Response.query.filter(Response.session_id.in_(session_ids)).delete(synchronize_session=False)
+        sessions = Session.query.filter(Session.session_id.in_(session_ids)).delete(synchronize_session=False)
+        self.db.session.commit()
+
+        for callback in self.on_deleted:
+            callback(session_ids)
+        return sessions, responses
+
+    def run_once(self):
+        """Delete every session idle for longer than the TTL, one batch at a time"""
+        with self._lock:
+            self.running = True
+            started_at = datetime.now()
+            start = time.perf_counter()
+            cutoff = started_at - self.ttl
+            run = {'started_at': started_at.isoformat(), 'sessions_deleted': 0,
+                   'responses_deleted': 0, 'batches': 0, 'error': None}
+
+            with self.app.app_context():
+                try:
+                    while not self._stop.is_set():
+                        sessions, responses = self._delete_batch(cutoff)
+                        if not sessions:
+                            break
+                        run['batches'] += 1
+                        run['sessions_deleted'] += sessions
+                        run['responses_deleted'] += responses
+                        time.sleep(self.batch_pause)
+                except Exception as e:
+                    self.db.session.rollback()
+                    run['error'] = str(e)
+                    self.totals['errors'] += 1
+                    print(f"Error during cleanup: {e}")
+                finally:
+                    self.db.session.remove()
+
+            run['duration_ms'] = round((time.perf_counter() - start) * 1000, 1)
+            self.totals['runs'] += 1
+            self.totals['sessions_deleted'] += run['sessions_deleted']
+            self.totals['responses_deleted'] += run['responses_deleted']
+            self.last_run = run
+            self.recent_runs.append(run)
+            self.running = False
+
+        print(f"Cleaned up {run['sessions_deleted']} sessions and {run['responses_deleted']} responses "
+              f"in {run['batches']} batches ({run['duration_ms']} ms)")
+        return run
+
+    def status(self):
+        """Current configuration, last run and lifetime totals"""
+        return {
+            'alive': bool(self._thread and self._thread.is_alive()),
+            'running': self.running,
+            'ttl_days': self.ttl.days,
+            'interval_seconds': self.interval,
+            'batch_size': self.batch_size,
+            'last_run': self.last_run,
+            'recent_runs': list(self.recent_runs),
+            'totals': dict(self.totals)
+        }
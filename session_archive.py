@@ -0,0 +1,225 @@
+"""Cold storage for expired chat sessions as compressed, date-partitioned JSONL
+
+Layout: <root>/<YYYY-MM-DD>/sessions-<HHMMSS>-<id>.jsonl.gz (or .jsonl.zst),
+partitioned by the day the session was created. Each line is one session
+with its responses nested under "responses". Files are written to a
+temporary name, fsynced and renamed, so a crash never leaves a partial file
+behind and rows are only deleted from SQLite once their archive is durable.
+
+Scan archives from the command line without loading them into memory:
+
+    python session_archive.py list
+    python session_archive.py scan --since 2025-08-01 --contains rash --count
+"""
+import argparse
+import gzip
+import io
+import json
+import os
+import sys
+import uuid
+from datetime import date, datetime
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+EXTENSIONS = {'gzip': '.jsonl.gz', 'zstd': '.jsonl.zst'}
+
+
+def available_codec(codec):
+    """The codec to write with: zstd needs the zstandard package, otherwise gzip"""
+    if codec == 'zstd' and zstandard is None:
+        print("zstandard is not installed, archiving with gzip instead")
+        return 'gzip'
+    if codec not in EXTENSIONS:
+        raise ValueError(f'Unknown archive codec: {codec}')
+    return codec
+
+
+def _timestamp(value):
+    return value.isoformat() if value else None
+
+
+def session_record(session, responses):
+    """JSON-ready archive record for a ChatSession row and its ChatResponse rows"""
+    return {
+        'session_id': session.session_id,
+        'created_at': _timestamp(session.created_at),
+        'last_activity': _timestamp(session.last_activity),
+        'baby_info': session.baby_info,
+        'initial_assessment': session.initial_assessment,
+        'conversation_summary': session.conversation_summary,
+        'responses': [
+            {
+                'id': response.id,
+                'response_type': response.response_type,
+                'user_message': response.user_message,
+                'response_text': response.response_text,
+                'created_at': _timestamp(response.created_at)
+            }
+            for response in responses
+        ]
+    }
+
+
+class SessionArchive:
+    """Writes batches of session records into the partitioned archive under `root`"""
+
+    def __init__(self, root, codec='gzip', level=None):
+        self.root = root
+        self.codec = available_codec(codec)
+        self.level = level
+        self.totals = {'files': 0, 'sessions': 0, 'bytes': 0}
+
+    def _open(self, path):
+        raw = open(path, 'wb')
+        if self.codec == 'zstd':
+            compressor = zstandard.ZstdCompressor(level=self.level or 10)
+            return raw, compressor.stream_writer(raw, closefd=False)
+        return raw, gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=self.level or 6)
+
+    def write(self, records):
+        """Archive records (dicts from session_record) and return the paths written
+
+        Only returns once every file is fsynced, so callers can delete the
+        rows afterwards. Raises on any I/O error, leaving no partial files.
+        """
+        archived_at = datetime.now()
+        partitions = {}
+        for record in records:
+            day = (record['created_at'] or record['last_activity'] or archived_at.isoformat())[:10]
+            partitions.setdefault(day, []).append(record)
+
+        paths = []
+        for day, day_records in sorted(partitions.items()):
+            directory = os.path.join(self.root, day)
+            os.makedirs(directory, exist_ok=True)
+            name = f"sessions-{archived_at:%H%M%S}-{uuid.uuid4().hex[:8]}{EXTENSIONS[self.codec]}"
+            path = os.path.join(directory, name)
+            temp_path = path + '.tmp'
+            raw, stream = self._open(temp_path)
+            try:
+                for record in day_records:
+                    line = json.dumps(dict(record, archived_at=archived_at.isoformat()), ensure_ascii=False)
+                    stream.write(line.encode('utf-8') + b'\n')
+                stream.close()
+                raw.flush()
+                os.fsync(raw.fileno())
+            except Exception:
+                raw.close()
+                os.remove(temp_path)
+                raise
+            raw.close()
+            os.replace(temp_path, path)
+            paths.append(path)
+            self.totals['files'] += 1
+            self.totals['sessions'] += len(day_records)
+            self.totals['bytes'] += os.path.getsize(path)
+        return paths
+
+    def status(self):
+        return dict(self.totals, root=self.root, codec=self.codec)
+
+
+def _parse_day(value):
+    if value is None or isinstance(value, date):
+        return value
+    return date.fromisoformat(value[:10])
+
+
+def archive_files(root, since=None, until=None):
+    """Archive file paths in date order, skipping partitions outside [since, until]"""
+    since, until = _parse_day(since), _parse_day(until)
+    if not os.path.isdir(root):
+        return
+    for day in sorted(os.listdir(root)):
+        try:
+            partition = date.fromisoformat(day)
+        except ValueError:
+            continue
+        if (since and partition < since) or (until and partition > until):
+            continue
+        directory = os.path.join(root, day)
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(tuple(EXTENSIONS.values())):
+                yield os.path.join(directory, name)
+
+
+def read_file(path):
+    """Yield the records in one archive file, decompressing as it goes"""
+    if path.endswith(EXTENSIONS['zstd']):
+        if zstandard is None:
+            raise RuntimeError(f'zstandard is required to read {path}')
+        with open(path, 'rb') as raw:
+            reader = zstandard.ZstdDecompressor().stream_reader(raw)
+            for line in io.TextIOWrapper(reader, encoding='utf-8'):
+                yield json.loads(line)
+    else:
+        with gzip.open(path, 'rt', encoding='utf-8') as lines:
+            for line in lines:
+                yield json.loads(line)
+
+
+def scan(root, since=None, until=None, session_id=None, response_type=None, contains=None):
+    """Yield archived sessions matching every given filter, one file at a time
+
+    `since`/`until` are inclusive days (date or 'YYYY-MM-DD') on created_at,
+    `response_type` keeps only responses of that type (and sessions that
+    have one), and `contains` is a case-insensitive search of the
+    assessment and conversation text.
+    """
+    needle = contains.lower() if contains else None
+    for path in archive_files(root, since, until):
+        for record in read_file(path):
+            if session_id and record['session_id'] != session_id:
+                continue
+            if response_type:
+                responses = [r for r in record['responses'] if r['response_type'] == response_type]
+                if not responses:
+                    continue
+                record = dict(record, responses=responses)
+            if needle:
+                texts = [record.get('initial_assessment') or '']
+                texts += [f"{r.get('user_message') or ''}\n{r['response_text']}" for r in record['responses']]
+                if not any(needle in text.lower() for text in texts):
+                    continue
+            yield record
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    list_parser = subparsers.add_parser('list', help='Show partitions with their file counts and sizes')
+    scan_parser = subparsers.add_parser('scan', help='Print matching sessions as JSONL')
+    for sub in (list_parser, scan_parser):
+        sub.add_argument('--root', default=os.getenv('ARCHIVE_DIR', os.path.join('instance', 'archive')))
+        sub.add_argument('--since', help='First day to include (YYYY-MM-DD)')
+        sub.add_argument('--until', help='Last day to include (YYYY-MM-DD)')
+    scan_parser.add_argument('--session', help='Only this session id')
+    scan_parser.add_argument('--type', dest='response_type', choices=['assessment', 'chat'])
+    scan_parser.add_argument('--contains', help='Case-insensitive text search')
+    scan_parser.add_argument('--count', action='store_true', help='Only print the number of matches')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        partitions = {}
+        for path in archive_files(args.root, args.since, args.until):
+            day = os.path.basename(os.path.dirname(path))
+            files, size = partitions.get(day, (0, 0))
+            partitions[day] = (files + 1, size + os.path.getsize(path))
+        for day, (files, size) in partitions.items():
+            print(f"{day}  {files:5d} files  {size / 1024:10.1f} KB")
+        return
+
+    matches = scan(args.root, args.since, args.until, args.session, args.response_type, args.contains)
+    if args.count:
+        print(sum(1 for _ in matches))
+        return
+    for record in matches:
+        sys.stdout.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+if __name__ == '__main__':
+    main()
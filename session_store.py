@@ -0,0 +1,590 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from database import SQLITE_SCHEMA, thread_connection
+from ratings import insert_ratings
+
+# Same text format SQLAlchemy uses for SQLite DateTime columns, so both can read each other's rows
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def new_session(session_id, baby_info=None):
+    """A fresh session record in the shape every store returns"""
+    now = datetime.now()
+    return {
+        'session_id': session_id,
+        'created_at': now,
+        'last_activity': now,
+        'initial_assessment': None,
+        'baby_info': baby_info or {},
+        'conversation_summary': None,
+        'summarized_until': 0
+    }
+
+
+def new_response(session_id, response_type, response_text, user_message=None):
+    """A chat response record; id is filled in once it is written to SQLite"""
+    return {
+        'id': None,
+        'session_id': session_id,
+        'response_type': response_type,
+        'response_text': response_text,
+        'user_message': user_message,
+        'created_at': datetime.now()
+    }
+
+
+def record_size(record):
+    """Approximate memory held by a session or response record"""
+    size = sys.getsizeof(record)
+    for value in record.values():
+        size += sys.getsizeof(json.dumps(value, default=str) if isinstance(value, (dict, list)) else value)
+    return size
+
+
+class SessionStore:
+    """Interface shared by the session store backends
+
+    Sessions and responses are plain dicts (see new_session/new_response).
+    Callers get copies, so changes only take effect through save_session().
+    """
+
+    def get_session(self, session_id):
+        raise NotImplementedError
+
+    def save_session(self, session):
+        raise NotImplementedError
+
+    def add_response(self, session_id, response_type, response_text, user_message=None):
+        raise NotImplementedError
+
+    def recent_responses(self, session_id, limit=None):
+        """Responses in chronological order, only the newest `limit` when given"""
+        raise NotImplementedError
+
+    def responses_between(self, session_id, after_id, before_id, response_type=None):
+        """Stored responses with after_id < id < before_id in chronological order"""
+        raise NotImplementedError
+
+    def history_version(self, session_id):
+        """(number of responses, newest response's created_at) of a session, without loading its history
+
+        Responses are append-only, so this changes whenever the history does;
+        /get-session builds its ETag from it. Buffered writes are included.
+        """
+        responses = self.recent_responses(session_id)
+        return len(responses), responses[-1]['created_at'] if responses else None
+
+    def save_batch(self, sessions, responses):
+        """Store new sessions together with their responses (built with new_response)
+
+        SQLite-backed stores write the whole batch in one transaction.
+        """
+        for session in sessions:
+            self.save_session(session)
+        for response in responses:
+            self.add_response(response['session_id'], response['response_type'],
+                              response['response_text'], response['user_message'])
+
+    def create_schema(self):
+        """Create the tables this store needs; a no-op for stores without any"""
+
+    def forget(self, session_ids):
+        """Drop cached copies and buffered writes of sessions deleted elsewhere (e.g. by the retention worker)"""
+
+    def flush(self):
+        """Write out anything buffered; a no-op for write-through backends"""
+
+    def stats(self):
+        return {'backend': type(self).__name__}
+
+
+class MemorySessionStore(SessionStore):
+    """In-process store with LRU, idle TTL and memory-based eviction
+
+    Used on its own it is the only copy of the data (app6's original
+    behaviour, now bounded). Inside TieredSessionStore it is a cache.
+    """
+
+    def __init__(self, max_sessions=1000, ttl=3600, max_bytes=64 * 1024 * 1024, max_responses=None):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_responses = max_responses  # Keep only the newest responses per session when set
+        self._entries = OrderedDict()  # session_id -> {'session', 'responses', 'size', 'accessed_at', 'complete'}
+        self._lock = threading.Lock()
+        self.bytes_used = 0
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    def _entry(self, session_id):
+        entry = self._entries.get(session_id)
+        if entry and time.monotonic() - entry['accessed_at'] > self.ttl:
+            self._remove(session_id)
+            self.counters['expirations'] += 1
+            entry = None
+        if entry:
+            entry['accessed_at'] = time.monotonic()
+            self._entries.move_to_end(session_id)
+        return entry
+
+    def _remove(self, session_id):
+        entry = self._entries.pop(session_id, None)
+        if entry:
+            self.bytes_used -= entry['size']
+
+    def _resize(self, entry, delta):
+        entry['size'] += delta
+        self.bytes_used += delta
+
+    def _evict(self):
+        """Drop least recently used sessions until both the count and byte limits hold"""
+        while self._entries and (len(self._entries) > self.max_sessions or self.bytes_used > self.max_bytes):
+            session_id = next(iter(self._entries))
+            self._remove(session_id)
+            self.counters['evictions'] += 1
+
+    def get_session(self, session_id):
+        with self._lock:
+            entry = self._entry(session_id)
+            if not entry:
+                self.counters['misses'] += 1
+                return None
+            self.counters['hits'] += 1
+            return dict(entry['session'])
+
+    def put(self, session, responses=(), complete=True):
+        """Cache a session with (some of) its responses, as loaded from another store"""
+        with self._lock:
+            self._remove(session['session_id'])
+            responses = list(responses)
+            entry = {
+                'session': dict(session),
+                'responses': responses,
+                'size': record_size(session) + sum(record_size(response) for response in responses),
+                'accessed_at': time.monotonic(),
+                'complete': complete
+            }
+            self._entries[session['session_id']] = entry
+            self.bytes_used += entry['size']
+            self._evict()
+
+    def save_session(self, session, complete=True):
+        """Store a session; `complete` says whether a newly created entry holds all its responses"""
+        with self._lock:
+            entry = self._entry(session['session_id'])
+            if not entry:
+                entry = {'session': {}, 'responses': [], 'size': 0,
+                         'accessed_at': time.monotonic(), 'complete': complete}
+                self._entries[session['session_id']] = entry
+            old_size = record_size(entry['session']) if entry['session'] else 0
+            self._resize(entry, record_size(session) - old_size)
+            entry['session'] = dict(session)
+            self._evict()
+
+    def append_response(self, response):
+        """Add an already built response record to a cached session, if it is cached"""
+        with self._lock:
+            entry = self._entry(response['session_id'])
+            if not entry:
+                return
+            entry['responses'].append(response)
+            self._resize(entry, record_size(response))
+            if self.max_responses and len(entry['responses']) > self.max_responses:
+                dropped = entry['responses'].pop(0)
+                self._resize(entry, -record_size(dropped))
+                entry['complete'] = False
+            self._evict()
+
+    def add_response(self, session_id, response_type, response_text, user_message=None):
+        response = new_response(session_id, response_type, response_text, user_message)
+        self.append_response(response)
+        return dict(response)
+
+    def cached_responses(self, session_id, limit=None):
+        """Responses from the cache, or None if the cache can't answer the request in full"""
+        with self._lock:
+            entry = self._entry(session_id)
+            if not entry:
+                return None
+            responses = entry['responses']
+            if limit is None and not entry['complete']:
+                return None
+            if limit is not None and len(responses) < limit and not entry['complete']:
+                return None
+            selected = responses[-limit:] if limit is not None else responses
+            return [dict(response) for response in selected]
+
+    def cached_history_version(self, session_id):
+        """history_version from the cache, or None if the cache doesn't hold every response"""
+        with self._lock:
+            entry = self._entry(session_id)
+            if not entry or not entry['complete']:
+                return None
+            responses = entry['responses']
+            return len(responses), responses[-1]['created_at'] if responses else None
+
+    def recent_responses(self, session_id, limit=None):
+        return self.cached_responses(session_id, limit) or []
+
+    def history_version(self, session_id):
+        return self.cached_history_version(session_id) or (0, None)
+
+    def responses_between(self, session_id, after_id, before_id, response_type=None):
+        return [
+            response for response in self.recent_responses(session_id)
+            if response['id'] is not None and after_id < response['id'] < before_id
+            and (response_type is None or response['response_type'] == response_type)
+        ]
+
+    def forget(self, session_ids):
+        with self._lock:
+            for session_id in session_ids:
+                self._remove(session_id)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                self.counters,
+                backend='memory',
+                sessions=len(self._entries),
+                bytes_used=self.bytes_used,
+                max_sessions=self.max_sessions,
+                max_bytes=self.max_bytes,
+                ttl_seconds=self.ttl
+            )
+
+
+class SQLiteSessionStore(SessionStore):
+    """Store backed by the same chat_session/chat_response tables app5.py's models use
+
+    Works without SQLAlchemy, so app6.py can use it too. Each thread gets its
+    own connection; WAL mode lets several processes share the file.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+
+    def create_schema(self):
+        connection = self._connection()
+        for statement in SQLITE_SCHEMA:
+            connection.execute(statement)
+        connection.commit()
+
+    def _connection(self):
+        return thread_connection(self._local, self.db_path, row_factory=sqlite3.Row, autocommit=False)
+
+    @staticmethod
+    def _session_from_row(row):
+        return {
+            'session_id': row['session_id'],
+            'created_at': datetime.fromisoformat(row['created_at']),
+            'last_activity': datetime.fromisoformat(row['last_activity']),
+            'initial_assessment': row['initial_assessment'],
+            'baby_info': json.loads(row['baby_info']) if row['baby_info'] else {},
+            'conversation_summary': row['conversation_summary'],
+            'summarized_until': row['summarized_until'] or 0
+        }
+
+    @staticmethod
+    def _response_from_row(row):
+        return {
+            'id': row['id'],
+            'session_id': row['session_id'],
+            'response_type': row['response_type'],
+            'response_text': row['response_text'],
+            'user_message': row['user_message'],
+            'created_at': datetime.fromisoformat(row['created_at'])
+        }
+
+    def get_session(self, session_id):
+        row = self._connection().execute(
+            'SELECT * FROM chat_session WHERE session_id = ?', (session_id,)
+        ).fetchone()
+        return self._session_from_row(row) if row else None
+
+    def write_batch(self, sessions=(), responses=()):
+        """Upsert sessions and insert responses in one transaction, filling in response ids
+
+        Each response's confidence ratings go into response_rating in the same transaction.
+        """
+        connection = self._connection()
+        with connection:
+            for session in sessions:
+                connection.execute(
+                    'INSERT INTO chat_session (session_id, created_at, last_activity, initial_assessment, '
+                    'baby_info, conversation_summary, summarized_until) VALUES (?, ?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT(session_id) DO UPDATE SET last_activity = excluded.last_activity, '
+                    'initial_assessment = excluded.initial_assessment, baby_info = excluded.baby_info, '
+                    'conversation_summary = excluded.conversation_summary, '
+                    'summarized_until = excluded.summarized_until',
+                    (
+                        session['session_id'],
+                        session['created_at'].strftime(DATETIME_FORMAT),
+                        session['last_activity'].strftime(DATETIME_FORMAT),
+                        session['initial_assessment'],
+                        json.dumps(session['baby_info']),
+                        session['conversation_summary'],
+                        session['summarized_until']
+                    )
+                )
+            for response in responses:
+                cursor = connection.execute(
+                    'INSERT INTO chat_response (session_id, response_text, user_message, response_type, created_at) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (
+                        response['session_id'],
+                        response['response_text'],
+                        response['user_message'],
+                        response['response_type'],
+                        response['created_at'].strftime(DATETIME_FORMAT)
+                    )
+                )
+                response['id'] = cursor.lastrowid
+                insert_ratings(connection, response)
+
+    def save_session(self, session):
+        self.write_batch(sessions=[session])
+
+    def add_response(self, session_id, response_type, response_text, user_message=None):
+        response = new_response(session_id, response_type, response_text, user_message)
+        self.write_batch(responses=[response])
+        return response
+
+    def save_batch(self, sessions, responses):
+        self.write_batch(sessions, responses)
+
+    def recent_responses(self, session_id, limit=None):
+        if limit is None:
+            rows = self._connection().execute(
+                'SELECT * FROM chat_response WHERE session_id = ? ORDER BY created_at, id', (session_id,)
+            ).fetchall()
+        else:
+            rows = self._connection().execute(
+                'SELECT * FROM chat_response WHERE session_id = ? ORDER BY created_at DESC, id DESC LIMIT ?',
+                (session_id, limit)
+            ).fetchall()
+            rows.reverse()
+        return [self._response_from_row(row) for row in rows]
+
+    def responses_between(self, session_id, after_id, before_id, response_type=None):
+        sql = 'SELECT * FROM chat_response WHERE session_id = ? AND id > ? AND id < ?'
+        params = [session_id, after_id, before_id]
+        if response_type:
+            sql += ' AND response_type = ?'
+            params.append(response_type)
+        rows = self._connection().execute(sql + ' ORDER BY id', params).fetchall()
+        return [self._response_from_row(row) for row in rows]
+
+    def history_version(self, session_id):
+        # Both answered from the (session_id, created_at) index
+        count, newest = self._connection().execute(
+            'SELECT COUNT(*), MAX(created_at) FROM chat_response WHERE session_id = ?', (session_id,)
+        ).fetchone()
+        return count, datetime.fromisoformat(newest) if newest else None
+
+    def stats(self):
+        return {'backend': 'sqlite', 'db_path': self.db_path}
+
+
+class TieredSessionStore(SessionStore):
+    """Hot sessions served from memory, writes buffered and flushed to SQLite in batches
+
+    Reads check the memory tier first and load misses (with their most recent
+    responses) from SQLite. Writes land in memory immediately and are queued;
+    a background thread writes the queue every `flush_interval` seconds or as
+    soon as `batch_size` writes are pending, in a single transaction.
+    """
+
+    def __init__(self, memory, sqlite_store, flush_interval=1.0, batch_size=100, preload_responses=20):
+        self.memory = memory
+        self.sqlite = sqlite_store
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.preload_responses = preload_responses
+
+        self._pending_sessions = OrderedDict()  # session_id -> latest session record
+        self._pending_responses = []
+        self._new_sessions = OrderedDict()  # ids get_session found in neither tier, until they are saved
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self.counters = {'flushes': 0, 'rows_flushed': 0, 'flush_errors': 0}
+        self.last_flush_ms = None
+        self._thread = None
+
+    def _start_flusher(self):
+        """Start the flush thread on the first write, and again in a forked worker process"""
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._flush_loop, name='session-store-flush', daemon=True)
+            self._thread.start()
+
+    def _flush_loop(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def _pending_count(self):
+        return len(self._pending_sessions) + len(self._pending_responses)
+
+    def get_session(self, session_id):
+        session = self.memory.get_session(session_id)
+        if session is not None:
+            return session
+        with self._pending_lock:
+            pending = self._pending_sessions.get(session_id)
+        if pending is not None:
+            return dict(pending)
+
+        session = self.sqlite.get_session(session_id)
+        if session is None:
+            with self._pending_lock:
+                self._new_sessions[session_id] = True
+                while len(self._new_sessions) > self.memory.max_sessions:
+                    self._new_sessions.popitem(last=False)
+            return None
+        responses = self.sqlite.recent_responses(session_id, self.preload_responses)
+        self.memory.put(session, responses, complete=len(responses) < self.preload_responses)
+        return dict(session)
+
+    def save_session(self, session):
+        # A session get_session just found missing has no stored responses, so the memory tier
+        # holds all of them; if it dropped any other session, it can't vouch for the stored ones
+        with self._pending_lock:
+            new = self._new_sessions.pop(session['session_id'], False)
+        self.memory.save_session(session, complete=new)
+        with self._pending_lock:
+            self._pending_sessions[session['session_id']] = dict(session)
+            if self._pending_count() >= self.batch_size:
+                self._wake.set()
+        self._start_flusher()
+
+    def add_response(self, session_id, response_type, response_text, user_message=None):
+        # The same dict is shared with the memory tier so it picks up its id after the flush
+        response = new_response(session_id, response_type, response_text, user_message)
+        self.memory.append_response(response)
+        with self._pending_lock:
+            self._pending_responses.append(response)
+            if self._pending_count() >= self.batch_size:
+                self._wake.set()
+        self._start_flusher()
+        return dict(response)
+
+    def save_batch(self, sessions, responses):
+        # Written straight through so the whole batch commits or fails together
+        self.sqlite.write_batch(sessions, responses)
+        for session in sessions:
+            session_responses = [r for r in responses if r['session_id'] == session['session_id']]
+            self.memory.put(session, session_responses, complete=True)
+
+    def recent_responses(self, session_id, limit=None):
+        cached = self.memory.cached_responses(session_id, limit)
+        if cached is not None:
+            return cached
+        self.flush()
+        return self.sqlite.recent_responses(session_id, limit)
+
+    def responses_between(self, session_id, after_id, before_id, response_type=None):
+        self.flush()
+        return self.sqlite.responses_between(session_id, after_id, before_id, response_type)
+
+    def history_version(self, session_id):
+        version = self.memory.cached_history_version(session_id)
+        if version is not None:
+            return version
+        # Held so a flush can't move pending responses into SQLite between the two reads
+        with self._flush_lock:
+            with self._pending_lock:
+                pending = [r['created_at'] for r in self._pending_responses if r['session_id'] == session_id]
+            count, newest = self.sqlite.history_version(session_id)
+        if pending:
+            count, newest = count + len(pending), max(pending + ([newest] if newest else []))
+        return count, newest
+
+    def create_schema(self):
+        self.sqlite.create_schema()
+
+    def forget(self, session_ids):
+        # Pending writes would re-create the deleted sessions, with orphaned responses
+        forgotten = set(session_ids)
+        with self._pending_lock:
+            for session_id in forgotten:
+                self._pending_sessions.pop(session_id, None)
+                self._new_sessions.pop(session_id, None)
+            self._pending_responses = [r for r in self._pending_responses if r['session_id'] not in forgotten]
+        self.memory.forget(session_ids)
+
+    def flush(self):
+        """Write every pending session and response to SQLite in one transaction"""
+        with self._flush_lock:
+            with self._pending_lock:
+                sessions = list(self._pending_sessions.values())
+                responses = self._pending_responses
+                self._pending_sessions = OrderedDict()
+                self._pending_responses = []
+            if not sessions and not responses:
+                return 0
+
+            start = time.perf_counter()
+            try:
+                self.sqlite.write_batch(sessions, responses)
+            except Exception as e:
+                # Put the batch back so the next flush retries it
+                print(f"Error flushing session store: {e}")
+                self.counters['flush_errors'] += 1
+                with self._pending_lock:
+                    for session in sessions:
+                        self._pending_sessions.setdefault(session['session_id'], session)
+                    self._pending_responses = responses + self._pending_responses
+                return 0
+
+            self.last_flush_ms = round((time.perf_counter() - start) * 1000, 2)
+            self.counters['flushes'] += 1
+            self.counters['rows_flushed'] += len(sessions) + len(responses)
+            return len(sessions) + len(responses)
+
+    def stats(self):
+        with self._pending_lock:
+            pending = self._pending_count()
+        return dict(
+            self.counters,
+            backend='tiered',
+            pending_writes=pending,
+            last_flush_ms=self.last_flush_ms,
+            flush_interval_seconds=self.flush_interval,
+            memory=self.memory.stats(),
+            sqlite=self.sqlite.stats()
+        )
+
+
+def create_session_store(kind, db_path=None):
+    """Build the store named by kind ('memory', 'sqlite' or 'tiered') using SESSION_* settings"""
+    def memory_store(max_responses=None):
+        return MemorySessionStore(
+            max_sessions=int(os.getenv('SESSION_CACHE_MAX_SESSIONS', 1000)),
+            ttl=int(os.getenv('SESSION_CACHE_TTL', 3600)),
+            max_bytes=int(os.getenv('SESSION_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+            max_responses=max_responses
+        )
+
+    if kind == 'memory':
+        return memory_store()
+    if kind == 'sqlite':
+        return SQLiteSessionStore(db_path)
+    if kind == 'tiered':
+        preload = int(os.getenv('SESSION_CACHE_RESPONSES', 20))
+        return TieredSessionStore(
+            memory_store(max_responses=preload),
+            SQLiteSessionStore(db_path),
+            flush_interval=float(os.getenv('SESSION_FLUSH_INTERVAL', 1.0)),
+            batch_size=int(os.getenv('SESSION_FLUSH_BATCH_SIZE', 100)),
+            preload_responses=preload
+        )
+    raise ValueError(f'Unknown session store: {kind}')
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+def payload_digest(*parts):
+    """Stable hash of JSON-serializable request parts"""
+    encoded = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+class Flight:
+    """One in-flight call that followers can wait on"""
+
+    def __init__(self, digest=None):
+        self.digest = digest
+        self.done = threading.Event()
+        self.result = None
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """Coalesce identical concurrent calls so only the first (the leader) does the work
+
+    Followers that arrive while the leader is running, or up to `linger`
+    seconds after it succeeded, get the leader's result instead of repeating
+    the call. Failed results are handed to current followers and then
+    dropped so the next attempt runs again. Flights older than `max_age` that
+    never finished (the leader thread died) are replaced.
+    """
+
+    def __init__(self, linger=5.0, max_age=120.0):
+        self.linger = linger
+        self.max_age = max_age
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.stats = {'leaders': 0, 'coalesced': 0, 'abandoned': 0, 'conflicts': 0}
+
+    def _expire(self, now):
+        for key, flight in list(self._flights.items()):
+            if flight.finished_at is not None:
+                if now - flight.finished_at > self.linger:
+                    del self._flights[key]
+            elif now - flight.started_at > self.max_age:
+                del self._flights[key]
+                self.stats['abandoned'] += 1
+
+    def begin(self, key, digest=None):
+        """Return (flight, True) for a new leader or (flight, False) for a follower
+
+        When the key doesn't identify the request by itself (an Idempotency-Key),
+        pass the request's digest: joining a flight started for a different
+        digest raises ValueError.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = Flight(digest)
+                self.stats['leaders'] += 1
+                return flight, True
+            if flight.digest != digest:
+                self.stats['conflicts'] += 1
+                raise ValueError('Idempotency-Key is in use for a different request')
+            flight.followers += 1
+            self.stats['coalesced'] += 1
+            return flight, False
+
+    def finish(self, key, flight, result, share=True):
+        """Publish the leader's result; share=False stops later arrivals from reusing it"""
+        flight.result = result
+        flight.finished_at = time.monotonic()
+        flight.done.set()
+        if not share or not self.linger:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+    def wait(self, flight, timeout=None):
+        """Block until the leader finishes, raising TimeoutError after `timeout` seconds"""
+        if not flight.done.wait(timeout or self.max_age):
+            raise TimeoutError('Timed out waiting for an identical request in progress')
+        return flight.result
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, in_flight=sum(1 for f in self._flights.values() if f.finished_at is None))
+
+
+class IdempotencyStore:
+    """Results stored under client-supplied Idempotency-Key headers for a retry window
+
+    Each entry keeps the digest of the request that created it, so reusing a
+    key for a different request can be detected and refused.
+    """
+
+    def __init__(self, ttl=600, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (scope, key) -> (stored_at, digest, status, payload)
+        self._lock = threading.Lock()
+        self.stats = {'replays': 0, 'conflicts': 0, 'stores': 0}
+
+    def get(self, scope, key, digest):
+        """Return (status, payload) stored for key, None if unknown, or raise ValueError on a digest mismatch"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get((scope, key))
+            if entry is None:
+                return None
+            stored_at, stored_digest, status, payload = entry
+            if now - stored_at > self.ttl:
+                del self._entries[(scope, key)]
+                return None
+            if stored_digest != digest:
+                self.stats['conflicts'] += 1
+                raise ValueError('Idempotency-Key was already used for a different request')
+            self.stats['replays'] += 1
+            return status, payload
+
+    def set(self, scope, key, digest, status, payload):
+        with self._lock:
+            self._entries[(scope, key)] = (time.time(), digest, status, payload)
+            self._entries.move_to_end((scope, key))
+            self.stats['stores'] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), ttl_seconds=self.ttl)
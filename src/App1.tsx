@@ -12,6 +12,7 @@ const API_BASE_URL = "http://localhost:8000"; // Update this to your backend URL
 
 function App() {
   const [filebase64, setFileBase64] = useState<string>("");
+  const [imageFile, setImageFile] = useState<File | null>(null);
   const [location, setLocation] = useState<string[]>([]);
   const [feedingType, setFeedingType] = useState("");
   const [stoolColor, setStoolColor] = useState("");
@@ -54,23 +55,22 @@ function App() {
     setIsLoading(true);
     setError("");
     try {
-      const formData = {
-        location,
-        feedingType,
-        stoolColor,
-        numberText,
-        durationText,
-        temperatureText,
-        extraNotes,
-        image: filebase64, // Include the base64 image
-      };
+      // Send the form as multipart so the photo goes up as raw bytes instead of base64
+      const formData = new FormData();
+      location.forEach((area) => formData.append("location", area));
+      formData.append("feedingType", feedingType);
+      formData.append("stoolColor", stoolColor);
+      formData.append("numberText", numberText);
+      formData.append("durationText", durationText);
+      formData.append("temperatureText", temperatureText);
+      formData.append("extraNotes", extraNotes);
+      if (imageFile) {
+        formData.append("image", imageFile);
+      }
 
       const response = await fetch(`${API_BASE_URL}/submit-assessment`, {
         method: "POST",
-        headers: {
-          "Content-Type": "application/json",
-        },
-        body: JSON.stringify(formData),
+        body: formData,
       });
 
       if (!response.ok) {
@@ -154,6 +154,7 @@ function App() {
     if (files) {
       const fileRef = files[0] || "";
       const fileType: string = fileRef.type || "";
+      setImageFile(files[0] || null);
       const reader = new FileReader();
       reader.readAsBinaryString(fileRef);
       reader.onload = (ev: any) => {
@@ -246,6 +247,7 @@ function App() {
                   setChatMessages([]);
                   // Reset form
                   setFileBase64("");
+                  setImageFile(null);
                   setLocation([]);
                   setFeedingType("");
                   setStoolColor("");
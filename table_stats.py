@@ -0,0 +1,59 @@
+import threading
+import time
+from datetime import datetime
+
+
+class TableStats:
+    """Row counts refreshed on a background thread so probes and dashboards never scan tables
+
+    `count_rows` is called every `interval` seconds and returns a dict of
+    counts. Readers get the last snapshot and how old it is.
+    """
+
+    def __init__(self, count_rows, interval=60):
+        self.count_rows = count_rows
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self.counts = None
+        self.refreshed_at = None
+        self.refresh_ms = None
+        self.error = None
+
+    def start(self):
+        """Take the first snapshot in the background and keep refreshing it"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._loop, name='table-stats', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self.refresh()
+            self._stop.wait(self.interval)
+
+    def refresh(self):
+        start = time.perf_counter()
+        try:
+            self.counts = self.count_rows()
+            self.refreshed_at = datetime.now()
+            self.error = None
+        except Exception as e:
+            self.error = str(e)
+            print(f"Error refreshing table stats: {e}")
+        self.refresh_ms = round((time.perf_counter() - start) * 1000, 1)
+
+    def snapshot(self):
+        """Last counts with their age, or None counts if no refresh has succeeded yet"""
+        age = (datetime.now() - self.refreshed_at).total_seconds() if self.refreshed_at else None
+        return {
+            'counts': dict(self.counts) if self.counts else None,
+            'refreshed_at': self.refreshed_at.isoformat() if self.refreshed_at else None,
+            'age_seconds': round(age, 1) if age is not None else None,
+            'refresh_interval_seconds': self.interval,
+            'refresh_ms': self.refresh_ms,
+            'error': self.error
+        }
@@ -1,26 +1,39 @@
+"""ParentPal command-line chat
+
+Recent turns are sent verbatim within a token budget; turns that fall out of
+the window are folded into a rolling summary instead of being re-sent every
+time. Replies stream to the terminal as they are generated, and each turn
+prints its latency and prompt size. With --db the conversation is stored in
+the same SQLite tables app5.py uses (in the background, so the next
+question never waits on disk) and can be resumed later, including sessions
+started in the web app:
+
+    python test.py
+    python test.py --db instance/baby_health_data.db
+    python test.py --db instance/baby_health_data.db --session <session id>
+
+Set LLM_BACKEND=fake to try it without an API key.
+"""
+import argparse
 import os
-import google.generativeai as genai
-from google.generativeai import types
-from dotenv import load_dotenv
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
-load_dotenv()
+from dotenv import load_dotenv
 
-# Rolling chat history
-chat_history = []
+from prompt_builder import (ASSESSMENT_BUDGET_SHARE, PROMPT_TOKEN_BUDGET, estimate_tokens, extend_summary,
+                            truncate_to_tokens)
+from session_store import SQLiteSessionStore, new_response, new_session
 
-# Configure API key
-genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+load_dotenv()
 
-# Set up the model
-model = genai.GenerativeModel(
-    model_name="gemini-2.5-flash",
-    system_instruction="You are a child paediatrician helping new parents understand what's normal for their babies. Be friendly, explain clearly, and reassure them."
-)
+SYSTEM_INSTRUCTION = "You are a child paediatrician helping new parents understand what's normal for their babies. Be friendly, explain clearly, and reassure them."
 
 # Generation settings
-generation_config = types.GenerationConfig(
-    temperature=0
-)
+generation_config = {"temperature": 0}
 
 safety_settings = [
     {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
@@ -29,27 +42,248 @@ safety_settings = [
     {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_ONLY_HIGH"},
 ]
 
-def chat():
-    print("👶 Welcome to ParentPal! Ask me anything about your baby's health.")
-    while True:
-        user_input = input("\nYou: ")
-        if user_input.lower() in {"exit", "quit"}:
-            print("👋 Goodbye! Stay calm and parent on.")
-            break
-
-        # Add user message to chat history
-        chat_history.append({"role": "user", "parts": [user_input]})
-
-        # Get model response
-        response = model.generate_content(
-            chat_history,
-            generation_config=generation_config,
-            safety_settings=safety_settings
+# Responses with ids below this all fit in SQLite's integer range
+MAX_RESPONSE_ID = 2 ** 63 - 1
+
+
+def create_cli_model():
+    """The Gemini model with the ParentPal persona, or the offline stub with LLM_BACKEND=fake"""
+    if os.getenv("LLM_BACKEND", "gemini") == "fake":
+        from llm_backend import create_model
+        return create_model("fake")
+
+    import google.generativeai as genai
+    genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+    return genai.GenerativeModel(
+        model_name=os.getenv("GEMINI_CLI_MODEL", "gemini-2.5-flash"),
+        system_instruction=SYSTEM_INSTRUCTION
+    )
+
+
+class Conversation:
+    """Recent turns kept verbatim plus a rolling summary of everything older
+
+    Turns are response records (see session_store.new_response). At most
+    `window_turns` of them are sent, fewer if they don't fit in `budget`
+    tokens together with the summary and the new question.
+    """
+
+    def __init__(self, window_turns=6, budget=PROMPT_TOKEN_BUDGET, summary=None, turns=None, background=None):
+        self.window_turns = window_turns
+        self.budget = budget
+        self.summary = summary
+        self.turns = list(turns or [])
+        self.background = background
+        self.summarized_turns = 0
+        self.last_summarized = None
+
+    def fold(self, count):
+        """Move the oldest `count` turns into the summary"""
+        if count <= 0:
+            return
+        folded, self.turns = self.turns[:count], self.turns[count:]
+        self.summary = extend_summary(
+            self.summary,
+            [{"user_message": turn["user_message"], "response": turn["response_text"]} for turn in folded]
         )
+        self.summarized_turns += len(folded)
+        self.last_summarized = folded[-1]
+
+    def contents(self, user_input):
+        """Gemini contents for the next question and a dict of size stats"""
+        self.fold(len(self.turns) - self.window_turns)
+
+        context = []
+        if self.background:
+            context.append(f"Earlier assessment of this baby:\n{self.background}")
+        if self.summary:
+            context.append(f"Summary of our conversation so far:\n{self.summary}")
+        context_text = "\n\n".join(context)
+
+        used = estimate_tokens(context_text) + estimate_tokens(user_input)
+        fits = 0
+        for turn in reversed(self.turns):
+            cost = estimate_tokens(turn["user_message"]) + estimate_tokens(turn["response_text"])
+            if used + cost > self.budget:
+                break
+            used += cost
+            fits += 1
+        # Turns that no longer fit are summarised rather than dropped
+        if fits < len(self.turns):
+            self.fold(len(self.turns) - fits)
+            return self.contents(user_input)
+
+        contents = []
+        if context_text:
+            contents.append({"role": "user", "parts": [context_text]})
+            contents.append({"role": "model", "parts": ["Thanks, I'll keep that in mind."]})
+        for turn in self.turns:
+            contents.append({"role": "user", "parts": [turn["user_message"]]})
+            contents.append({"role": "model", "parts": [turn["response_text"]]})
+        contents.append({"role": "user", "parts": [user_input]})
+        stats = {
+            "estimated_tokens": used,
+            "recent_turns": len(self.turns),
+            "summary_tokens": estimate_tokens(self.summary)
+        }
+        return contents, stats
+
+    def add(self, turn):
+        self.turns.append(turn)
+
+
+class HistoryWriter:
+    """Stores each finished turn in SQLite on a background thread
+
+    One writer thread keeps the writes in order; the session row is written
+    with the turn so its summary and summarized_until stay current. The
+    summary is taken when save() is called, since the main thread may fold
+    more turns into it before the write runs.
+    """
+
+    def __init__(self, store, session, conversation):
+        self.store = store
+        self.session = session
+        self.conversation = conversation
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-writer")
+
+    def save(self, turn=None):
+        self._executor.submit(self._write, turn, self.conversation.summary, self.conversation.last_summarized)
+
+    def _write(self, turn, summary, last_summarized):
+        try:
+            self.session["last_activity"] = datetime.now()
+            self.session["conversation_summary"] = summary
+            # Turns are written in order, so the last one in this summary has its id by now
+            if last_summarized is not None and last_summarized["id"] is not None:
+                self.session["summarized_until"] = last_summarized["id"]
+            # write_batch fills in turn["id"], which later summaries refer to
+            self.store.write_batch([self.session], [turn] if turn else [])
+        except Exception as e:
+            print(f"\nError saving chat history: {e}")
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+def resume(store, session_id, args):
+    """The stored session and a Conversation rebuilt from its summary and unsummarised turns"""
+    session = store.get_session(session_id)
+    if session is None:
+        sys.exit(f"No session {session_id} in {store.db_path}")
+    turns = store.responses_between(session_id, session["summarized_until"] or 0, MAX_RESPONSE_ID,
+                                    response_type="chat")
+    background = None
+    if session["initial_assessment"]:
+        background = truncate_to_tokens(session["initial_assessment"], int(args.budget * ASSESSMENT_BUDGET_SHARE))
+    conversation = Conversation(args.window, args.budget, session["conversation_summary"], turns, background)
+    return session, conversation
+
+
+def stream_reply(model, contents, stream):
+    """Print the reply as it arrives; returns its text, seconds to the first text and usage metadata"""
+    started = time.perf_counter()
+    first_text_at = None
+    usage = None
+    parts = []
+    response = model.generate_content(
+        contents,
+        stream=stream,
+        generation_config=generation_config,
+        safety_settings=safety_settings
+    )
+    for chunk in (response if stream else [response]):
+        usage = getattr(chunk, "usage_metadata", None) or usage
+        try:
+            text = chunk.text
+        except ValueError:
+            # Chunks without text (e.g. a safety block) have nothing to print
+            continue
+        if first_text_at is None:
+            first_text_at = time.perf_counter() - started
+        parts.append(text)
+        print(text, end="", flush=True)
+    print()
+    return "".join(parts), first_text_at, usage
+
+
+def chat(args):
+    store = None
+    writer = None
+    if args.db:
+        store = SQLiteSessionStore(args.db)
+        store.create_schema()
+
+    if args.session:
+        if store is None:
+            sys.exit("--session needs --db to resume from")
+        session, conversation = resume(store, args.session, args)
+        print(f"Resuming session {session['session_id']} ({len(conversation.turns)} recent turns"
+              f"{', with a summary of earlier ones' if conversation.summary else ''})")
+    else:
+        session = new_session(str(uuid.uuid4()))
+        conversation = Conversation(args.window, args.budget)
+    if store is not None:
+        writer = HistoryWriter(store, session, conversation)
+        if not args.session:
+            writer.save()
+            print(f"Saving this conversation as session {session['session_id']}")
+
+    model = create_cli_model()
+    print("👶 Welcome to ParentPal! Ask me anything about your baby's health.")
+    try:
+        while True:
+            try:
+                user_input = input("\nYou: ").strip()
+            except (EOFError, KeyboardInterrupt):
+                print()
+                break
+            if user_input.lower() in {"exit", "quit"}:
+                break
+            if not user_input:
+                continue
+
+            contents, stats = conversation.contents(user_input)
+            print("\nParentPal: ", end="", flush=True)
+            started = time.perf_counter()
+            try:
+                reply, first_text_at, usage = stream_reply(model, contents, not args.no_stream)
+            except KeyboardInterrupt:
+                print("\n(stopped, this turn was not kept)")
+                continue
+            except Exception as e:
+                print(f"\nError getting a response: {e}")
+                continue
+            elapsed = time.perf_counter() - started
+
+            turn = new_response(session["session_id"], "chat", reply, user_input)
+            conversation.add(turn)
+            if writer is not None:
+                writer.save(turn)
+
+            prompt_tokens = getattr(usage, "prompt_token_count", None)
+            size = f"{prompt_tokens} tokens" if prompt_tokens else f"~{stats['estimated_tokens']} tokens (estimated)"
+            first = ""
+            if first_text_at is not None and not args.no_stream:
+                first = f", first text {first_text_at * 1000:.0f} ms"
+            print(f"  [{elapsed * 1000:.0f} ms{first}, prompt {size}: {stats['recent_turns']} recent turns, "
+                  f"{conversation.summarized_turns} summarised]")
+    finally:
+        if writer is not None:
+            writer.close()
+    print("👋 Goodbye! Stay calm and parent on.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", help="Store the conversation in this SQLite database (app5.py's tables)")
+    parser.add_argument("--session", help="Resume this session id from --db")
+    parser.add_argument("--window", type=int, default=int(os.getenv("CLI_WINDOW_TURNS", 6)),
+                        help="Most recent turns sent verbatim")
+    parser.add_argument("--budget", type=int, default=PROMPT_TOKEN_BUDGET, help="Prompt token budget")
+    parser.add_argument("--no-stream", action="store_true", help="Print each reply once it is complete")
+    chat(parser.parse_args())
 
-        # Print and add model response
-        print("\nParentPal:", response.text)
-        chat_history.append({"role": "model", "parts": [response.text]})
 
 if __name__ == "__main__":
-    chat()
\ No newline at end of file
+    main()
@@ -0,0 +1,22 @@
+import os
+import sys
+
+# The modules live flat in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+
+@pytest.fixture(scope='session')
+def app5(tmp_path_factory):
+    """app5 on a scratch database with the offline model and no rate limits"""
+    root = tmp_path_factory.mktemp('app5')
+    os.environ.update({
+        'DATABASE_URL': f'sqlite:///{root}/app.db',
+        'ARCHIVE_DIR': '',
+        'LLM_BACKEND': 'fake',
+        'RATE_LIMIT_ENABLED': '0',
+    })
+    import app5
+    app5.migrate_database()
+    return app5
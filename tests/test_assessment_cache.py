@@ -0,0 +1,46 @@
+import threading
+
+from assessment_cache import AssessmentCache
+
+
+def shared_caches(tmp_path, **kwargs):
+    path = str(tmp_path / 'cache.db')
+    first, second = AssessmentCache(db_path=path, **kwargs), AssessmentCache(db_path=path, **kwargs)
+    first.create_schema()
+    return first, second
+
+
+def test_entries_are_shared_through_sqlite(tmp_path):
+    first, second = shared_caches(tmp_path)
+    first.set('key', 'Mild diaper rash')
+    assert second.get('key') == 'Mild diaper rash'
+    assert second.get('key') == 'Mild diaper rash'
+    assert second.snapshot()['sqlite_hits'] == 1
+    assert second.snapshot()['memory_hits'] == 1
+    assert second.get('other') is None
+
+
+def test_expired_entries_are_deleted(tmp_path):
+    first, second = shared_caches(tmp_path, ttl=0)
+    first.set('key', 'Mild diaper rash')
+    assert second.get('key') is None
+    count = second._connection().execute('SELECT COUNT(*) FROM assessment_cache').fetchone()[0]
+    assert count == 0
+
+
+def test_each_thread_gets_its_own_tuned_connection(tmp_path):
+    cache, _ = shared_caches(tmp_path)
+    connections = []
+
+    def worker():
+        cache.set(threading.current_thread().name, 'text')
+        connections.append(cache._connection())
+
+    threads = [threading.Thread(target=worker) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({id(connection) for connection in connections}) == 3
+    assert cache._connection().execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    assert cache._connection().execute('SELECT COUNT(*) FROM assessment_cache').fetchone()[0] == 3
@@ -0,0 +1,29 @@
+import pytest
+
+from job_queue import RetryLater
+from llm_pool import DeadlineExceededError, PoolFullError
+from resilience import CircuitOpenError, ModelTimeoutError, UpstreamError
+
+
+def failing(error):
+    def generate_text(model_input):
+        raise error
+    return generate_text
+
+
+@pytest.mark.parametrize('error', [PoolFullError('full', retry_after=3), CircuitOpenError('open', retry_after=3)])
+def test_refused_model_calls_are_retried_later(app5, monkeypatch, error):
+    monkeypatch.setattr(app5, 'generate_text', failing(error))
+    with pytest.raises(RetryLater) as raised:
+        app5.process_assessment_job({'form': {'no_cache': True}})
+    assert raised.value.delay == 3
+
+
+@pytest.mark.parametrize('error', [
+    UpstreamError('upstream failed'), ModelTimeoutError('too slow'), DeadlineExceededError('too slow'),
+])
+def test_failed_model_calls_use_up_an_attempt(app5, monkeypatch, error):
+    monkeypatch.setattr(app5, 'generate_text', failing(error))
+    with pytest.raises(Exception) as raised:
+        app5.process_assessment_job({'form': {'no_cache': True}})
+    assert type(raised.value) is RuntimeError
@@ -0,0 +1,39 @@
+import threading
+
+from session_store import new_session
+
+
+def get(client, session_id, etag=None):
+    return client.get(f'/get-session/{session_id}', headers={'If-None-Match': f'"{etag}"'} if etag else {})
+
+
+def test_unchanged_poll_gets_a_304_without_flushing(app5, monkeypatch):
+    store = app5.session_store
+    flushes = []
+    flush = store.flush
+
+    def counting_flush():
+        # Only flushes on the request path count, not the store's own flush thread
+        if threading.current_thread() is threading.main_thread():
+            flushes.append(1)
+        return flush()
+
+    monkeypatch.setattr(store, 'flush', counting_flush)
+    store.save_session(new_session('polled-app5'))
+    store.add_response('polled-app5', 'assessment', 'All looks fine')
+    client = app5.app.test_client()
+
+    # Still only in the write-behind tier
+    first = get(client, 'polled-app5')
+    assert first.status_code == 200
+    assert [entry['response'] for entry in first.get_json()['chat_history']] == ['All looks fine']
+    etag = first.headers['ETag'].strip('"').split('-')[0]
+
+    flushes.clear()
+    assert get(client, 'polled-app5', etag).status_code == 304
+    assert flushes == []
+
+    store.add_response('polled-app5', 'chat', 'Keep an eye on the fever')
+    changed = get(client, 'polled-app5', etag)
+    assert changed.status_code == 200
+    assert len(changed.get_json()['chat_history']) == 2
@@ -0,0 +1,110 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from job_queue import JobFailed, JobQueue, RetryLater
+
+
+def make_queue(tmp_path, handler, **kwargs):
+    queue = JobQueue(str(tmp_path / 'jobs.db'), handler, poll_interval=0.01, **kwargs)
+    queue.create_schema()
+    return queue
+
+
+def wait_for(queue, job_id, timeout=5):
+    job = queue.wait(job_id, timeout)
+    assert job['status'] in ('done', 'failed'), job
+    return job
+
+
+def test_expired_lease_is_claimed_again_and_the_old_holder_cannot_finish(tmp_path):
+    queue = make_queue(tmp_path, lambda payload: payload, lease_seconds=0.05)
+    job_id = queue.enqueue({'form': 1})
+
+    first = queue._claim()
+    assert queue._claim() is None
+    time.sleep(0.1)
+    second = queue._claim()
+    assert second['id'] == job_id and second['attempts'] == 2
+
+    # The worker whose lease ran out can't overwrite the current holder's outcome
+    assert queue._finish(first, 'done', result={'stale': True}) is False
+    assert queue.counters['lease_lost'] == 1
+    assert queue._finish(second, 'done', result={'fresh': True}) is True
+    assert queue.get(job_id)['result'] == {'fresh': True}
+
+
+def test_slow_job_keeps_its_lease_while_it_runs(tmp_path):
+    calls = []
+
+    def slow(payload):
+        calls.append(payload)
+        time.sleep(0.5)
+        return {'ok': True}
+
+    queue = make_queue(tmp_path, slow, lease_seconds=0.15, workers=2)
+    # A second process's worker polling the same table
+    other = JobQueue(queue.db_path, slow, poll_interval=0.01, lease_seconds=0.15)
+    queue.start()
+    other.start()
+    try:
+        job = wait_for(queue, queue.enqueue({'form': 1}))
+    finally:
+        queue.stop()
+        other.stop()
+    assert job['status'] == 'done'
+    assert job['attempts'] == 1
+    assert len(calls) == 1
+
+
+def test_retry_later_does_not_use_up_attempts(tmp_path):
+    busy = iter(range(5))
+
+    def handler(payload):
+        if next(busy, None) is not None:
+            raise RetryLater('LLM pool is at capacity', delay=0)
+        return {'ok': True}
+
+    queue = make_queue(tmp_path, handler, max_attempts=2)
+    queue.start()
+    try:
+        job = wait_for(queue, queue.enqueue({'form': 1}))
+    finally:
+        queue.stop()
+    assert job['status'] == 'done'
+    assert job['attempts'] == 1
+    assert queue.counters['retried'] == 5
+
+
+@pytest.mark.parametrize('error, attempts', [(JobFailed('bad form'), 1), (RuntimeError('upstream'), 3)])
+def test_failures(tmp_path, error, attempts):
+    def handler(payload):
+        raise error
+
+    queue = make_queue(tmp_path, handler, max_attempts=3)
+    queue.start()
+    try:
+        job = wait_for(queue, queue.enqueue({'form': 1}))
+    finally:
+        queue.stop()
+    assert job['status'] == 'failed'
+    assert job['attempts'] == attempts
+
+
+def test_create_schema_adds_the_lease_token_to_an_existing_table(tmp_path):
+    path = str(tmp_path / 'old.db')
+    connection = sqlite3.connect(path)
+    connection.execute(
+        'CREATE TABLE assessment_job (id VARCHAR(36) PRIMARY KEY, status VARCHAR(10) NOT NULL, '
+        'payload TEXT NOT NULL, result TEXT, error TEXT, attempts INTEGER NOT NULL DEFAULT 0, '
+        'created_at REAL NOT NULL, available_at REAL NOT NULL, started_at REAL, finished_at REAL, '
+        'lease_until REAL)'
+    )
+    connection.close()
+    queue = JobQueue(path, lambda payload: payload)
+    queue.create_schema()
+    queue.create_schema()
+    columns = [row[1] for row in sqlite3.connect(path).execute('PRAGMA table_info(assessment_job)')]
+    assert 'lease_token' in columns
@@ -0,0 +1,39 @@
+import threading
+import time
+
+import pytest
+
+from llm_pool import DeadlineExceededError, LLMPool
+
+
+def occupy(pool, release):
+    """Keep the pool's only worker busy until release is set"""
+    busy = threading.Thread(target=pool.submit, args=(release.wait,))
+    busy.start()
+    while not pool.running:
+        time.sleep(0.01)
+    return busy
+
+
+def test_time_spent_queued_comes_out_of_the_call_deadline():
+    pool = LLMPool(max_concurrency=1, max_queue=1, deadline=5)
+    release = threading.Event()
+    busy = occupy(pool, release)
+    threading.Timer(0.3, release.set).start()
+
+    received = pool.submit(lambda deadline: deadline, deadline=2, deadline_arg='deadline')
+    busy.join()
+    assert 0 < received <= 1.75
+
+
+def test_call_still_queued_at_its_deadline_fails():
+    pool = LLMPool(max_concurrency=1, max_queue=1, deadline=5)
+    release = threading.Event()
+    busy = occupy(pool, release)
+    try:
+        with pytest.raises(DeadlineExceededError):
+            pool.submit(lambda: None, deadline=0.1)
+    finally:
+        release.set()
+        busy.join()
+    assert pool.timed_out == 1
@@ -0,0 +1,26 @@
+import pytest
+from flask import Flask
+
+import metrics
+
+
+def make_app(name, calls):
+    app = Flask(name)
+    registry = metrics.init_app(app)
+    registry.counter('llm_call_events_total', 'Model calls', ['event'], function=lambda: {('calls',): calls})
+    return app
+
+
+def test_each_app_has_its_own_registry():
+    first = make_app('first', 1).test_client().get('/metrics').get_data(as_text=True)
+    second = make_app('second', 2).test_client().get('/metrics').get_data(as_text=True)
+    assert 'llm_call_events_total{event="calls"} 1' in first
+    assert 'llm_call_events_total{event="calls"} 2' in second
+    assert 'http_request_duration_seconds' in first
+
+
+def test_registering_a_name_twice_in_one_registry_fails():
+    registry = metrics.Registry()
+    registry.gauge('up', 'Up')
+    with pytest.raises(ValueError):
+        registry.gauge('up', 'Up')
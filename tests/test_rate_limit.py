@@ -0,0 +1,116 @@
+import pytest
+
+import rate_limit
+from rate_limit import MemoryBuckets, RateLimit, RateLimiter, SQLiteBuckets
+
+
+class Clock:
+    """Stands in for the time module so buckets refill on demand"""
+
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+    monotonic = time
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit, 'time', clock)
+    return clock
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def buckets(request, tmp_path, clock):
+    if request.param == 'memory':
+        buckets = MemoryBuckets()
+    else:
+        buckets = SQLiteBuckets(str(tmp_path / 'rate_limit.db'))
+    buckets.create_schema()
+    return buckets
+
+
+# 3 tokens, one back every 2 seconds
+LIMIT = RateLimit('ip', burst=3, per_minute=30)
+
+
+def test_burst_is_spent_then_refused(buckets):
+    decisions = [buckets.take('client', LIMIT) for _ in range(4)]
+    assert [d.allowed for d in decisions] == [True, True, True, False]
+    assert [d.remaining for d in decisions] == [2, 1, 0, 0]
+    assert decisions[-1].retry_after == pytest.approx(2)
+    assert decisions[-1].reset == pytest.approx(6)
+
+
+def test_tokens_refill_with_time(buckets, clock):
+    for _ in range(3):
+        buckets.take('client', LIMIT)
+    clock.now += 1
+    assert not buckets.take('client', LIMIT).allowed
+    clock.now += 1
+    assert buckets.take('client', LIMIT).allowed
+    assert not buckets.take('client', LIMIT).allowed
+
+
+def test_refill_stops_at_the_burst(buckets, clock):
+    buckets.take('client', LIMIT)
+    clock.now += 3600
+    decisions = [buckets.take('client', LIMIT) for _ in range(4)]
+    assert [d.allowed for d in decisions] == [True, True, True, False]
+
+
+def test_refused_take_spends_nothing(buckets):
+    assert not buckets.take('client', LIMIT, cost=5).allowed
+    assert buckets.take('client', LIMIT, cost=3).allowed
+
+
+def test_keys_have_their_own_buckets(buckets):
+    for _ in range(3):
+        buckets.take('one', LIMIT)
+    assert not buckets.take('one', LIMIT).allowed
+    assert buckets.take('two', LIMIT).allowed
+
+
+def test_sqlite_buckets_are_shared_between_workers(tmp_path, clock):
+    path = str(tmp_path / 'rate_limit.db')
+    first, second = SQLiteBuckets(path), SQLiteBuckets(path)
+    first.create_schema()
+    assert first.take('client', LIMIT).allowed
+    assert second.take('client', LIMIT).allowed
+    assert first.take('client', LIMIT).allowed
+    assert not second.take('client', LIMIT).allowed
+
+
+def test_sqlite_purge_deletes_full_buckets_only(tmp_path, clock):
+    buckets = SQLiteBuckets(str(tmp_path / 'rate_limit.db'))
+    buckets.create_schema()
+    buckets.take('old', LIMIT)
+    clock.now += 1
+    buckets.take('new', LIMIT)
+    clock.now += 1.5
+    buckets.purge()
+    assert buckets.status()['buckets'] == 1
+    assert buckets.take('new', LIMIT).remaining == 1
+
+
+def test_request_refused_by_its_session_keeps_its_ip_tokens(buckets):
+    limiter = RateLimiter(buckets, per_ip=LIMIT, per_session=RateLimit('session', burst=1, per_minute=30))
+    assert limiter.check('10.0.0.1', 'session-a').allowed
+    for _ in range(3):
+        assert not limiter.check('10.0.0.1', 'session-a').allowed
+    # Only the allowed request took an IP token
+    assert [limiter.check('10.0.0.1', f'session-{n}').allowed for n in range(3)] == [True, True, False]
+    assert limiter.counters == {'allowed': 3, 'limited': 4, 'errors': 0}
+
+
+def test_sqlite_refund_marks_the_bucket_full_again(tmp_path, clock):
+    buckets = SQLiteBuckets(str(tmp_path / 'rate_limit.db'))
+    buckets.create_schema()
+    buckets.take('client', LIMIT)
+    buckets.refund('client', LIMIT)
+    clock.now += 0.001
+    buckets.purge()
+    assert buckets.status()['buckets'] == 0
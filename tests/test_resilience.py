@@ -0,0 +1,171 @@
+import pytest
+
+from resilience import CircuitBreaker, CircuitOpenError, ResilientModel
+
+
+class Chunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class StreamingModel:
+    """Streams `chunks` or raises `error` from generate_content"""
+
+    def __init__(self, chunks=('a', 'b', 'c'), error=None):
+        self.chunks = chunks
+        self.error = error
+        self.calls = 0
+
+    def generate_content(self, model_input, stream=False, **kwargs):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        return iter([Chunk(text) for text in self.chunks])
+
+
+def open_breaker(breaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.allow()
+        breaker.record_failure()
+
+
+def expire(breaker):
+    """Pretend the reset timeout has passed"""
+    breaker.opened_at -= breaker.reset_timeout
+
+
+def test_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    for _ in range(2):
+        breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == 'closed'
+    breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    with pytest.raises(CircuitOpenError) as raised:
+        breaker.allow()
+    assert raised.value.retry_after >= 1
+    assert breaker.counters == {'opened': 1, 'short_circuited': 1}
+
+
+def test_success_resets_the_failure_count():
+    breaker = CircuitBreaker(failure_threshold=2)
+    breaker.allow()
+    breaker.record_failure()
+    breaker.allow()
+    breaker.record_success()
+    breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+
+
+def test_half_open_lets_one_trial_through():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    open_breaker(breaker)
+    expire(breaker)
+    breaker.allow()
+    assert breaker.state == 'half_open'
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    breaker.allow()
+
+
+def test_failed_trial_opens_again():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    open_breaker(breaker)
+    expire(breaker)
+    breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert breaker.counters['opened'] == 2
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+
+def test_ignored_trial_frees_the_slot():
+    breaker = CircuitBreaker(failure_threshold=1)
+    open_breaker(breaker)
+    expire(breaker)
+    breaker.allow()
+    breaker.record_ignored()
+    assert breaker.state == 'half_open'
+    breaker.allow()
+
+
+def test_check_does_not_take_the_trial():
+    breaker = CircuitBreaker(failure_threshold=1)
+    open_breaker(breaker)
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    expire(breaker)
+    breaker.check()
+    breaker.allow()
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+
+def test_stream_raises_on_an_open_circuit_before_iterating():
+    model = ResilientModel(StreamingModel(), breaker=CircuitBreaker(failure_threshold=1))
+    open_breaker(model.breaker)
+    with pytest.raises(CircuitOpenError):
+        model.generate_content('prompt', stream=True)
+    assert model.model.calls == 0
+
+
+def test_abandoned_streamed_trial_is_released():
+    model = ResilientModel(StreamingModel(), breaker=CircuitBreaker(failure_threshold=1))
+    open_breaker(model.breaker)
+    expire(model.breaker)
+
+    stream = model.generate_content('prompt', stream=True)
+    assert next(stream).text == 'a'
+    # The client went away, or the pool's deadline closed the generator
+    stream.close()
+
+    assert [chunk.text for chunk in model.generate_content('prompt', stream=True)] == ['a', 'b', 'c']
+    assert model.breaker.state == 'closed'
+
+
+def test_unstarted_stream_does_not_take_the_trial():
+    model = ResilientModel(StreamingModel(), breaker=CircuitBreaker(failure_threshold=1))
+    open_breaker(model.breaker)
+    expire(model.breaker)
+    model.generate_content('prompt', stream=True).close()
+    assert list(model.generate_content('prompt', stream=True))
+
+
+def test_retries_then_gives_up_with_a_503():
+    error = ConnectionError('reset')
+    model = ResilientModel(StreamingModel(error=error), max_retries=2, backoff_base=0,
+                           breaker=CircuitBreaker(failure_threshold=10))
+    with pytest.raises(Exception) as raised:
+        model.generate_content('prompt')
+    assert raised.value.status_code == 503
+    assert model.model.calls == 3
+    assert model.counters['retries'] == 2
+
+
+def test_passed_deadline_bounds_the_attempt_timeout():
+    class RecordingModel(StreamingModel):
+        def generate_content(self, model_input, stream=False, **kwargs):
+            self.kwargs = kwargs
+            return super().generate_content(model_input, stream, **kwargs)
+
+    model = ResilientModel(RecordingModel(), deadline=60)
+    model.generate_content('prompt', deadline=2)
+    assert 0 < model.model.kwargs['request_options']['timeout'] <= 2
+    model.generate_content('prompt')
+    assert model.model.kwargs['request_options']['timeout'] > 2
+
+
+def test_stream_gives_up_retrying_at_the_passed_deadline():
+    model = ResilientModel(StreamingModel(error=ConnectionError('reset')), deadline=60, max_retries=100,
+                           backoff_base=0.05, backoff_max=0.05, breaker=CircuitBreaker(failure_threshold=1000))
+    stream = model.generate_content('prompt', stream=True, deadline=0.2)
+    with pytest.raises(Exception) as raised:
+        list(stream)
+    assert raised.value.status_code == 503
+    assert model.model.calls < 100
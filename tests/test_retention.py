@@ -0,0 +1,26 @@
+from datetime import datetime, timedelta
+
+from retention import RetentionWorker
+from session_store import MemorySessionStore, SQLiteSessionStore, TieredSessionStore, new_session
+
+
+def test_session_resumed_within_the_flush_window_is_not_deleted(app5):
+    store = TieredSessionStore(MemorySessionStore(), SQLiteSessionStore(app5.database_path), flush_interval=3600)
+    worker = RetentionWorker(app5.app, app5.db, app5.ChatSession, app5.ChatResponse, ttl_days=7, batch_pause=0,
+                             before_batch=[store.flush], on_deleted=[store.forget])
+
+    stale, resumed = new_session('stale'), new_session('resumed')
+    stale['last_activity'] = resumed['last_activity'] = datetime.now() - timedelta(days=30)
+    store.save_batch([stale, resumed], [])
+
+    # Resumed a moment ago: the new last_activity is still waiting in the write-behind tier
+    session = store.get_session('resumed')
+    session['last_activity'] = datetime.now()
+    store.save_session(session)
+    store.add_response('resumed', 'chat', 'Still feeding well')
+
+    run = worker.run_once()
+    assert run['sessions_deleted'] == 1
+    assert store.get_session('stale') is None
+    assert store.get_session('resumed') is not None
+    assert [r['response_text'] for r in store.recent_responses('resumed')] == ['Still feeding well']
@@ -0,0 +1,71 @@
+import pytest
+
+from session_store import MemorySessionStore, SQLiteSessionStore, TieredSessionStore, new_session
+
+
+@pytest.fixture
+def tiered(tmp_path):
+    sqlite_store = SQLiteSessionStore(str(tmp_path / 'sessions.db'))
+    sqlite_store.create_schema()
+    # A long interval so nothing is flushed unless the test (or the store) asks for it
+    return TieredSessionStore(MemorySessionStore(max_responses=20), sqlite_store, flush_interval=3600,
+                              batch_size=1000)
+
+
+def create(store, session_id):
+    assert store.get_session(session_id) is None
+    store.save_session(new_session(session_id, {'age': '3 months'}))
+    store.add_response(session_id, 'assessment', 'Looks like a mild rash')
+
+
+def test_new_session_is_served_from_memory_without_a_flush(tiered):
+    create(tiered, 'new')
+    responses = tiered.recent_responses('new', 5)
+    assert [r['response_text'] for r in responses] == ['Looks like a mild rash']
+    assert tiered.stats()['flushes'] == 0
+    assert tiered.stats()['pending_writes'] == 2
+
+
+def test_session_loaded_after_eviction_is_not_trusted_as_complete(tiered):
+    create(tiered, 'old')
+    tiered.flush()
+    tiered.memory.forget(['old'])
+    session = tiered.get_session('old')
+    tiered.save_session(session)
+    assert [r['response_text'] for r in tiered.recent_responses('old')] == ['Looks like a mild rash']
+
+
+def test_forget_drops_pending_writes(tiered):
+    create(tiered, 'deleted')
+    create(tiered, 'kept')
+    tiered.forget(['deleted'])
+    assert tiered.get_session('deleted') is None
+    tiered.flush()
+    assert tiered.sqlite.get_session('deleted') is None
+    assert tiered.sqlite.recent_responses('deleted') == []
+    assert tiered.sqlite.get_session('kept') is not None
+
+
+def test_flush_writes_pending_sessions_and_responses(tiered):
+    create(tiered, 'flushed')
+    assert tiered.flush() == 2
+    assert tiered.sqlite.get_session('flushed')['baby_info'] == {'age': '3 months'}
+    assert len(tiered.sqlite.recent_responses('flushed')) == 1
+
+
+def test_history_version_includes_pending_writes_and_survives_the_flush(tiered):
+    create(tiered, 'polled')
+    tiered.flush()
+    tiered.memory.forget(['polled'])
+    flushed = tiered.history_version('polled')
+    assert flushed[0] == 1
+
+    tiered.add_response('polled', 'chat', 'Try a lukewarm bath')
+    pending = tiered.history_version('polled')
+    assert pending[0] == 2 and pending[1] > flushed[1]
+    assert tiered.stats()['pending_writes'] == 1
+
+    tiered.flush()
+    assert tiered.history_version('polled') == pending
+    tiered.get_session('polled')
+    assert tiered.memory.cached_history_version('polled') == pending
@@ -0,0 +1,108 @@
+import threading
+
+import pytest
+from flask import jsonify
+
+from singleflight import SingleFlight
+
+
+def run(app5, name, scope, digest, handler, headers=None):
+    with app5.app.test_request_context('/chat', method='POST', headers=headers or {}):
+        response = app5.app.make_response(app5.run_single_flight(name, scope, digest, {}, handler))
+        return response.status_code, response.get_json()
+
+
+def blocking_handler(started, release, payload):
+    def handler(publish, close):
+        started.set()
+        release.wait(5)
+        return jsonify(publish(payload))
+    return handler
+
+
+def run_concurrently(app5, name, leader, follower):
+    """Start the leader, then send the follower while it is still in flight
+
+    The leader is let go shortly after, so a follower that joined its flight
+    gets its result.
+    """
+    started, release = threading.Event(), threading.Event()
+    results = {}
+    thread = threading.Thread(target=lambda: results.setdefault('leader', run(
+        app5, name, *leader[:2], blocking_handler(started, release, leader[2]), leader[3])))
+    thread.start()
+    assert started.wait(5)
+    timer = threading.Timer(0.2, release.set)
+    timer.start()
+    try:
+        results['follower'] = run(app5, name, *follower[:2], follower[2], follower[3])
+    finally:
+        release.set()
+        timer.cancel()
+        thread.join(5)
+    return results['leader'], results['follower']
+
+
+def never_called(publish, close):
+    raise AssertionError('follower ran its own handler')
+
+
+def test_same_idempotency_key_different_request_is_refused(app5):
+    key = {'Idempotency-Key': 'k-different'}
+    leader, follower = run_concurrently(
+        app5, 'test-chat',
+        ('session-1', 'digest-a', {'response': 'answer A'}, key),
+        ('session-1', 'digest-b', never_called, key),
+    )
+    assert leader == (200, {'response': 'answer A'})
+    assert follower[0] == 422
+
+
+def test_same_idempotency_key_same_request_is_coalesced(app5):
+    key = {'Idempotency-Key': 'k-same'}
+    leader, follower = run_concurrently(
+        app5, 'test-chat',
+        ('session-1', 'digest-a', {'response': 'answer A'}, key),
+        ('session-1', 'digest-a', never_called, key),
+    )
+    assert follower == (200, {'response': 'answer A', 'coalesced': True})
+
+
+def test_identical_requests_in_one_scope_are_coalesced(app5):
+    leader, follower = run_concurrently(
+        app5, 'test-chat',
+        ('session-2', 'digest-a', {'response': 'answer A'}, None),
+        ('session-2', 'digest-a', never_called, None),
+    )
+    assert follower[1]['coalesced'] is True
+
+
+def test_requests_without_a_scope_are_not_coalesced(app5):
+    calls = []
+
+    def handler(publish, close):
+        calls.append(1)
+        return jsonify(publish({'session_id': f'new-{len(calls)}'}))
+
+    first = run(app5, 'test-submit', None, 'digest-a', handler)
+    second = run(app5, 'test-submit', None, 'digest-a', handler)
+    assert first[1]['session_id'] != second[1]['session_id']
+    assert len(calls) == 2
+
+
+def test_requests_without_a_scope_are_replayed_under_an_idempotency_key(app5):
+    key = {'Idempotency-Key': 'k-new-session'}
+    first = run(app5, 'test-submit', None, 'digest-a',
+                lambda publish, close: jsonify(publish({'session_id': 'new'})), key)
+    second = run(app5, 'test-submit', None, 'digest-a', never_called, key)
+    assert first == second == (200, {'session_id': 'new'})
+    assert run(app5, 'test-submit', None, 'digest-b', never_called, key)[0] == 422
+
+
+def test_flight_digest_mismatch_raises():
+    flights = SingleFlight()
+    flights.begin('key', 'a')
+    assert flights.begin('key', 'a')[1] is False
+    with pytest.raises(ValueError):
+        flights.begin('key', 'b')
+    assert flights.snapshot()['conflicts'] == 1
@@ -0,0 +1,18 @@
+"""WSGI entry point for multi-worker serving
+
+    gunicorn -c gunicorn.conf.py
+
+APP_MODULE picks the app (app5 by default, or app6). Importing this module
+only builds the app, so gunicorn can preload it once in the master; each
+worker then creates its model client, connections and background threads
+in init_worker(), called from the post_fork hook in gunicorn.conf.py.
+migrate_database() creates and migrates the tables and runs in the master
+before any worker starts.
+"""
+import importlib
+import os
+
+application = importlib.import_module(os.getenv('APP_MODULE', 'app5'))
+app = application.app
+init_worker = application.init_worker
+migrate_database = application.migrate_database